@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import statistics
+import tempfile
+import datetime
+from contextlib import redirect_stdout
+
+from tarea import FileManagementSystem
+
+
+def generate_root(root_path, users, files, size, grants, versions, seed, depth=0):
+    # Crea una raíz sintética: usuarios, archivos en temporal, permisos e historial de versiones
+    # Devuelve el sistema y un diccionario usuario -> sesión
+    rng = random.Random(seed)
+    system = FileManagementSystem(root_path)
+
+    names = [f"usuario{i:04d}" for i in range(users)]
+    success, message = system.register_users([(name, "clave") for name in names])
+    if not success:
+        raise RuntimeError(message)
+
+    sessions = {}
+    for name in names:
+        success, session = system.login(name, "clave")
+        if not success:
+            raise RuntimeError(session)
+        sessions[name] = session
+
+    # Permisos: cada usuario da acceso a otros usuarios elegidos al azar
+    for name in names:
+        others = [other for other in names if other != name]
+        for target in rng.sample(others, min(grants, len(others))):
+            permission = rng.choice(["lectura", "escritura"])
+            system.grant_permission(sessions[name], target, permission)
+
+    # Archivos de trabajo y primer commit
+    for name in names:
+        temporal_dir = system.users[name]["temporal_dir"]
+        for i in range(files):
+            write_random_file(rng, os.path.join(temporal_dir, file_name(i, depth)), size)
+        system.commit(sessions[name])
+
+    # Historial: en cada commit cambia una parte de los archivos
+    for _ in range(versions):
+        for name in names:
+            touch_files(rng, system, name, files, size, depth=depth)
+            system.commit(sessions[name])
+
+    return system, sessions
+
+
+def file_name(i, depth):
+    # Ruta relativa del archivo i: con profundidad, repartido en subcarpetas de 10 en 10
+    folders = [f"carpeta{(i // 10 ** (level + 1)) % 10}" for level in range(depth)]
+    return "/".join(folders + [f"archivo{i:05d}.bin"])
+
+
+def write_random_file(rng, path, size):
+    # Escribe un archivo de contenido pseudoaleatorio (reproducible con la semilla)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(rng.getrandbits(8 * size).to_bytes(size, 'little') if size else b"")
+
+
+def touch_files(rng, system, name, files, size, fraction=0.1, depth=0):
+    # Reescribe una fracción de los archivos de la carpeta temporal del usuario
+    temporal_dir = system.users[name]["temporal_dir"]
+    for i in rng.sample(range(files), max(1, int(files * fraction)) if files else 0):
+        write_random_file(rng, os.path.join(temporal_dir, file_name(i, depth)), size)
+
+
+def measure(function, repetitions, setup=None):
+    # Ejecuta la operación varias veces y devuelve los tiempos en segundos
+    # setup se ejecuta antes de cada repetición y no se mide
+    times = []
+    for _ in range(repetitions):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        success, result = function()
+        times.append(time.perf_counter() - start)
+        if not success:
+            raise RuntimeError(result)
+    return {
+        "repeticiones": repetitions,
+        "min_s": min(times),
+        "mediana_s": statistics.median(times),
+        "media_s": statistics.mean(times),
+        "max_s": max(times)
+    }
+
+
+def run_benchmarks(system, sessions, files, size, repetitions, seed, depth=0):
+    # Mide cada operación de FileManagementSystem con el primer usuario de la raíz
+    rng = random.Random(seed + 1)
+    name = sorted(sessions)[0]
+    session = sessions[name]
+    latest = system.list_versions(session, limit=1)[1]
+    version_id = latest[0]["version_id"] if latest else None
+    some_file = file_name(0, depth)
+    grantors = [owner for owner, _ in system.list_accessible_folders(session)[1]]
+
+    results = {}
+    results["commit_sin_cambios"] = measure(lambda: system.commit(session), repetitions)
+    results["commit_con_cambios"] = measure(
+        lambda: system.commit(session), repetitions,
+        setup=lambda: touch_files(rng, system, name, files, size, depth=depth))
+    results["update"] = measure(lambda: system.update(session), repetitions)
+    results["update_simulado"] = measure(lambda: system.update(session, dry_run=True), repetitions)
+    if grantors:
+        results["update_ajeno"] = measure(lambda: system.update(session, grantors[0]), repetitions)
+    results["status"] = measure(lambda: system.status(session), repetitions)
+    results["list_versions"] = measure(lambda: system.list_versions(session), repetitions)
+    results["list_versions_10"] = measure(lambda: system.list_versions(session, limit=10), repetitions)
+    results["list_accessible_folders"] = measure(lambda: system.list_accessible_folders(session), repetitions)
+    if version_id:
+        results["recover_version_archivo"] = measure(
+            lambda: system.recover_version(session, "archivo", version_id, some_file), repetitions)
+        results["recover_version_carpeta"] = measure(
+            lambda: system.recover_version(session, "carpeta", version_id), repetitions)
+    return results
+
+
+def compare(results, previous_path):
+    # Muestra la relación entre las medianas de esta ejecución y las de un resultado anterior
+    with open(previous_path, 'r', encoding='utf-8') as f:
+        previous = json.load(f)["resultados"]
+    print(f"\nComparación con {previous_path} (mediana actual / mediana anterior):")
+    for operation, values in results.items():
+        if operation not in previous:
+            continue
+        ratio = values["mediana_s"] / previous[operation]["mediana_s"] if previous[operation]["mediana_s"] else 0
+        print(f"  {operation:<28} {ratio:6.2f}x")
+
+
+def main():
+    # Genera una raíz sintética, mide las operaciones y guarda los resultados en JSON
+    parser = argparse.ArgumentParser(description="Pruebas de rendimiento del Sistema de Control de Archivos")
+    parser.add_argument("--usuarios", type=int, default=10, help="número de usuarios")
+    parser.add_argument("--archivos", type=int, default=100, help="archivos por carpeta temporal")
+    parser.add_argument("--tamano", type=int, default=4096, help="tamaño de cada archivo en bytes")
+    parser.add_argument("--profundidad", type=int, default=0, help="niveles de subcarpetas en las carpetas temporales")
+    parser.add_argument("--permisos", type=int, default=3, help="permisos que otorga cada usuario")
+    parser.add_argument("--versiones", type=int, default=5, help="commits de historial por usuario")
+    parser.add_argument("--repeticiones", type=int, default=5, help="repeticiones de cada operación")
+    parser.add_argument("--semilla", type=int, default=1, help="semilla de los datos sintéticos")
+    parser.add_argument("--raiz", help="carpeta donde generar la raíz (por defecto una carpeta temporal que se borra)")
+    parser.add_argument("--salida", default="benchmark.json", help="archivo JSON de resultados")
+    parser.add_argument("--comparar", metavar="ARCHIVO", help="resultado anterior con el que comparar")
+    args = parser.parse_args()
+
+    root_path = os.path.abspath(args.raiz) if args.raiz else tempfile.mkdtemp(prefix="benchmark_raiz_")
+    system = None
+    try:
+        # Los mensajes del sistema no interesan durante la medición
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            start = time.perf_counter()
+            system, sessions = generate_root(root_path, args.usuarios, args.archivos, args.tamano,
+                                             args.permisos, args.versiones, args.semilla, args.profundidad)
+            setup_time = time.perf_counter() - start
+            results = run_benchmarks(system, sessions, args.archivos, args.tamano,
+                                     args.repeticiones, args.semilla, args.profundidad)
+            config = dict(system.config)
+    finally:
+        # Cerrar el sistema (hilos, seguimiento de cambios y base de datos) antes de borrar su raíz
+        if system is not None:
+            system.close()
+        if not args.raiz:
+            shutil.rmtree(root_path, ignore_errors=True)
+
+    report = {
+        "fecha": datetime.datetime.now().isoformat(),
+        "parametros": {
+            "usuarios": args.usuarios,
+            "archivos": args.archivos,
+            "tamano": args.tamano,
+            "profundidad": args.profundidad,
+            "permisos": args.permisos,
+            "versiones": args.versiones,
+            "repeticiones": args.repeticiones,
+            "semilla": args.semilla
+        },
+        "entorno": {
+            "python": platform.python_version(),
+            "plataforma": platform.platform(),
+            "configuracion": config
+        },
+        "preparacion_s": setup_time,
+        "resultados": results
+    }
+    with open(args.salida, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4, ensure_ascii=False)
+
+    print(f"Raíz sintética preparada en {setup_time:.2f} s")
+    for operation, values in results.items():
+        print(f"  {operation:<28} mediana {values['mediana_s'] * 1000:9.2f} ms   "
+              f"min {values['min_s'] * 1000:9.2f} ms   max {values['max_s'] * 1000:9.2f} ms")
+    print(f"Resultados guardados en {args.salida}")
+
+    if args.comparar:
+        compare(results, args.comparar)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,18 +2,1952 @@ import os
 import shutil
 import json
 import datetime
-import msvcrt
+import argparse
+import asyncio
+import contextvars
+import ctypes
+import ctypes.util
+import errno
+import functools
+import getpass
+import hashlib
+import io
+import mmap
+import socket
+import sqlite3
+import stat
+import struct
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 import uuid
+import lzma
+import zlib
 from cmd import Cmd
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager, redirect_stdout
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:  # Linux y macOS
+    msvcrt = None
+
+try:
+    import zstandard
+except ImportError:  # zstd es opcional
+    zstandard = None
+
+# Tamaño de bloque usado al leer archivos para calcular hashes
+BLOCK_SIZE = 1024 * 1024
+
+# Configuración por defecto, se puede cambiar en .configuracion.json dentro de la raíz
+DEFAULT_CONFIG = {
+    # Confirmar con el hash del contenido los archivos con igual tamaño pero distinta fecha
+    "verify_hash": False,
+    # Cómo se guardan los contenidos de las versiones: "auto", "reflink", "hardlink" o "copy"
+    "snapshot_backend": "auto",
+    # Número de hilos que copian archivos en paralelo en commit, update y recuperar
+    "transfer_workers": 8,
+    # Servicio (--servidor): peticiones atendidas a la vez e hilos para el trabajo de disco
+    "server_max_requests": 16,
+    "server_workers": 8,
+    # Archivo (relativo a la raíz) donde se añade una línea JSON por operación; None lo desactiva
+    "metrics_log": None,
+    # Retención de versiones para gc; una versión se conserva si cumple alguna regla (None la desactiva)
+    # keep_last: las N más recientes; keep_daily / keep_weekly: la más reciente de cada uno de los
+    # últimos N días / semanas con versiones; max_age_days: las que tienen menos de N días
+    "retention": {
+        "keep_last": None,
+        "keep_daily": None,
+        "keep_weekly": None,
+        "max_age_days": None
+    },
+    # empaquetar: versiones que se dejan sin empaquetar (las más recientes) y antigüedad mínima en días
+    "pack_keep_recent": 10,
+    "pack_min_age_days": 7,
+    # Deltas binarios respecto a la versión anterior del mismo archivo: tamaño mínimo del archivo,
+    # deltas seguidos como máximo antes de guardar de nuevo el contenido completo (0 los desactiva)
+    # y tamaño de bloque de la comparación
+    "delta_min_size": 1024 * 1024,
+    "delta_max_chain": 8,
+    "delta_block_size": 4096,
+    # Trocear por contenido los archivos de al menos chunk_min_size bytes (None lo desactiva),
+    # con trozos de chunk_avg_size bytes de media (entre la cuarta parte y el cuádruple)
+    "chunk_min_size": None,
+    "chunk_avg_size": 64 * 1024,
+    # Compresión de los contenidos nuevos: None, "zlib", "lzma" o "zstd" (si está instalado zstandard)
+    # con el nivel del códec (None usa el nivel por defecto); los archivos ya comprimidos se guardan tal cual
+    "compression": None,
+    "compression_level": None,
+    # Seguir los cambios de temporal y access/<dueño> (inotify en Linux, si no recorriendo con stat)
+    # para que commit, update y estado solo consulten los archivos modificados
+    "change_tracking": False,
+    # Al hacer commit, llevar los archivos cambiados a las carpetas access/<dueño> de los usuarios con
+    # permiso que ya la tienen, sin tocar los archivos que ellos hayan cambiado
+    "publish_on_commit": False,
+    # Archivos que importar copia en cada tanda (con una sola comprobación de permisos y del lock)
+    "import_batch_size": 1000
+}
+
+# ioctl de Linux para clonar un archivo compartiendo bloques (copy-on-write)
+FICLONE = 0x40049409
+
+# Errores que indican que el sistema de archivos no soporta reflinks o enlaces duros
+UNSUPPORTED_LINK_ERRORS = {errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.EPERM,
+                           errno.EOPNOTSUPP, errno.ENOSYS, errno.EMLINK}
+
+# Errores que indican que no se puede copiar dentro del kernel entre estos dos archivos
+UNSUPPORTED_COPY_ERRORS = UNSUPPORTED_LINK_ERRORS | {errno.EBADF, errno.ENOTSOCK}
+
+# Contadores de la operación que se está midiendo; TransferEngine los pasa a sus hilos
+_current_stats = contextvars.ContextVar("current_stats", default=None)
+
+def count(counter, amount=1):
+    # Suma al contador de la operación en curso; fuera de una operación medida no hace nada
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.add(counter, amount)
+
+@contextmanager
+def timed(phase):
+    # Acumula en "<phase>_seconds" el tiempo del bloque para la operación en curso
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        count(f"{phase}_seconds", time.perf_counter() - start)
+
+def _kernel_copy(src_fd, dst_fd, size):
+    # Copia size bytes sin pasar por Python con copy_file_range o sendfile
+    # Devuelve False si ninguno está soportado (solo se decide antes de escribir nada)
+    # Algunos sistemas de archivos devuelven 0 sin copiar nada: al principio se prueba el siguiente
+    # método; a mitad de copia es un error, nunca un archivo cortado
+    methods = []
+    if hasattr(os, "copy_file_range"):
+        methods.append(lambda offset: os.copy_file_range(src_fd, dst_fd, size - offset, offset, offset))
+    if hasattr(os, "sendfile"):
+        methods.append(lambda offset: os.sendfile(dst_fd, src_fd, offset, size - offset))
+
+    for method in methods:
+        offset = 0
+        try:
+            while offset < size:
+                copied = method(offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError as e:
+            if offset or e.errno not in UNSUPPORTED_COPY_ERRORS:
+                raise
+            continue
+        if offset == size:
+            return True
+        if offset:
+            raise OSError(errno.EIO, f"Copia incompleta: {offset} de {size} bytes")
+
+    return False
+
+def fast_copy(src_path, dst_path):
+    # Copia un archivo con sus metadatos, dentro del kernel cuando el sistema lo permite
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        size = os.fstat(src.fileno()).st_size
+        if not _kernel_copy(src.fileno(), dst.fileno(), size):
+            shutil.copyfileobj(src, dst, BLOCK_SIZE)
+    shutil.copystat(src_path, dst_path)
+    count("files_copied")
+    count("bytes_written", size)
+
+def clone_copy(src_path, dst_path):
+    # Copia un archivo con sus metadatos como reflink (FICLONE): comparte los bloques con el original
+    # pero cada copia se puede modificar sin afectar a las demás. False si el sistema no lo permite
+    if fcntl is None:
+        return False
+    try:
+        with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError as e:
+        if e.errno not in UNSUPPORTED_LINK_ERRORS:
+            raise
+        return False
+    shutil.copystat(src_path, dst_path)
+    count("files_linked")
+    return True
+
+def atomic_copy(src_path, dst_path, clone=False):
+    # Copia src sobre dst escribiendo primero un temporal y renombrándolo
+    # Así nunca se reescribe en el sitio un archivo que pueda compartir inodo con un blob
+    # clone: probar antes con un reflink
+    tmp_path = os.path.join(os.path.dirname(dst_path), f".{os.path.basename(dst_path)}.{uuid.uuid4().hex}.tmp")
+    try:
+        if not (clone and clone_copy(src_path, tmp_path)):
+            fast_copy(src_path, tmp_path)
+        os.replace(tmp_path, dst_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+class OperationStats:
+    # Contadores de una ejecución de una operación; los hilos de transferencia suman a la vez
+
+    def __init__(self, name):
+        self.name = name
+        self.counters = {}
+        self.failed = False
+        self._lock = threading.Lock()
+
+    def add(self, counter, amount=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+class Metrics:
+    # Métricas en memoria por operación: llamadas, errores, tiempo y los contadores de los pasos internos
+    # Se consultan con snapshot(), se exportan en formato Prometheus y opcionalmente se registran en JSON
+
+    # Descripción de cada contador para la exportación en formato Prometheus
+    DESCRIPTIONS = {
+        "calls": "Operaciones ejecutadas",
+        "errors": "Operaciones que devolvieron error",
+        "seconds": "Tiempo total de las operaciones",
+        "files_stat": "Archivos consultados con stat",
+        "files_copied": "Archivos copiados byte a byte",
+        "files_linked": "Archivos guardados con reflink o enlace duro",
+        "bytes_written": "Bytes escritos",
+        "bytes_hashed": "Bytes leídos para calcular hashes",
+        "delta_objects": "Contenidos guardados como delta",
+        "chunks_stored": "Trozos nuevos guardados de archivos troceados",
+        "compressed_objects": "Contenidos guardados comprimidos",
+        "user_saves": "Transacciones guardadas en la base de usuarios",
+        "scan_seconds": "Tiempo comparando carpetas",
+        "snapshot_seconds": "Tiempo creando versiones",
+        "sync_seconds": "Tiempo copiando y borrando archivos de trabajo",
+        "restore_seconds": "Tiempo recuperando archivos de versiones",
+        "publish_seconds": "Tiempo publicando commits en las carpetas access de otros usuarios",
+        "files_published": "Archivos publicados en carpetas access de otros usuarios",
+        "publish_conflicts": "Archivos sin publicar porque el otro usuario los había cambiado",
+        "import_seconds": "Tiempo importando árboles de archivos",
+        "files_imported": "Archivos importados desde carpetas locales",
+        "user_saves_seconds": "Tiempo guardando usuarios y permisos"
+    }
+
+    def __init__(self, log_path=None):
+        self.log_path = log_path
+        self._totals = {}  # operación -> contador -> valor
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def operation(self, name):
+        # Mide una operación; si ya hay una en curso en este contexto, los contadores se suman a esa
+        if _current_stats.get() is not None:
+            yield None
+            return
+
+        stats = OperationStats(name)
+        token = _current_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            yield stats
+        except BaseException:
+            stats.failed = True
+            raise
+        finally:
+            _current_stats.reset(token)
+            stats.add("seconds", time.perf_counter() - start)
+            stats.add("calls")
+            if stats.failed:
+                stats.add("errors")
+            self._record(stats)
+
+    def _record(self, stats):
+        with self._lock:
+            totals = self._totals.setdefault(stats.name, {})
+            for counter, value in stats.counters.items():
+                totals[counter] = totals.get(counter, 0) + value
+
+        if self.log_path:
+            entry = {
+                "timestamp": datetime.datetime.now().isoformat(),
+                "operation": stats.name,
+                "ok": not stats.failed
+            }
+            entry.update(stats.counters)
+            try:
+                with self._lock, open(self.log_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            except OSError:
+                pass  # las métricas nunca hacen fallar una operación
+
+    def snapshot(self):
+        # Copia de los totales: operación -> contador -> valor
+        with self._lock:
+            return {name: dict(counters) for name, counters in self._totals.items()}
+
+    def reset(self):
+        with self._lock:
+            self._totals.clear()
+
+    def to_prometheus(self):
+        # Totales en el formato de texto de Prometheus, un contador por tipo con la operación como etiqueta
+        totals = self.snapshot()
+        counters = sorted({counter for values in totals.values() for counter in values})
+        lines = []
+        for counter in counters:
+            metric = f"control_archivos_{counter}_total"
+            if counter == "seconds":
+                metric = "control_archivos_operation_seconds_total"
+            lines.append(f"# HELP {metric} {self.DESCRIPTIONS.get(counter, counter)}")
+            lines.append(f"# TYPE {metric} counter")
+            for name in sorted(totals):
+                if counter in totals[name]:
+                    lines.append(f'{metric}{{operation="{name}"}} {totals[name][counter]}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        # Escribe el archivo completo de una vez para que un lector nunca vea uno a medias
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(self.to_prometheus())
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+def instrumented(method):
+    # Mide una operación pública de FileManagementSystem; cuenta como error si devuelve (False, ...)
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.metrics.operation(method.__name__) as stats:
+            result = method(self, *args, **kwargs)
+            if stats is not None and isinstance(result, tuple) and result and result[0] is False:
+                stats.failed = True
+            return result
+    return wrapper
+
+class FileLock:
+    # Bloqueo exclusivo entre procesos con fcntl.flock sobre un archivo de bloqueo
+    # En sistemas sin fcntl (Windows) no bloquea entre procesos; los hilos usan sus propios locks
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+class Session:
+    # Sesión de un usuario; la devuelve login() y se pasa a cada operación
+    # Varias sesiones (de usuarios distintos o del mismo) pueden usarse a la vez desde distintos hilos
+
+    def __init__(self, username):
+        self.username = username
+        self.token = uuid.uuid4().hex
+        self.created_at = datetime.datetime.now().isoformat()
+        self.active = True
+
+    def __repr__(self):
+        return f"Session({self.username!r})"
+
+class TransferError(Exception):
+    # Errores de una transferencia en paralelo, con el archivo que falló y su excepción
+
+    def __init__(self, errors):
+        self.errors = errors
+        details = "; ".join(f"{name}: {error}" for name, error in errors[:5])
+        if len(errors) > 5:
+            details += f" (y {len(errors) - 5} más)"
+        super().__init__(f"fallaron {len(errors)} archivos: {details}")
+
+class TransferEngine:
+    # Ejecuta operaciones por archivo (copias, blobs...) en un pool de hilos acotado
+    # Un archivo que falla no detiene al resto; los errores se reúnen en un TransferError
+
+    def __init__(self, workers=8):
+        self.workers = max(1, int(workers))
+        # Un único pool para todas las operaciones: con varias operaciones a la vez (servicio)
+        # nunca hay más de workers hilos copiando
+        self._local = threading.local()
+        self._pool = None
+        if self.workers > 1:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="transferencias",
+                                            initializer=self._mark_worker)
+
+    def _mark_worker(self):
+        self._local.worker = True
+
+    def close(self):
+        # Espera a las tareas pendientes y termina los hilos del pool
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def run(self, func, items, label=str):
+        # Aplica func a cada elemento y devuelve los resultados en el mismo orden
+        # Dentro de una tarea del propio pool se trabaja en el mismo hilo: esperar a otras tareas
+        # del pool desde uno de sus hilos podría dejarlo bloqueado
+        items = list(items)
+        results = [None] * len(items)
+        errors = []
+
+        if self._pool is None or len(items) <= 1 or getattr(self._local, "worker", False):
+            for i, item in enumerate(items):
+                try:
+                    results[i] = func(item)
+                except Exception as e:
+                    errors.append((label(item), e))
+        else:
+            # Cada tarea corre en una copia del contexto para que sus contadores vayan a la operación
+            futures = [self._pool.submit(contextvars.copy_context().run, func, item) for item in items]
+            for i, future in enumerate(futures):
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    errors.append((label(items[i]), e))
+
+        if errors:
+            raise TransferError(errors)
+        return results
+
+    def copy_many(self, pairs, clone=False):
+        # Copia pares (origen, destino) en paralelo reemplazando cada destino de forma atómica
+        # clone: compartir los bloques con reflink cuando el sistema de archivos lo permite
+        self.run(lambda pair: atomic_copy(*pair, clone=clone), pairs, label=lambda pair: os.path.basename(pair[1]))
+
+class MapReader:
+    # Lectura tipo archivo de un trozo de un mmap (un objeto dentro de un paquete)
+
+    def __init__(self, data, offset, size):
+        self._data = data
+        self._start = offset
+        self._size = size
+        self._pos = 0
+
+    def read(self, n=-1):
+        end = self._size if n is None or n < 0 else min(self._size, self._pos + n)
+        chunk = self._data[self._start + self._pos:self._start + end]
+        self._pos = max(self._pos, end)
+        return chunk
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self._pos
+        elif whence == os.SEEK_END:
+            pos += self._size
+        self._pos = max(0, pos)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        pass
+
+class PackFile:
+    # Paquete con los contenidos y los metadatos de muchas versiones frías en un solo archivo
+    # Formato: cabecera, contenidos uno detrás de otro, índice JSON y un trailer con la posición del índice
+    # El índice guarda {"objects": {hash: [posición, tamaño, tipo]}, "versions": {dueño: {id_versión: metadata}}}
+    # El tipo es el de BlobStore.KINDS ("full" si falta); se lee con mmap, así se extrae
+    # un contenido sin leer el resto del paquete
+
+    MAGIC = b"CAPACK1\n"
+    TRAILER = struct.Struct("<QQ8s")  # posición del índice, tamaño del índice, marca
+    TRAILER_MAGIC = b"CAPACKIX"
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if self._map[:len(self.MAGIC)] != self.MAGIC:
+                raise ValueError
+            offset, length, magic = self.TRAILER.unpack_from(self._map, len(self._map) - self.TRAILER.size)
+            if magic != self.TRAILER_MAGIC:
+                raise ValueError
+            index = json.loads(self._map[offset:offset + length].decode('utf-8'))
+        except (ValueError, struct.error):
+            self._map.close()
+            raise ValueError(f"Paquete dañado: {path}")
+        self.objects = index["objects"]
+        self.versions = index["versions"]
+
+    def close(self):
+        self._map.close()
+
+    def size(self, digest):
+        return self.objects[digest][1]
+
+    def kind(self, digest):
+        entry = self.objects[digest]
+        return entry[2] if len(entry) > 2 else "full"
+
+    def reader(self, digest):
+        # Lector del objeto tal como está guardado (sin reconstruir deltas)
+        offset, size = self.objects[digest][:2]
+        return MapReader(self._map, offset, size)
+
+    def write_object(self, digest, f):
+        # Escribe el objeto en un archivo abierto, leyendo del mmap por bloques
+        offset, size = self.objects[digest][:2]
+        view = memoryview(self._map)
+        try:
+            for start in range(offset, offset + size, BLOCK_SIZE):
+                f.write(view[start:min(start + BLOCK_SIZE, offset + size)])
+        finally:
+            view.release()
+        return size
+
+    @classmethod
+    def write(cls, path, objects, versions):
+        # Crea un paquete; objects es hash -> origen (otro PackFile o (ruta de un archivo, tipo))
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        index = {"objects": {}, "versions": versions}
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(cls.MAGIC)
+                for digest, source in objects.items():
+                    offset = f.tell()
+                    if isinstance(source, PackFile):
+                        source.write_object(digest, f)
+                        kind = source.kind(digest)
+                    else:
+                        source_path, kind = source
+                        with open(source_path, 'rb') as src:
+                            shutil.copyfileobj(src, f, BLOCK_SIZE)
+                    index["objects"][digest] = [offset, f.tell() - offset]
+                    if kind != "full":
+                        index["objects"][digest].append(kind)
+                index_offset = f.tell()
+                data = json.dumps(index, ensure_ascii=False).encode('utf-8')
+                f.write(data)
+                f.write(cls.TRAILER.pack(index_offset, len(data), cls.TRAILER_MAGIC))
+                count("bytes_written", f.tell())
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+class DeltaSignature:
+    # Firma de un contenido para calcular deltas estilo rsync: suma Adler-32 y hash fuerte de cada bloque
+    # Se alimenta con write(), así se calcula mientras se reconstruye el contenido sin guardarlo
+    # El último bloque incompleto no se incluye: en el delta queda como bytes literales
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.blocks = {}  # suma débil -> {hash fuerte: número de bloque}
+        self.strong = []  # hash fuerte de cada bloque, en orden
+        self._pending = bytearray()
+
+    @staticmethod
+    def strong_hash(block):
+        return hashlib.blake2b(block, digest_size=16).digest()
+
+    def _add(self, block):
+        strong = self.strong_hash(block)
+        self.blocks.setdefault(zlib.adler32(block), {}).setdefault(strong, len(self.strong))
+        self.strong.append(strong)
+
+    def write(self, data):
+        size = self.block_size
+        data = memoryview(data)
+        if self._pending:
+            needed = size - len(self._pending)
+            self._pending += data[:needed]
+            data = data[needed:]
+            if len(self._pending) < size:
+                return
+            self._add(bytes(self._pending))
+            self._pending = bytearray()
+        full = len(data) - len(data) % size
+        for start in range(0, full, size):
+            self._add(data[start:start + size])
+        self._pending += data[full:]
+
+class Delta:
+    # Delta binario de un contenido respecto a otro (la base), calculado con suma rodante como rsync
+    # Formato: MAGIC, hash de la base, profundidad de la cadena y las instrucciones:
+    # b"C" + posición y longitud a copiar de la base, b"L" + longitud y bytes literales, b"E" al final
+
+    MAGIC = b"CADELTA1"
+    HEADER = struct.Struct("<64sI")  # hash de la base, profundidad (1 si la base es completa)
+    COPY = struct.Struct("<QQ")
+    LITERAL = struct.Struct("<Q")
+    MODULE = 65521  # módulo de Adler-32
+    MIN_CHECK = 4 * 1024 * 1024  # bytes recorridos antes de abandonar un delta que no compensa
+
+    @classmethod
+    def encode(cls, target, signature):
+        # Calcula las instrucciones para reconstruir target (bytes o mmap) a partir de la base firmada
+        # Devuelve None si más de la mitad del contenido serían bytes literales
+        size = signature.block_size
+        table = signature.blocks
+        strongs = signature.strong
+        strong_hash = signature.strong_hash
+        module = cls.MODULE
+        length = len(target)
+        check_at = max(cls.MIN_CHECK, length // 10)
+
+        ops = []
+        literal = 0
+        pos = 0
+        literal_start = 0
+        expected = 0  # bloque que seguiría al último encontrado
+        while pos + size <= length:
+            # Lo habitual es que el contenido siga igual que en la base: probar primero el siguiente bloque
+            if expected < len(strongs) and strong_hash(target[pos:pos + size]) == strongs[expected]:
+                index = expected
+            else:
+                index = None
+                weak = zlib.adler32(target[pos:pos + size])
+                a, b = weak & 0xffff, weak >> 16
+                while True:
+                    candidates = table.get((b << 16) | a)
+                    if candidates:
+                        index = candidates.get(strong_hash(target[pos:pos + size]))
+                        if index is not None:
+                            break
+                    if pos + size >= length:
+                        break
+                    # Desplazar la ventana un byte actualizando la suma sin recalcularla
+                    removed, added = target[pos], target[pos + size]
+                    a = (a - removed + added) % module
+                    b = (b - size * removed + a - 1) % module
+                    pos += 1
+                    if pos >= check_at and not pos & 0xffff and literal + pos - literal_start > pos // 2:
+                        return None
+                if index is None:
+                    break
+
+            if pos > literal_start:
+                ops.append(("L", literal_start, pos))
+                literal += pos - literal_start
+            offset = index * size
+            if ops and ops[-1][0] == "C" and ops[-1][1] + ops[-1][2] == offset:
+                ops[-1] = ("C", ops[-1][1], ops[-1][2] + size)
+            else:
+                ops.append(("C", offset, size))
+            pos += size
+            literal_start = pos
+            expected = index + 1
+
+        if literal_start < length:
+            ops.append(("L", literal_start, length))
+            literal += length - literal_start
+        if literal > length // 2:
+            return None
+        return ops
+
+    @classmethod
+    def write(cls, f, base, depth, ops, target):
+        # Escribe el delta en un archivo abierto; los literales se copian de target
+        f.write(cls.MAGIC)
+        f.write(cls.HEADER.pack(base.encode('ascii'), depth))
+        for op in ops:
+            if op[0] == "C":
+                f.write(b"C" + cls.COPY.pack(op[1], op[2]))
+            else:
+                f.write(b"L" + cls.LITERAL.pack(op[2] - op[1]))
+                for start in range(op[1], op[2], BLOCK_SIZE):
+                    f.write(target[start:min(start + BLOCK_SIZE, op[2])])
+        f.write(b"E")
+
+    @classmethod
+    def read_header(cls, reader):
+        # Devuelve (hash de la base, profundidad) y deja el lector en la primera instrucción
+        if reader.read(len(cls.MAGIC)) != cls.MAGIC:
+            raise ValueError("Delta dañado")
+        base, depth = cls.HEADER.unpack(reader.read(cls.HEADER.size))
+        return base.decode('ascii'), depth
+
+    @classmethod
+    def apply(cls, reader, base, out):
+        # Reconstruye el contenido en out leyendo el delta y la base (un archivo con seek) por trozos
+        # reader debe estar ya después de la cabecera
+        written = 0
+        while True:
+            tag = reader.read(1)
+            if tag == b"E":
+                return written
+            if tag == b"C":
+                offset, length = cls.COPY.unpack(reader.read(cls.COPY.size))
+                base.seek(offset)
+                source = base
+            elif tag == b"L":
+                length, = cls.LITERAL.unpack(reader.read(cls.LITERAL.size))
+                source = reader
+            else:
+                raise ValueError("Delta dañado")
+            while length:
+                chunk = source.read(min(length, BLOCK_SIZE))
+                if not chunk:
+                    raise ValueError("Delta incompleto")
+                out.write(chunk)
+                length -= len(chunk)
+                written += len(chunk)
+
+class Chunker:
+    # Corta contenidos en trozos de tamaño variable con los cortes definidos por el contenido (estilo FastCDC)
+    # Cada byte se convierte en un bit pseudoaleatorio con una tabla (bytes.translate) y se corta donde
+    # los últimos bits forman un patrón fijo, que se busca con bytes.find: las dos cosas se hacen en C,
+    # sin un paso de Python por byte. Un corte depende solo de los últimos bytes, así insertar o desplazar
+    # bytes solo cambia los trozos de alrededor y el resto se comparten entre versiones, archivos y usuarios
+    # Manifiesto de un archivo troceado: MAGIC y por cada trozo su SHA-256 y su tamaño
+
+    MAGIC = b"CACHUNK1"
+    ENTRY = struct.Struct("<32sI")
+    # Byte -> bit pseudoaleatorio fijo (como bytes 0/1) y los bits del patrón de corte
+    BITS = bytes(hashlib.sha256(bytes([i])).digest()[0] & 1 for i in range(256))
+    PATTERN = bytes(byte & 1 for byte in hashlib.sha256(b"corte").digest())
+
+    def __init__(self, avg_size=64 * 1024):
+        self.avg_size = avg_size
+        self.min_size = avg_size // 4
+        self.max_size = avg_size * 4
+        bits = min(max(2, avg_size.bit_length() - 1), len(self.PATTERN) - 1)
+        # Normalización de FastCDC: más difícil cortar antes del tamaño medio (patrón de bits + 1 bits)
+        # y más fácil después (bits - 1, el final del mismo patrón)
+        self.pattern_small = self.PATTERN[:bits + 1]
+        self.pattern_large = self.pattern_small[2:]
+
+    def cut(self, data, start):
+        # Posición donde termina el trozo que empieza en start
+        length = len(data) - start
+        if length <= self.min_size:
+            return len(data)
+        limit = min(length, self.max_size)
+        middle = min(limit, self.avg_size)
+
+        # No se buscan cortes en los primeros min_size bytes
+        for pattern, begin, end in ((self.pattern_small, start + self.min_size + 1, start + middle),
+                                    (self.pattern_large, start + middle + 1, start + limit)):
+            if begin > end:
+                continue
+            # Bits de los bytes de los patrones que terminan entre begin y end
+            offset = max(begin - len(pattern), 0)
+            found = data[offset:end].translate(self.BITS).find(pattern)
+            if found >= 0:
+                return offset + found + len(pattern)
+        return start + limit
+
+    def boundaries(self, data):
+        # Recorre los trozos de data (bytes o mmap): (inicio, fin)
+        start = 0
+        while start < len(data):
+            end = self.cut(data, start)
+            yield start, end
+            start = end
+
+    @classmethod
+    def write_manifest(cls, f, chunks):
+        f.write(cls.MAGIC)
+        for digest, size in chunks:
+            f.write(cls.ENTRY.pack(bytes.fromhex(digest), size))
+
+    @classmethod
+    def read_manifest(cls, reader):
+        # Lista de (hash, tamaño) de los trozos, en orden
+        if reader.read(len(cls.MAGIC)) != cls.MAGIC:
+            raise ValueError("Manifiesto de trozos dañado")
+        chunks = []
+        while True:
+            entry = reader.read(cls.ENTRY.size)
+            if not entry:
+                return chunks
+            digest, size = cls.ENTRY.unpack(entry)
+            chunks.append((digest.hex(), size))
+
+class Compression:
+    # Compresión de objetos por trozos, sin tener el archivo entero en memoria
+    # Formato: MAGIC, nombre del códec y los datos comprimidos
+
+    MAGIC = b"CACOMP1\n"
+    HEADER = struct.Struct("<8s")
+    # Extensiones de archivos que ya vienen comprimidos y no merece la pena comprimir otra vez
+    SKIP_EXTENSIONS = {
+        ".7z", ".avi", ".br", ".bz2", ".docx", ".flac", ".gif", ".gz", ".jar", ".jpeg", ".jpg", ".lz4",
+        ".m4a", ".mkv", ".mov", ".mp3", ".mp4", ".odt", ".ogg", ".pdf", ".png", ".pptx", ".rar", ".tgz",
+        ".webm", ".webp", ".xlsx", ".xz", ".zip", ".zst"
+    }
+    # Se prueba a comprimir el principio del archivo; si no baja de este tamaño relativo se guarda sin comprimir
+    SAMPLE_SIZE = 64 * 1024
+    MIN_RATIO = 0.9
+
+    @staticmethod
+    def available():
+        codecs = ["zlib", "lzma"]
+        if zstandard is not None:
+            codecs.append("zstd")
+        return codecs
+
+    @staticmethod
+    def compressor(codec, level=None):
+        # Objeto con compress(datos) y flush()
+        if codec == "zlib":
+            return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level)
+        if codec == "lzma":
+            return lzma.LZMACompressor(preset=level)
+        if codec == "zstd" and zstandard is not None:
+            return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+        raise ValueError(f"Compresión '{codec}' no disponible")
+
+    @staticmethod
+    def decompressor(codec):
+        # Objeto con decompress(datos, max_length) y eof (zlib y lzma)
+        if codec == "zlib":
+            return zlib.decompressobj()
+        if codec == "lzma":
+            return lzma.LZMADecompressor()
+        raise ValueError(f"Compresión '{codec}' no disponible")
+
+    @classmethod
+    def worth_compressing(cls, path):
+        # Heurística: no se comprimen formatos ya comprimidos ni contenidos que apenas se reducen
+        if os.path.splitext(path)[1].lower() in cls.SKIP_EXTENSIONS:
+            return False
+        with open(path, 'rb') as f:
+            return cls.compresses_well(f.read(cls.SAMPLE_SIZE))
+
+    @classmethod
+    def compresses_well(cls, data):
+        sample = data[:cls.SAMPLE_SIZE]
+        return bool(sample) and len(zlib.compress(sample, 1)) < len(sample) * cls.MIN_RATIO
+
+    @classmethod
+    def compress(cls, reader, out, codec, level=None):
+        # Comprime el contenido de reader en out
+        out.write(cls.MAGIC + cls.HEADER.pack(codec.encode()))
+        compressor = cls.compressor(codec, level)
+        while True:
+            block = reader.read(BLOCK_SIZE)
+            if not block:
+                break
+            out.write(compressor.compress(block))
+        out.write(compressor.flush())
+
+    @classmethod
+    def decompress(cls, reader, out):
+        # Escribe en out el contenido descomprimido, de BLOCK_SIZE en BLOCK_SIZE bytes como mucho:
+        # un bloque pequeño muy comprimido nunca se descomprime entero en memoria
+        # Un objeto cortado (sin el final del flujo comprimido) es un error, no un archivo más corto
+        if reader.read(len(cls.MAGIC)) != cls.MAGIC:
+            raise ValueError("Objeto comprimido dañado")
+        codec = cls.HEADER.unpack(reader.read(cls.HEADER.size))[0].rstrip(b"\0").decode()
+        if codec == "zstd" and zstandard is not None:
+            # El lector de zstandard ya devuelve como mucho lo que se le pide
+            source = zstandard.ZstdDecompressor().stream_reader(reader, closefd=False)
+            for block in iter(lambda: source.read(BLOCK_SIZE), b''):
+                out.write(block)
+            return
+
+        decompressor = cls.decompressor(codec)
+        if codec == "zlib":
+            data = b''
+            while not decompressor.eof:
+                data = data or reader.read(BLOCK_SIZE)
+                if not data:
+                    break
+                out.write(decompressor.decompress(data, BLOCK_SIZE))
+                data = decompressor.unconsumed_tail
+            out.write(decompressor.flush())
+        else:
+            while not decompressor.eof:
+                data = reader.read(BLOCK_SIZE) if decompressor.needs_input else b''
+                if decompressor.needs_input and not data:
+                    break
+                out.write(decompressor.decompress(data, BLOCK_SIZE))
+        if not decompressor.eof:
+            raise ValueError("Objeto comprimido incompleto")
+
+class HashWriter:
+    # Destino de escritura que solo calcula el SHA-256 de lo escrito, para comprobar un contenido sin guardarlo
+
+    def __init__(self):
+        self.sha = hashlib.sha256()
+
+    def write(self, data):
+        self.sha.update(data)
+        return len(data)
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+class BlobStore:
+    # Almacén de archivos direccionado por contenido (SHA-256)
+    # Cada contenido se guarda una sola vez y lo comparten todas las versiones y usuarios
+    # Un contenido se guarda completo, comprimido, como delta respecto al contenido anterior del mismo
+    # archivo o, si es grande, troceado (un manifiesto con los hashes de sus trozos, que son objetos)
+    # Las carpetas de las versiones también son objetos ("tree"): un JSON con sus archivos y subcarpetas
+
+    # Tipo de objeto -> sufijo del archivo suelto en .objetos
+    KINDS = {"full": "", "delta": ".delta", "chunks": ".chunks", "compressed": ".z", "tree": ".tree"}
+    TREE_MAGIC = b"CATREE1\n"
+
+    # Métodos que se prueban en orden para cada backend; la copia de bytes siempre es el último recurso
+    BACKENDS = {
+        "auto": ("reflink", "hardlink", "copy"),
+        "reflink": ("reflink", "copy"),
+        "hardlink": ("hardlink", "copy"),
+        "copy": ("copy",)
+    }
+
+    def __init__(self, objects_dir, backend="auto", delta_min_size=None, delta_max_chain=0, delta_block_size=4096,
+                 chunk_min_size=None, chunk_avg_size=64 * 1024, compression=None, compression_level=None):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Backend de versiones no válido: {backend}")
+        self.objects_dir = objects_dir
+        self.packs_dir = os.path.join(objects_dir, "paquetes")
+        # Deltas: tamaño mínimo del archivo, longitud máxima de la cadena (0 los desactiva) y tamaño de bloque
+        self.delta_min_size = delta_min_size
+        self.delta_max_chain = delta_max_chain
+        self.delta_block_size = delta_block_size
+        # Trocear los archivos de al menos chunk_min_size bytes (None lo desactiva)
+        self.chunk_min_size = chunk_min_size
+        self.chunker = Chunker(chunk_avg_size)
+        # Códec con el que se comprimen los contenidos nuevos (None los guarda tal cual)
+        self.compression = compression
+        self.compression_level = compression_level
+        self.methods = list(self.BACKENDS[backend])
+        self._methods_lock = threading.Lock()
+        self._packs = {}  # ruta -> PackFile
+        self._packs_lock = threading.Lock()
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self._load_packs()
+
+    def _path(self, digest):
+        # Ruta del blob, repartida en subcarpetas por los dos primeros caracteres del hash
+        return os.path.join(self.objects_dir, digest[:2], digest[2:])
+
+    @staticmethod
+    def hash_file(path):
+        # Calcula el SHA-256 de un archivo leyéndolo por bloques
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+                sha.update(block)
+                count("bytes_hashed", len(block))
+        return sha.hexdigest()
+
+    def exists(self, digest):
+        return self._loose(digest) is not None or self._find_pack(digest) is not None
+
+    def _loose(self, digest):
+        # (tipo, ruta) del objeto suelto en .objetos, None si no hay
+        path = self._path(digest)
+        for kind, suffix in self.KINDS.items():
+            if os.path.exists(path + suffix):
+                return kind, path + suffix
+        return None
+
+    def loose_path(self, digest):
+        # (ruta, tipo) del objeto suelto en .objetos, None si solo está en un paquete o no existe
+        loose = self._loose(digest)
+        return (loose[1], loose[0]) if loose else None
+
+    @contextmanager
+    def open_stored(self, digest):
+        # Abre el objeto tal como está guardado para llevarlo a otro almacén: (tipo, tamaño, lector)
+        loose = self._loose(digest)
+        if loose:
+            with open(loose[1], 'rb') as f:
+                yield loose[0], os.fstat(f.fileno()).st_size, f
+            return
+        pack = self._find_pack(digest)
+        if pack is None:
+            raise FileNotFoundError(errno.ENOENT, "Contenido no encontrado", digest)
+        yield pack.kind(digest), pack.size(digest), pack.reader(digest)
+
+    def put_stored(self, digest, kind, reader):
+        # Guarda un objeto leído con open_stored de otro almacén, sin reconstruirlo; False si ya existía
+        # El almacén lo comparten todos los usuarios: un objeto completo se comprueba con su hash mientras se
+        # copia (ValueError si no coincide) y el resto, que necesita sus dependencias, se debe comprobar con
+        # verify en cuanto estén guardadas
+        if self.exists(digest):
+            return False
+        if kind == "full":
+            self._write_object(digest, kind, lambda f: self._copy_checked(reader, f, digest))
+        else:
+            self._write_object(digest, kind, lambda f: shutil.copyfileobj(reader, f, BLOCK_SIZE))
+        return True
+
+    @staticmethod
+    def _copy_checked(reader, out, digest):
+        # Copia el lector en out y comprueba que el contenido tiene el hash indicado
+        sha = hashlib.sha256()
+        for block in iter(lambda: reader.read(BLOCK_SIZE), b''):
+            sha.update(block)
+            out.write(block)
+        if sha.hexdigest() != digest:
+            raise ValueError(f"el contenido {digest} no coincide con su hash")
+
+    def verify(self, digest):
+        # Reconstruye el objeto suelto y lo borra si su contenido no tiene el hash con el que se guardó
+        # (o si le faltan dependencias); ValueError en ese caso
+        try:
+            out = HashWriter()
+            self.write_content(digest, out)
+            valid = out.hexdigest() == digest
+        except Exception:  # Objeto dañado o sin sus dependencias
+            valid = False
+        if not valid:
+            loose = self._loose(digest)
+            if loose:
+                os.remove(loose[1])
+            raise ValueError(f"el contenido {digest} no coincide con su hash")
+
+    @contextmanager
+    def _open_raw(self, digest):
+        # Abre el objeto tal como está guardado: (tipo, lector con read y seek)
+        loose = self._loose(digest)
+        if loose:
+            with open(loose[1], 'rb') as f:
+                yield loose[0], f
+            return
+        pack = self._find_pack(digest)
+        if pack is None:
+            raise FileNotFoundError(errno.ENOENT, "Contenido no encontrado", digest)
+        yield pack.kind(digest), pack.reader(digest)
+
+    def delta_base(self, digest):
+        # (hash de la base, profundidad) si el objeto es un delta, None si está completo
+        with self._open_raw(digest) as (kind, reader):
+            if kind != "delta":
+                return None
+            return Delta.read_header(reader)
+
+    def dependencies(self, digest):
+        # Hashes que necesita un objeto: la base de un delta o los trozos de un archivo troceado
+        with self._open_raw(digest) as (kind, reader):
+            if kind == "delta":
+                return [Delta.read_header(reader)[0]]
+            if kind == "chunks":
+                return [chunk for chunk, size in Chunker.read_manifest(reader)]
+            if kind == "tree":
+                return [entry.get("tree") or entry["hash"] for entry in self._parse_tree(reader.read()).values()]
+        return []
+
+    def with_dependencies(self, digests):
+        # Añade a los hashes todos los objetos de los que dependen, recursivamente
+        result = set(digests)
+        pending = list(result)
+        while pending:
+            digest = pending.pop()
+            try:
+                needed = self.dependencies(digest)
+            except FileNotFoundError:
+                continue
+            for dependency in needed:
+                if dependency not in result:
+                    result.add(dependency)
+                    pending.append(dependency)
+        return result
+
+    def write_content(self, digest, out):
+        # Escribe el contenido completo en out (cualquier objeto con write), por trozos:
+        # los deltas se reconstruyen y los archivos troceados se vuelven a juntar en orden
+        with self._open_raw(digest) as (kind, reader):
+            if kind in ("full", "tree"):
+                shutil.copyfileobj(reader, out, BLOCK_SIZE)
+                return
+            if kind == "chunks":
+                for chunk, size in Chunker.read_manifest(reader):
+                    self.write_content(chunk, out)
+                return
+            if kind == "compressed":
+                Compression.decompress(reader, out)
+                return
+            base, depth = Delta.read_header(reader)
+            with self._open_raw(base) as (base_kind, base_reader):
+                if base_kind == "full":
+                    Delta.apply(reader, base_reader, out)
+                    return
+            # La base también es un delta: reconstruirla en un temporal para poder saltar dentro
+            with tempfile.TemporaryFile(dir=self.objects_dir) as base_file:
+                self.write_content(base, base_file)
+                Delta.apply(reader, base_file, out)
+
+    def _load_packs(self):
+        # Abre los paquetes nuevos y olvida los que ya no existen (por ejemplo, reescritos por otro proceso)
+        with self._packs_lock:
+            paths = set()
+            if os.path.isdir(self.packs_dir):
+                paths = {os.path.join(self.packs_dir, name) for name in os.listdir(self.packs_dir)
+                         if name.endswith(".pack")}
+            for path in list(self._packs):
+                if path not in paths:
+                    del self._packs[path]
+            for path in paths - self._packs.keys():
+                try:
+                    self._packs[path] = PackFile(path)
+                except (OSError, ValueError) as e:
+                    print(f"No se pudo abrir el paquete {path}: {str(e)}")
+
+    def packs(self):
+        with self._packs_lock:
+            return list(self._packs.values())
+
+    def _find_pack(self, digest):
+        # Paquete que contiene el hash; si no aparece se vuelven a leer los paquetes del disco
+        for reload in (False, True):
+            if reload:
+                self._load_packs()
+            for pack in self.packs():
+                if digest in pack.objects:
+                    return pack
+        return None
+
+    def packed_version(self, owner, version_id):
+        # metadata de una versión empaquetada, None si no está en ningún paquete
+        for reload in (False, True):
+            if reload:
+                self._load_packs()
+            for pack in self.packs():
+                if version_id in pack.versions.get(owner, {}):
+                    return pack.versions[owner][version_id]
+        return None
+
+    def write_pack(self, objects, versions):
+        # Guarda un paquete nuevo y lo deja disponible para las lecturas
+        os.makedirs(self.packs_dir, exist_ok=True)
+        path = os.path.join(self.packs_dir, f"paquete-{uuid.uuid4().hex}.pack")
+        PackFile.write(path, objects, versions)
+        self._load_packs()
+        return path
+
+    def remove_pack(self, pack):
+        # Borra un paquete que ya no se necesita (quien llama garantiza que nadie lo está leyendo)
+        with self._packs_lock:
+            self._packs.pop(pack.path, None)
+        pack.close()
+        os.remove(pack.path)
+
+    def put_file(self, path, digest=None, base=None):
+        # Guarda el contenido del archivo si todavía no existe y devuelve su hash
+        # base: hash del contenido anterior del mismo archivo, para guardarlo como delta si compensa
+        if digest is None:
+            digest = self.hash_file(path)
+
+        blob_path = self._path(digest)
+        if self._loose(digest) is None:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            if self.chunk_min_size is not None and os.path.getsize(path) >= max(self.chunk_min_size, 1):
+                self._put_chunks(path, digest)
+                return digest
+            if base and base != digest and self._put_delta(path, digest, base):
+                return digest
+            if self.compression and Compression.worth_compressing(path):
+                with open(path, 'rb') as f:
+                    self._write_object(digest, "compressed",
+                                       lambda out: Compression.compress(f, out, self.compression, self.compression_level))
+                count("compressed_objects")
+                return digest
+            # Escribir en un temporal y renombrar para no dejar blobs a medias
+            tmp_path = f"{blob_path}.{uuid.uuid4().hex}.tmp"
+            try:
+                self._materialize(path, tmp_path)
+                os.replace(tmp_path, blob_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return digest
+
+    def put_tree(self, entries):
+        # Guarda una carpeta de una versión y devuelve su hash
+        # entries: nombre -> {"hash", "size", "mtime_ns"} de un archivo o {"tree", "files", "size"} de una subcarpeta
+        # El hash solo depende del contenido, así las carpetas iguales se guardan una sola vez
+        data = self.TREE_MAGIC + json.dumps(entries, sort_keys=True, separators=(",", ":"),
+                                            ensure_ascii=False).encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        if self._loose(digest) is None:
+            self._write_object(digest, "tree", lambda f: f.write(data))
+        return digest
+
+    def read_tree(self, digest):
+        with self._open_raw(digest) as (kind, reader):
+            return self._parse_tree(reader.read())
+
+    def _parse_tree(self, data):
+        if not data.startswith(self.TREE_MAGIC):
+            raise ValueError("Carpeta de versión dañada")
+        return json.loads(data[len(self.TREE_MAGIC):].decode('utf-8'))
+
+    def _put_chunks(self, path, digest):
+        # Guarda el archivo troceado: los trozos nuevos como objetos y un manifiesto con todos
+        # Si sale un solo trozo se guarda como un objeto normal, sin manifiesto
+        chunks = []
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for start, end in self.chunker.boundaries(data):
+                chunk = data[start:end]
+                if start == 0 and end == len(data):
+                    chunk_digest = digest
+                else:
+                    chunk_digest = hashlib.sha256(chunk).hexdigest()
+                    count("bytes_hashed", len(chunk))
+                chunks.append((chunk_digest, len(chunk)))
+                if self._loose(chunk_digest) is None:
+                    if self.compression and Compression.compresses_well(chunk):
+                        self._write_object(chunk_digest, "compressed", lambda f: Compression.compress(
+                            io.BytesIO(chunk), f, self.compression, self.compression_level))
+                        count("compressed_objects")
+                    else:
+                        self._write_object(chunk_digest, "full", lambda f: f.write(chunk))
+                    count("chunks_stored")
+        if len(chunks) > 1:
+            self._write_object(digest, "chunks", lambda f: Chunker.write_manifest(f, chunks))
+
+    def _write_object(self, digest, kind, writer):
+        # Escribe un objeto suelto con writer(archivo) en un temporal y lo renombra
+        path = self._path(digest) + self.KINDS[kind]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                writer(f)
+                count("bytes_written", f.tell())
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _put_delta(self, path, digest, base):
+        # Intenta guardar el archivo como delta respecto a base; False si no procede o no compensa
+        # La cadena se corta cada delta_max_chain deltas guardando el contenido completo
+        size = os.path.getsize(path)
+        if not self.delta_max_chain or self.delta_min_size is None or size < max(self.delta_min_size, 1):
+            return False
+        try:
+            delta = self.delta_base(base)
+        except FileNotFoundError:
+            return False
+        depth = delta[1] + 1 if delta else 1
+        if depth > self.delta_max_chain:
+            return False
+
+        signature = DeltaSignature(self.delta_block_size)
+        self.write_content(base, signature)
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as target:
+            ops = Delta.encode(target, signature)
+            if ops is None:
+                return False
+            self._write_object(digest, "delta", lambda f: Delta.write(f, base, depth, ops, target))
+        count("delta_objects")
+        return True
+
+    def _materialize(self, src_path, dst_path):
+        # Crea dst con el contenido de src usando el método más barato disponible
+        # Si un método no está soportado se descarta para los siguientes archivos
+        for method in list(self.methods):
+            if method == "copy":
+                fast_copy(src_path, dst_path)
+                return
+            try:
+                if method == "reflink":
+                    self._reflink(src_path, dst_path)
+                else:
+                    # Los blobs nunca se modifican y los archivos de trabajo se reemplazan
+                    # con atomic_copy, así que compartir el inodo es seguro
+                    os.link(src_path, dst_path)
+                count("files_linked")
+                return
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_LINK_ERRORS:
+                    raise
+                if os.path.exists(dst_path):
+                    os.remove(dst_path)
+                with self._methods_lock:
+                    if method in self.methods:
+                        self.methods.remove(method)
+
+    @staticmethod
+    def _reflink(src_path, dst_path):
+        # Clona el archivo con FICLONE (btrfs, XFS...), sin copiar bytes
+        if fcntl is None:
+            raise OSError(errno.ENOSYS, "reflink no disponible en este sistema")
+        with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+    def copy_to(self, digest, dst_path):
+        # Copia el contenido de un blob a la ruta indicada, desde .objetos o desde un paquete
+        # Los blobs sueltos completos se copian en el kernel; el resto se escribe por trozos
+        blob_path = self._path(digest)
+        if os.path.exists(blob_path):
+            atomic_copy(blob_path, dst_path)
+            return
+        tmp_path = os.path.join(os.path.dirname(dst_path), f".{os.path.basename(dst_path)}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp_path, 'wb') as f:
+                self.write_content(digest, f)
+                size = f.tell()
+            os.replace(tmp_path, dst_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        count("files_copied")
+        count("bytes_written", size)
+
+    def iter_objects(self):
+        # Recorre los blobs guardados: (hash, ruta, stat)
+        # Los temporales de escrituras interrumpidas se devuelven con hash None
+        for prefix in os.listdir(self.objects_dir):
+            prefix_dir = os.path.join(self.objects_dir, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+            with os.scandir(prefix_dir) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        name = entry.name
+                        for suffix in self.KINDS.values():
+                            if suffix and name.endswith(suffix):
+                                name = name[:-len(suffix)]
+                        digest = None if name.endswith(".tmp") else prefix + name
+                        yield digest, entry.path, entry.stat()
+
+class Bundle:
+    # Copia de una raíz (completa o incremental) en un único tar que se escribe y se lee en streaming
+    # Miembros, en este orden: indice.json (formato, fechas y versiones incluidas), usuarios.json,
+    # objetos/<tipo>/<hash> (tal como están guardados), versiones/<dueño>/<id>/metadata.json (y los
+    # archivos de las versiones antiguas), carpetas/<usuario>/<temporal|permanente|access>/... y
+    # fin.json con los totales: si falta, el bundle está incompleto
+
+    FORMAT = 1
+    WORK_DIRS = ("temporal", "permanente", "access")
+    COMPRESSIONS = {".gz": "gz", ".tgz": "gz", ".bz2": "bz2", ".xz": "xz"}
+
+    @classmethod
+    def open_write(cls, path, fileobj):
+        # Tar en streaming sobre fileobj, comprimido según la extensión de path (.tar.gz, .tgz, .tar.bz2, .tar.xz)
+        compression = cls.COMPRESSIONS.get(os.path.splitext(path)[1].lower())
+        mode = f"w|{compression}" if compression else "w|"
+        return tarfile.open(mode=mode, fileobj=fileobj, format=tarfile.PAX_FORMAT)
+
+    @staticmethod
+    def open_read(path):
+        return tarfile.open(path, "r|*")
+
+    @staticmethod
+    def add_json(tar, name, data):
+        content = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        Bundle.add_stream(tar, name, len(content), io.BytesIO(content))
+        return len(content)
+
+    @staticmethod
+    def add_stream(tar, name, size, reader, mtime_ns=None):
+        # Añade un miembro copiando size bytes del lector; la fecha se guarda con decimales (PAX)
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mode = 0o644
+        info.mtime = mtime_ns / 10**9 if mtime_ns is not None else time.time()
+        tar.addfile(info, reader)
+        count("bytes_written", size)
+
+class VersionId:
+    # Identificadores de versión ordenables por fecha, con el formato de UUIDv7: 48 bits con los
+    # milisegundos desde 1970, la versión (7) y bits aleatorios. Como texto se ordenan igual que por fecha
+    # Las carpetas de versión se reparten en subcarpetas por día (UTC) sacado del propio identificador
+    # Las versiones antiguas usan uuid4 (sin fecha) y siguen en la carpeta del usuario directamente
+
+    _lock = threading.Lock()
+    _last_ms = 0
+
+    @classmethod
+    def new(cls):
+        # Nuevo identificador; dentro del proceso nunca se repite el milisegundo para mantener el orden
+        with cls._lock:
+            ms = max(time.time_ns() // 10**6, cls._last_ms + 1)
+            cls._last_ms = ms
+        rand = int.from_bytes(os.urandom(10), 'big')
+        value = (ms << 80) | (0x7 << 76) | ((rand >> 62) & 0xFFF) << 64 | (0b10 << 62) | (rand & (2**62 - 1))
+        return str(uuid.UUID(int=value))
+
+    @staticmethod
+    def millis(version_id):
+        # Milisegundos desde 1970 del identificador, None si no es un identificador con fecha
+        try:
+            value = uuid.UUID(version_id)
+        except ValueError:
+            return None
+        return value.int >> 80 if value.version == 7 else None
+
+    @staticmethod
+    def shard(ms):
+        # Subcarpeta del día (UTC) de un instante en milisegundos: AAAA-MM-DD
+        return time.strftime("%Y-%m-%d", time.gmtime(ms // 1000))
+
+    @staticmethod
+    def is_shard(name):
+        return len(name) == 10 and name[4] == name[7] == "-" and name.replace("-", "").isdigit()
+
+class VersionIndex:
+    # Índice de versiones de un usuario en formato JSON-lines, solo se añaden líneas al final
+    # Cada línea resume una versión: id, fecha, autor, origen, número de archivos y bytes
+
+    # Tamaño de bloque al leer el índice desde el final
+    READ_BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def append(self, entry):
+        # Añade una versión al final del índice
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def rewrite(self, entries):
+        # Reescribe el índice completo (de la más antigua a la más reciente)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def latest(self, limit=None, offset=0, since=None, until=None):
+        # Devuelve las versiones más recientes primero, saltando las primeras `offset`
+        # since/until (datetime): solo las versiones de ese intervalo, ambos incluidos
+        # Solo se lee el final del archivo necesario para responder: las líneas van por orden de fecha
+        entries = []
+        if not self.exists():
+            return entries
+
+        skipped = 0
+        for line in self._lines_reversed():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Línea incompleta por una escritura interrumpida
+                continue
+            if since is not None or until is not None:
+                moment = datetime.datetime.fromisoformat(entry["timestamp"])
+                if since is not None and moment < since:
+                    break
+                if until is not None and moment > until:
+                    continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            entries.append(entry)
+            if limit is not None and len(entries) >= limit:
+                break
+        return entries
+
+    def _lines_reversed(self):
+        # Recorre las líneas del archivo desde la última hasta la primera
+        with open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            buffer = b''
+            while position > 0:
+                size = min(self.READ_BLOCK_SIZE, position)
+                position -= size
+                f.seek(position)
+                buffer = f.read(size) + buffer
+                lines = buffer.split(b'\n')
+                buffer = lines.pop(0)
+                for line in reversed(lines):
+                    if line.strip():
+                        yield line.decode('utf-8')
+            if buffer.strip():
+                yield buffer.decode('utf-8')
+
+# Datos de stat guardados en el índice de una carpeta, para los archivos que no hace falta volver a consultar
+CachedStat = namedtuple("CachedStat", ["st_size", "st_mtime_ns", "st_ino"])
+
+class StatCache:
+    # Índice persistente de una carpeta de trabajo: nombre -> [tamaño, mtime_ns, inodo, hash]
+    # Un archivo solo se vuelve a leer si sus datos de stat no coinciden con los guardados
+    # "tracker" indica qué seguimiento de cambios garantiza que el índice está al día (None si ninguno)
+
+    # Los archivos modificados hace menos de esto se guardan sin hash: otro cambio en el mismo
+    # instante dejaría la misma fecha y no se notaría (como los archivos "racily clean" de git)
+    RACY_NS = 2 * 10**9
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            data = None
+        if not isinstance(data, dict) or not isinstance(data.get("files"), dict):
+            return {"tracker": None, "files": {}}
+        return data
+
+    def save(self, data):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def scan(self, directory, changed=None, tracker=None, on_dir=None):
+        # Devuelve nombre -> stat de los archivos de la carpeta y actualiza el índice
+        # changed: nombres que pueden haber cambiado según el seguimiento tracker; el resto se toma del
+        # índice si lo dejó al día ese mismo seguimiento. Con changed None se recorre la carpeta entera
+        # (on_dir como en FileManagementSystem._scan_files)
+        data = self.load()
+        entries = data["files"]
+        if changed is None or tracker is None or data["tracker"] != tracker:
+            stats = FileManagementSystem._scan_files(directory, on_dir)
+        else:
+            stats = {name: CachedStat(*entry[:3]) for name, entry in entries.items() if name not in changed}
+            for name in changed:
+                try:
+                    file_stat = os.stat(os.path.join(directory, name))
+                except FileNotFoundError:
+                    continue
+                if stat.S_ISREG(file_stat.st_mode):
+                    stats[name] = file_stat
+            count("files_stat", len(changed))
+
+        updated = {}
+        for name, file_stat in stats.items():
+            key = [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino]
+            cached = entries.get(name)
+            updated[name] = cached if cached and cached[:3] == key else key + [None]
+        if updated != entries or data["tracker"] != tracker:
+            self.save({"tracker": tracker, "files": updated})
+        return stats
+
+    def hashes(self, directory, stats):
+        # Hash de cada archivo de la carpeta (stats: nombre -> stat), leyendo solo los que cambiaron
+        data = self.load()
+        entries = data["files"]
+        changed = bool(set(entries) - set(stats))
+        racy_limit = time.time_ns() - self.RACY_NS
+        result = {}
+        for name, file_stat in stats.items():
+            key = [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino]
+            cached = entries.get(name)
+            if cached and cached[:3] == key and cached[3]:
+                result[name] = cached[3]
+                continue
+            result[name] = BlobStore.hash_file(os.path.join(directory, name))
+            entry = key + [result[name] if file_stat.st_mtime_ns < racy_limit else None]
+            if entry != cached:
+                entries[name] = entry
+                changed = True
+
+        if changed:
+            for name in set(entries) - set(stats):
+                del entries[name]
+            self.save(data)
+        return result
+
+class TrackerJournal:
+    # Estado persistente del seguimiento de cambios de una carpeta de trabajo, para que sobreviva a un reinicio
+    # {"id": seguimiento que dejó al día su índice de stat, "clean": si ese proceso terminó bien,
+    #  "names": nombres cambiados que no llegó a consultar (None si había que recorrerla entera)}
+    # Mientras un proceso la sigue queda con clean False: si termina sin cerrar, se habrán perdido eventos
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if not isinstance(data, dict) or not isinstance(data.get("id"), str) or data.get("clean") is not True:
+            return None
+        names = data.get("names")
+        return {"id": data["id"], "clean": True, "names": set(names) if isinstance(names, list) else None}
+
+    def save(self, tracker_id, clean, names=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"id": tracker_id, "clean": clean, "names": sorted(names) if names is not None else None},
+                      f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+class ChangeTracker:
+    # Sigue los cambios de las carpetas de trabajo (temporal y access/<dueño>) para no recorrerlas enteras
+    # En Linux usa inotify mediante ctypes, leyendo los eventos al consultar; si no está disponible, cada
+    # consulta recorre la carpeta con stat y apunta los archivos que no coinciden con su índice de stat
+    # (sondeo), sin volver a leer los que no cambiaron. Lo que escribe el propio sistema se apunta con note
+    # Lo pendiente se guarda al cerrar en el TrackerJournal de cada carpeta: tras un cierre limpio, el
+    # siguiente proceso sigue con esos nombres y el mismo id, y el hilo compara una vez la carpeta con su
+    # índice para ver lo que cambió mientras no se seguía. Si se pierden eventos (cierre sin close, cola
+    # desbordada, carpeta borrada o seguida por otro proceso) la siguiente consulta la recorre entera
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_ISDIR = 0x40000000
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+            IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    # wd, mask, cookie y longitud del nombre; le sigue el nombre terminado en ceros
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, journal_for, index_for):
+        # journal_for(carpeta) -> TrackerJournal e index_for(carpeta) -> StatCache de cada carpeta de trabajo
+        self.journal_for = journal_for
+        self.index_for = index_for
+        self.lock = threading.Lock()
+        self.wake = threading.Condition(self.lock)
+        self.fd = None
+        self.watches = {}  # wd -> (carpeta de trabajo, subcarpeta relativa o "")
+        self.dirty = {}  # carpeta -> nombres cambiados desde la última consulta, None si hay que recorrerla
+        # Id de cada carpeta en su índice de stat: otro proceso no conoce sus eventos
+        self.ids = {}
+        self.ready = {}  # carpeta -> Event que se activa al terminar de compararla con su índice
+        self.pending = []  # carpetas por comparar con su índice tras un reinicio
+        self.indexes = {}  # carpeta -> (stat del índice, entradas) de la última comparación
+        self.stopped = False
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):  # Sin inotify (Windows, macOS)
+            fd = -1
+        if fd >= 0:
+            self.libc = libc
+            self.fd = fd
+        self.thread = threading.Thread(target=self._run, name="seguimiento", daemon=True)
+        self.thread.start()
+
+    @property
+    def method(self):
+        return "inotify" if self.fd is not None else "sondeo"
+
+    def _watch(self, directory, names=None, tracker_id=None):
+        # Empieza a seguir la carpeta con los nombres pendientes names (None: la primera consulta la recorre)
+        # Con tracker_id sigue el seguimiento de un proceso anterior y se compara antes con su índice
+        # False si no se puede vigilar (por ejemplo si se alcanzó el límite de inotify del sistema)
+        if self.fd is not None:
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+            if wd < 0:
+                return False
+            self.watches[wd] = (directory, "")
+        self.ids[directory] = tracker_id or f"{os.getpid()}-{uuid.uuid4().hex}"
+        self.dirty[directory] = names
+        self.ready[directory] = threading.Event()
+        if tracker_id:
+            self.pending.append(directory)
+            self.wake.notify()
+        else:
+            self.ready[directory].set()
+        # Mientras este proceso la sigue el estado guardado no vale para otro
+        self.journal_for(directory).save(self.ids[directory], False)
+        return True
+
+    def resume(self, directories):
+        # Sigue las carpetas que un proceso anterior dejó bien cerradas, sin esperar a la primera consulta
+        with self.lock:
+            for directory in directories:
+                if directory in self.dirty or not os.path.isdir(directory):
+                    continue
+                state = self.journal_for(directory).load()
+                if state:
+                    self._watch(directory, state["names"], state["id"])
+
+    def take(self, directory):
+        # Devuelve (id del seguimiento, nombres que cambiaron desde la consulta anterior) y empieza de cero
+        # Sin seguimiento posible devuelve (None, None); nombres None obliga a recorrer la carpeta
+        with self.lock:
+            if directory not in self.dirty and not self._watch(directory):
+                return None, None
+            ready = self.ready[directory]
+        ready.wait()
+        if self.fd is None and self.dirty.get(directory) is not None:
+            # Sin eventos, lo cambiado hasta ahora solo se sabe recorriendo la carpeta
+            self._compare(directory)
+        with self.lock:
+            if self.fd is not None:
+                self._drain()
+            if directory not in self.dirty:
+                # La vigilancia se perdió mientras tanto (carpeta borrada o movida)
+                return None, None
+            names = self.dirty[directory]
+            self.dirty[directory] = set()
+            return self.ids[directory], names
+
+    def note(self, directory, names):
+        # Apunta archivos que el propio sistema acaba de escribir o borrar en una carpeta seguida
+        with self.lock:
+            if self.dirty.get(directory) is not None:
+                self.dirty[directory].update(names)
+
+    def watch_subdir(self, directory, relative):
+        # Vigila una subcarpeta de una carpeta de trabajo (inotify no vigila las subcarpetas)
+        # Si no se puede, la carpeta se vuelve a recorrer entera en cada consulta
+        with self.lock:
+            if directory not in self.dirty or self.fd is None:
+                return
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(os.path.join(directory, relative)), self.MASK)
+            if wd < 0:
+                self.dirty[directory] = None
+            else:
+                self.watches[wd] = (directory, relative)
+
+    def invalidate(self, directory):
+        # Olvida lo sabido de la carpeta (por ejemplo si falló la consulta que usaba sus cambios)
+        with self.lock:
+            if directory in self.dirty:
+                self.dirty[directory] = None
+
+    def _run(self):
+        # Hilo del seguimiento: compara con su índice las carpetas retomadas, sin esperar a que se consulten
+        with self.lock:
+            while not self.stopped:
+                if not self.pending:
+                    self.wake.wait()
+                    continue
+                directory = self.pending.pop(0)
+                self.lock.release()
+                try:
+                    self._compare(directory)
+                finally:
+                    self.lock.acquire()
+
+    def _compare(self, directory):
+        # Recorre la carpeta con stat (vigilando sus subcarpetas) y apunta los archivos que no coinciden
+        # con su índice de stat
+        try:
+            index = self.index_for(directory)
+            # El índice solo se vuelve a leer si cambió desde el recorrido anterior
+            index_stat = os.stat(index.path) if os.path.exists(index.path) else None
+            key = (index_stat.st_mtime_ns, index_stat.st_size, index_stat.st_ino) if index_stat else None
+            if self.indexes.get(directory, (None,))[0] != key or key is None:
+                self.indexes[directory] = (key, index.load()["files"])
+            entries = self.indexes[directory][1]
+            on_dir = (lambda relative: self.watch_subdir(directory, relative)) if self.fd is not None else None
+            current = FileManagementSystem._scan_files(directory, on_dir)
+            changed = set(entries) - set(current)
+            for name, file_stat in current.items():
+                entry = entries.get(name)
+                if not entry or entry[:3] != [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino]:
+                    changed.add(name)
+        except Exception:
+            changed = None
+        with self.lock:
+            if directory in self.dirty:
+                if changed is None:
+                    self.dirty[directory] = None
+                elif self.dirty[directory] is not None:
+                    self.dirty[directory] |= changed
+                self.ready[directory].set()
+
+    def _drain(self):
+        # Lee los eventos pendientes de inotify y apunta los nombres cambiados de cada carpeta
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+                name = data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b"\0")
+                offset += self.EVENT.size + length
+
+                if mask & self.IN_Q_OVERFLOW:
+                    for directory in self.dirty:
+                        self.dirty[directory] = None
+                    continue
+                if wd not in self.watches:
+                    continue
+                directory, relative = self.watches[wd]
+                if mask & self.IN_IGNORED:
+                    del self.watches[wd]
+                    if not relative:
+                        self._forget(directory)
+                    continue
+                if directory not in self.dirty:
+                    continue
+                if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF | self.IN_ISDIR) or not name:
+                    # Subcarpetas creadas, borradas o movidas: hay que recorrerla entera
+                    self.dirty[directory] = None
+                elif self.dirty[directory] is not None:
+                    name = os.fsdecode(name)
+                    self.dirty[directory].add(f"{relative}/{name}" if relative else name)
+
+    def _forget(self, directory):
+        # Deja de seguir una carpeta que ya no se puede vigilar; su estado guardado deja de valer
+        self.dirty.pop(directory, None)
+        self.ids.pop(directory, None)
+        ready = self.ready.pop(directory, None)
+        if ready:
+            ready.set()
+
+    def close(self):
+        # Para el hilo y guarda lo pendiente de cada carpeta, marcando que se cerró bien
+        with self.lock:
+            self.stopped = True
+            self.wake.notify()
+        self.thread.join()
+        with self.lock:
+            if self.fd is not None:
+                self._drain()
+                os.close(self.fd)
+                self.fd = None
+            for directory, names in self.dirty.items():
+                if not self.ready[directory].is_set():
+                    names = None  # No se llegó a comparar con su índice
+                    self.ready[directory].set()
+                try:
+                    self.journal_for(directory).save(self.ids[directory], True, names)
+                except OSError:
+                    pass  # Sin estado guardado, el siguiente proceso la recorre entera
+            self.watches.clear()
+            self.dirty.clear()
+            self.ids.clear()
+            self.ready.clear()
+
+class UserStore:
+    # Usuarios y permisos guardados en SQLite
+    # Cada cambio es una transacción pequeña y atómica, sin reescribir el resto de usuarios
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # La conexión se comparte entre hilos, así que cada operación la usa con este lock
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    username TEXT PRIMARY KEY,
+                    password TEXT NOT NULL,
+                    temporal_dir TEXT NOT NULL,
+                    permanente_dir TEXT NOT NULL
+                )""")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS permissions (
+                    owner TEXT NOT NULL REFERENCES users(username),
+                    grantee TEXT NOT NULL REFERENCES users(username),
+                    permission TEXT NOT NULL,
+                    PRIMARY KEY (owner, grantee)
+                )""")
+            # Índice inverso: a quién ha dado permiso cada dueño se busca por el receptor
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS permissions_by_grantee ON permissions (grantee, owner)")
+        self._data_version = self._read_data_version()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def _read_data_version(self):
+        with self.lock:
+            return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def changed(self):
+        # Indica si otra conexión (por ejemplo otro proceso) ha guardado cambios desde la última consulta
+        version = self._read_data_version()
+        changed = version != self._data_version
+        self._data_version = version
+        return changed
+
+    def is_empty(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0
+
+    def load(self):
+        # Devuelve todos los usuarios con la misma forma que tenía .usuarios.json
+        with self.lock:
+            return self._load()
+
+    def _load(self):
+        users = {}
+        for username, password, temporal_dir, permanente_dir in self.conn.execute(
+                "SELECT username, password, temporal_dir, permanente_dir FROM users"):
+            users[username] = {
+                "password": password,
+                "temporal_dir": temporal_dir,
+                "permanente_dir": permanente_dir,
+                "permissions": {}
+            }
+        for owner, grantee, permission in self.conn.execute(
+                "SELECT owner, grantee, permission FROM permissions"):
+            if owner in users:
+                users[owner]["permissions"][grantee] = permission
+        return users
+
+    def add_users(self, users):
+        # Inserta varios usuarios (nombre -> datos) en una sola transacción
+        count("user_saves")
+        with timed("user_saves"), self.lock, self.conn:
+            for username, data in users.items():
+                self.conn.execute(
+                    "INSERT INTO users (username, password, temporal_dir, permanente_dir) VALUES (?, ?, ?, ?)",
+                    (username, data["password"], data["temporal_dir"], data["permanente_dir"]))
+                for grantee, permission in data.get("permissions", {}).items():
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO permissions (owner, grantee, permission) VALUES (?, ?, ?)",
+                        (username, grantee, permission))
+
+    def load_grants(self):
+        # Devuelve el índice inverso de permisos: receptor -> {dueño: permiso}
+        grants = {}
+        with self.lock:
+            for grantee, owner, permission in self.conn.execute(
+                    "SELECT grantee, owner, permission FROM permissions ORDER BY grantee, owner"):
+                grants.setdefault(grantee, {})[owner] = permission
+        return grants
+
+    def set_permission(self, owner, grantee, permission):
+        count("user_saves")
+        with timed("user_saves"), self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO permissions (owner, grantee, permission) VALUES (?, ?, ?)",
+                (owner, grantee, permission))
+
+    def delete_permission(self, owner, grantee):
+        count("user_saves")
+        with timed("user_saves"), self.lock, self.conn:
+            self.conn.execute("DELETE FROM permissions WHERE owner = ? AND grantee = ?", (owner, grantee))
 
 class FileManagementSystem:
 
     def __init__(self, root_path):
         self.root_path = os.path.abspath(root_path)
-        self.users_file = os.path.join(self.root_path, ".usuarios.json")
+        self.users_file = os.path.join(self.root_path, ".usuarios.db")
+        self.legacy_users_file = os.path.join(self.root_path, ".usuarios.json")
+        self.config_file = os.path.join(self.root_path, ".configuracion.json")
         self.versions_dir = os.path.join(self.root_path, ".versiones")
+        self.objects_dir = os.path.join(self.versions_dir, ".objetos")
         self.users = {}
-        self.current_user = None
+        self.grants = {}  # índice inverso de permisos: receptor -> {dueño: permiso}
+        self.config = dict(DEFAULT_CONFIG)
+        self.sessions = {}  # token -> Session
+
+        # Locks en memoria: usuarios/permisos, sesiones y uno por dueño para su carpeta permanente
+        self._users_lock = threading.RLock()
+        self._sessions_lock = threading.Lock()
+        self._owner_locks = {}
+        self._owner_locks_guard = threading.Lock()
         
         # Crear la estructura inicial si no existe
         self._initialize_system()
@@ -27,103 +1961,276 @@ class FileManagementSystem:
         # Crear directorio de versiones
         if not os.path.exists(self.versions_dir):
             os.makedirs(self.versions_dir)
-        
-        # Cargar información de usuarios si existe
-        if os.path.exists(self.users_file):
+
+        # Cargar la configuración si existe
+        if os.path.exists(self.config_file):
             try:
-                with open(self.users_file, 'r', encoding='utf-8') as f:
-                    self.users = json.load(f)
+                with open(self.config_file, 'r', encoding='utf-8') as f:
+                    self.config.update(json.load(f))
             except json.JSONDecodeError:
-                print("Error al cargar el archivo de usuarios. Creando nuevo archivo.")
-                self.users = {}
-                self._save_users()
-        else:
-            self._save_users()
-    
-    def _save_users(self):
-        # Guarda la información de los usuarios en el archivo .json
-        with open(self.users_file, 'w', encoding='utf-8') as f:
-            json.dump(self.users, f, indent=4)
-    
-    def register_user(self, username, password):
-        # Registra un nuevo usuario
-        if username in self.users:
-            return False, "El nombre de usuario ya existe."
+                print("Error al cargar el archivo de configuración. Usando valores por defecto.")
+
+        # Almacén de contenidos compartido por todas las versiones
+        if self.config["snapshot_backend"] not in BlobStore.BACKENDS:
+            print(f"Backend de versiones '{self.config['snapshot_backend']}' no válido. Usando 'auto'.")
+            self.config["snapshot_backend"] = "auto"
+        if self.config["compression"] is not None and self.config["compression"] not in Compression.available():
+            print(f"Compresión '{self.config['compression']}' no disponible. Se guardará sin comprimir.")
+            self.config["compression"] = None
+        self.blobs = BlobStore(self.objects_dir, self.config["snapshot_backend"],
+                               self.config["delta_min_size"], self.config["delta_max_chain"],
+                               self.config["delta_block_size"], self.config["chunk_min_size"],
+                               self.config["chunk_avg_size"], self.config["compression"],
+                               self.config["compression_level"])
+
+        # Completar la política de retención con los valores por defecto
+        retention = self.config["retention"]
+        valid = isinstance(retention, dict) and all(
+            value is None or (type(value) in ((int, float) if key == "max_age_days" else (int,)) and value >= 0)
+            for key, value in retention.items())
+        if not valid:
+            print("Política de retención no válida. Se conservan todas las versiones.")
+            retention = {}
+        self.config["retention"] = {**DEFAULT_CONFIG["retention"], **retention}
+        self.transfers = TransferEngine(self.config["transfer_workers"])
+        # Seguimiento de cambios de las carpetas de trabajo (None: se recorren enteras en cada operación)
+        self.tracker = ChangeTracker(self._tracker_journal, self._stat_cache) if self.config["change_tracking"] else None
+        metrics_log = self.config["metrics_log"]
+        self.metrics = Metrics(os.path.join(self.root_path, metrics_log) if metrics_log else None)
         
-        # Crear estructura de usuario
-        self.users[username] = {
+        # Cargar información de usuarios
+        self.store = UserStore(self.users_file)
+        if self.store.is_empty() and os.path.exists(self.legacy_users_file):
+            self._migrate_users_json()
+        self.users = self.store.load()
+        self.grants = self.store.load_grants()
+        if self.tracker is not None:
+            self.tracker.resume(self._work_dirs())
+
+    def close(self):
+        # Libera los hilos de copia, el seguimiento de cambios y la base de datos de usuarios; el sistema
+        # no se usa después
+        self.transfers.close()
+        if self.tracker is not None:
+            self.tracker.close()
+        self.store.close()
+
+    def _migrate_users_json(self):
+        # Pasa los usuarios del antiguo .usuarios.json a la base de datos en una sola transacción
+        try:
+            with open(self.legacy_users_file, 'r', encoding='utf-8') as f:
+                users = json.load(f)
+        except json.JSONDecodeError:
+            print("Error al cargar el archivo de usuarios. No se migraron usuarios.")
+            return
+
+        self.store.add_users(users)
+        # Conservar el archivo original como respaldo
+        os.replace(self.legacy_users_file, self.legacy_users_file + ".migrado")
+        print(f"Migrados {len(users)} usuarios de .usuarios.json a .usuarios.db.")
+
+    def _permission(self, owner, user):
+        # Permiso que tiene el usuario sobre la carpeta del dueño, o None
+        return self.grants.get(user, {}).get(owner)
+
+    def _can_write(self, owner, user):
+        return self._permission(owner, user) == "escritura"
+
+    def _refresh_users(self):
+        # Recarga usuarios y permisos si otro proceso cambió la base de datos
+        if self.store.changed():
+            with self._users_lock:
+                self.users = self.store.load()
+                self.grants = self.store.load_grants()
+
+    @contextmanager
+    def _users_write_lock(self):
+        # Exclusión para cambiar usuarios o permisos, entre hilos y entre procesos
+        with self._users_lock, FileLock(os.path.join(self.root_path, ".usuarios.lock")):
+            self._refresh_users()
+            yield
+
+    @contextmanager
+    def _owner_lock(self, owner):
+        # Exclusión sobre la carpeta permanente (y las versiones) de un dueño
+        with self._owner_locks_guard:
+            lock = self._owner_locks.setdefault(owner, threading.Lock())
+        with lock, FileLock(os.path.join(self.root_path, owner, ".permanente.lock")):
+            yield
+
+    @contextmanager
+    def _all_owners_lock(self):
+        # Bloquea todas las carpetas permanentes (en orden, para no bloquearse con otros)
+        # Mientras tanto ningún commit ni recuperación está a medias
+        with ExitStack() as stack:
+            for owner in sorted(list(self.users)):
+                stack.enter_context(self._owner_lock(owner))
+            yield
+
+    def _session_user(self, session):
+        # Devuelve el usuario de una sesión válida, o None
+        if session is None or not session.active or self.sessions.get(session.token) is not session:
+            return None
+        self._refresh_users()
+        return session.username
+
+    def get_session(self, token):
+        # Busca una sesión activa por su token
+        return self.sessions.get(token)
+
+    @staticmethod
+    def _valid_filename(filename):
+        # Un nombre de archivo válido no puede salir de su carpeta
+        return bool(filename) and filename not in (".", "..") and \
+            os.path.basename(filename) == filename and "/" not in filename and "\\" not in filename
+
+    @classmethod
+    def _valid_path(cls, path):
+        # Ruta relativa válida dentro de una carpeta (subcarpetas separadas por "/")
+        return bool(path) and all(cls._valid_filename(part) for part in path.split("/"))
+
+    def _new_user(self, username, password):
+        # Estructura de un usuario nuevo
+        return {
             "password": password,
             "temporal_dir": os.path.join(self.root_path, username, "temporal"),
             "permanente_dir": os.path.join(self.root_path, username, "permanente"),
             "permissions": {}  # permisos a otras carpetas
         }
-        
-        # Crear carpetas del usuario temporal y permanente
-        os.makedirs(self.users[username]["temporal_dir"], exist_ok=True)
-        os.makedirs(self.users[username]["permanente_dir"], exist_ok=True)
-        
-        self._save_users()
+    
+    @instrumented
+    def register_user(self, username, password):
+        # Registra un nuevo usuario
+        with self._users_write_lock():
+            if username in self.users:
+                return False, "El nombre de usuario ya existe."
+            
+            # Crear estructura de usuario
+            user = self._new_user(username, password)
+            
+            # Crear carpetas del usuario temporal y permanente
+            os.makedirs(user["temporal_dir"], exist_ok=True)
+            os.makedirs(user["permanente_dir"], exist_ok=True)
+            
+            try:
+                self.store.add_users({username: user})
+            except sqlite3.Error as e:
+                return False, f"Error al guardar el usuario: {str(e)}"
+
+            self.users[username] = user
         return True, f"Usuario {username} registrado correctamente."
+
+    @instrumented
+    def register_users(self, credentials):
+        # Registra varios usuarios a la vez en una sola transacción
+        # credentials: lista de pares (nombre_usuario, contraseña)
+        new_users = {}
+        skipped = []
+        with self._users_write_lock():
+            for username, password in credentials:
+                if username in self.users or username in new_users:
+                    skipped.append(username)
+                    continue
+                new_users[username] = self._new_user(username, password)
+
+            for user in new_users.values():
+                os.makedirs(user["temporal_dir"], exist_ok=True)
+                os.makedirs(user["permanente_dir"], exist_ok=True)
+
+            try:
+                self.store.add_users(new_users)
+            except sqlite3.Error as e:
+                return False, f"Error al guardar los usuarios: {str(e)}"
+
+            self.users.update(new_users)
+        message = f"{len(new_users)} usuarios registrados correctamente."
+        if skipped:
+            message += f" Ya existían: {', '.join(skipped)}."
+        return True, message
     
+    @instrumented
     def login(self, username, password):
-        # Inicia sesión con un usuario existente
+        # Inicia sesión con un usuario existente y devuelve la sesión creada
+        self._refresh_users()
         if username not in self.users:
             return False, "Usuario no encontrado."
         
         if password != self.users[username]["password"]:
             return False, "Contraseña incorrecta."
         
-        self.current_user = username
-        return True, f"Sesión iniciada como {username}."
+        session = Session(username)
+        with self._sessions_lock:
+            self.sessions[session.token] = session
+        return True, session
     
-    def logout(self):
-        # Cerrar la sesión actual
-        if not self.current_user:
+    @instrumented
+    def logout(self, session):
+        # Cierra la sesión indicada
+        if not self._session_user(session):
             return False, "No hay sesión activa."
         
-        self.current_user = None
+        with self._sessions_lock:
+            self.sessions.pop(session.token, None)
+        session.active = False
         return True, "Sesión cerrada correctamente."
     
-    def grant_permission(self, target_user, permission_type):
+    @instrumented
+    def grant_permission(self, session, target_user, permission_type):
         # Otorga permisos a otro usuario sobre la carpeta del usuario actual "lectura" o "escritura"
-        if not self.current_user:
+        user = self._session_user(session)
+        if not user:
             return False, "Iniciar sesión primero"
         
-        if target_user not in self.users:
-            return False, f"El usuario {target_user} no existe."
-        
-        if target_user == self.current_user:
-            return False, "No puede cambiar sus propios permisos."
-        
-        if permission_type not in ["lectura", "escritura"]:
-            return False, "Tipo de permiso no válido usar 'lectura' o 'escritura'."
-        
-        # Actualizar permisos del usuario objetivo
-        self.users[self.current_user]["permissions"][target_user] = permission_type
+        with self._users_write_lock():
+            if target_user not in self.users:
+                return False, f"El usuario {target_user} no existe."
+            
+            if target_user == user:
+                return False, "No puede cambiar sus propios permisos."
+            
+            if permission_type not in ["lectura", "escritura"]:
+                return False, "Tipo de permiso no válido usar 'lectura' o 'escritura'."
+            
+            # Actualizar permisos del usuario objetivo
+            try:
+                self.store.set_permission(user, target_user, permission_type)
+            except sqlite3.Error as e:
+                return False, f"Error al guardar el permiso: {str(e)}"
+            self.users[user]["permissions"][target_user] = permission_type
+            self.grants.setdefault(target_user, {})[user] = permission_type
         
         # Crear carpeta temporal para este usuario
-        access_temporal_dir = os.path.join(self.root_path, target_user, "access", self.current_user)
+        access_temporal_dir = os.path.join(self.root_path, target_user, "access", user)
         os.makedirs(access_temporal_dir, exist_ok=True)
         
-        self._save_users()
         return True, f"Permiso '{permission_type}' otorgado a {target_user}."
     
-    def revoke_permission(self, target_user):
+    @instrumented
+    def revoke_permission(self, session, target_user):
         # Quita los permisos dados a un usuario
-        if not self.current_user:
+        user = self._session_user(session)
+        if not user:
             return False, "Debe iniciar sesión primero."
         
-        if target_user not in self.users:
-            return False, f"El usuario {target_user} no existe."
-        
-        if target_user not in self.users[self.current_user]["permissions"]:
-            return False, f"{target_user} no tiene permisos sobre su carpeta."
-        
-        # Eliminar permisos
-        del self.users[self.current_user]["permissions"][target_user]
+        with self._users_write_lock():
+            if target_user not in self.users:
+                return False, f"El usuario {target_user} no existe."
+            
+            if target_user not in self.users[user]["permissions"]:
+                return False, f"{target_user} no tiene permisos sobre su carpeta."
+            
+            # Eliminar permisos
+            try:
+                self.store.delete_permission(user, target_user)
+            except sqlite3.Error as e:
+                return False, f"Error al guardar el permiso: {str(e)}"
+            del self.users[user]["permissions"][target_user]
+            self.grants[target_user].pop(user, None)
+            if not self.grants[target_user]:
+                del self.grants[target_user]
         
         # Eliminar carpeta de acceso temporal
-        access_temporal_dir = os.path.join(self.root_path, target_user, "access",self.current_user)
+        access_temporal_dir = os.path.join(self.root_path, target_user, "access",user)
         if os.path.exists(access_temporal_dir):
             shutil.rmtree(access_temporal_dir)
         
@@ -132,50 +2239,52 @@ class FileManagementSystem:
         if os.path.exists(access_dir) and not os.listdir(access_dir):
             os.rmdir(access_dir)
         
-        self._save_users()
         return True, f"Permisos revocados para {target_user}."
     
-    def list_files(self, dir_type="temporal"):
+    @instrumented
+    def list_files(self, session, dir_type="temporal"):
         # Lista los archivos en una carpeta del usuario actual
-        if not self.current_user:
+        user = self._session_user(session)
+        if not user:
             return False, "Debe iniciar sesión primero."
         
         if dir_type not in ["temporal", "permanente"]:
             return False, "Tipo de directorio no válido. Use 'temporal' o 'permanente'."
         
-        directory = self.users[self.current_user][f"{dir_type}_dir"]
-        files = []
+        directory = self.users[user][f"{dir_type}_dir"]
         
         try:
-            for item in os.listdir(directory):
-                item_path = os.path.join(directory, item)
-                if os.path.isfile(item_path):
-                    files.append(item)
+            # Archivos de la carpeta y de sus subcarpetas, con su ruta relativa
+            files = sorted(self._scan_files(directory))
         except Exception as e:
             return False, f"Error al listar archivos: {str(e)}"
         
         return True, files
     
-    def list_accessible_folders(self):
+    @instrumented
+    def list_accessible_folders(self, session):
         # Lista las carpetas a las que el usuario actual tiene acceso
-        if not self.current_user:
+        user = self._session_user(session)
+        if not user:
             return False, "Iniciar sesión primero."
         
-        accessible = []
-        for user, data in self.users.items():
-            if self.current_user in data.get("permissions", {}):
-                perm_type = data["permissions"][self.current_user]
-                accessible.append((user, perm_type))
-
+        with self._users_lock:
+            accessible = list(self.grants.get(user, {}).items())
         return True, accessible
     
-    def create_file(self, filename, content, owner=None):
-        if not self.current_user:
+    @instrumented
+    def create_file(self, session, filename, content, owner=None):
+        user = self._session_user(session)
+        if not user:
             return False, "Iniciar sesión primero."
 
+        # El nombre puede incluir subcarpetas (carpeta/archivo.txt), pero no salir de la carpeta
+        if not self._valid_path(filename):
+            return False, f"Nombre de archivo no válido: '{filename}'."
+
         # Si no se especifica un dueño, crear el archivo en la carpeta temporal del usuario actual
         if not owner:
-            directory = self.users[self.current_user]["temporal_dir"]
+            directory = self.users[user]["temporal_dir"]
             file_path = os.path.join(directory, filename)
         else:
             # Verificar que el owner (otro usuario) existe
@@ -183,12 +2292,11 @@ class FileManagementSystem:
                 return False, f"El usuario '{owner}' no existe."
             
             # Verificar si el usuario actual tiene permisos de escritura para el dueño especificado
-            if self.current_user not in self.users.get(owner, {}).get("permissions", {}) or \
-            self.users[owner]["permissions"][self.current_user] != "escritura":
+            if not self._can_write(owner, user):
                 return False, f"No tienes permisos de escritura sobre los archivos de {owner}."
             
             # Ruta para la carpeta access/owner del usuario actual
-            access_owner_dir = os.path.join(self.root_path, self.current_user, "access", owner)
+            access_owner_dir = os.path.join(self.root_path, user, "access", owner)
 
             if not os.path.exists(access_owner_dir):
                 try:
@@ -196,12 +2304,16 @@ class FileManagementSystem:
                 except Exception as e:
                     return False, f"Error al crear directorio de acceso: {str(e)}"
             
-            file_path = os.path.join(access_owner_dir, filename)
+            directory = access_owner_dir
+            file_path = os.path.join(directory, filename)
 
         # Crear el archivo
         try:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
             with open(file_path, 'w', encoding='utf-8') as f:
                 f.write(content)
+            count("bytes_written", len(content))
+            self._note_changes(directory, [filename])
         except Exception as e:
             return False, f"Error al crear archivo: {str(e)}"
 
@@ -211,22 +2323,112 @@ class FileManagementSystem:
         else:
             return True, f"Archivo '{filename}' creado correctamente en carpeta access/{owner}."
     
-    def modify_file(self, filename, dir_type="temporal", owner=None):
+    @instrumented
+    def import_tree(self, session, source_dir, owner=None):
+        # Copia un árbol de archivos local a la carpeta temporal del usuario, o a access/<dueño>
+        # Los archivos se leen mientras se recorre el origen y se copian en paralelo por tandas de
+        # import_batch_size, sin reunir la lista completa; los que ya existen se reemplazan
+        # Los permisos se comprueban una vez por tanda, así una revocación detiene la importación
+        user = self._session_user(session)
+        if not user:
+            return False, "Debe iniciar sesión primero."
+
+        source_dir = os.path.abspath(source_dir)
+        if not os.path.isdir(source_dir):
+            return False, f"La carpeta '{source_dir}' no existe."
+
+        if not owner:
+            target_dir = self.users[user]["temporal_dir"]
+            lock_owner = user
+        else:
+            if owner not in self.users:
+                return False, f"El usuario '{owner}' no existe."
+            if not self._can_write(owner, user):
+                return False, f"No tienes permisos de escritura sobre los archivos de {owner}."
+            target_dir = os.path.join(self.root_path, user, "access", owner)
+            lock_owner = owner
+        if os.path.commonpath([source_dir, target_dir]) in (source_dir, target_dir):
+            return False, "La carpeta de origen no puede contener ni estar dentro de la carpeta de destino."
+
+        files = 0
+        size = 0
+        skipped = []
+        start = time.perf_counter()
+        try:
+            with timed("import"):
+                for batch in self._import_batches(source_dir, skipped):
+                    if owner and not self._can_write(owner, user):
+                        return False, (f"No tienes permisos de escritura sobre los archivos de {owner} "
+                                       f"(se importaron {files} archivos).")
+                    pairs = [(os.path.join(source_dir, name), os.path.join(target_dir, name)) for name, _ in batch]
+                    with self._owner_lock(lock_owner):
+                        for parent in sorted({os.path.dirname(dst) for src, dst in pairs}):
+                            os.makedirs(parent, exist_ok=True)
+                        self.transfers.copy_many(pairs, clone=True)
+                        self._note_changes(target_dir, [name for name, _ in batch])
+                    files += len(batch)
+                    size += sum(file_size for _, file_size in batch)
+                    count("files_imported", len(batch))
+        except Exception as e:
+            return False, f"Error al importar archivos (se importaron {files} archivos): {str(e)}"
+
+        seconds = time.perf_counter() - start
+        destination = f"access/{owner}" if owner else "temporal"
+        message = (f"Importados {files} archivos ({size} bytes) en carpeta {destination} en {seconds:.2f} s "
+                   f"({files / seconds if seconds else 0:.0f} archivos/s, {size / seconds / 2**20 if seconds else 0:.1f} MB/s).")
+        if skipped:
+            message += f" Se omitieron {len(skipped)} archivos con nombres no válidos: {', '.join(skipped[:5])}"
+            if len(skipped) > 5:
+                message += f" (y {len(skipped) - 5} más)"
+        return True, message
+
+    def _import_batches(self, source_dir, skipped):
+        # Recorre el árbol de origen y devuelve tandas de (ruta relativa, tamaño)
+        # Los nombres que no se pueden guardar se apuntan en skipped
+        batch = []
+        for name, file_stat in self._walk_files(source_dir):
+            if not self._valid_path(name):
+                skipped.append(name)
+                continue
+            batch.append((name, file_stat.st_size))
+            if len(batch) >= self.config["import_batch_size"]:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _walk_files(directory):
+        # Como _scan_files, pero devuelve (ruta relativa, stat) a medida que recorre, sin reunir la lista
+        pending = [""]
+        while pending:
+            relative = pending.pop()
+            with os.scandir(os.path.join(directory, relative) if relative else directory) as entries:
+                for entry in entries:
+                    name = f"{relative}/{entry.name}" if relative else entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(name)
+                    elif entry.is_file():
+                        count("files_stat")
+                        yield name, entry.stat()
+
+    @instrumented
+    def modify_file(self, session, filename, dir_type="temporal", owner=None):
         # Actualiza la fecha de modificación de un archivo existente
-        if not self.current_user:
+        user = self._session_user(session)
+        if not user:
             return False, "Debe iniciar sesión primero."
         
         if dir_type == "temporal":
-            directory = self.users[self.current_user]["temporal_dir"]
+            directory = self.users[user]["temporal_dir"]
         elif dir_type == "access":
             if not owner:
                 return False, "Debe especificar el dueño para modificar archivos en 'access'."
             if owner not in self.users:
                 return False, f"El usuario '{owner}' no existe."
-            if self.current_user not in self.users[owner]["permissions"] or \
-               self.users[owner]["permissions"][self.current_user] != "escritura":
+            if not self._can_write(owner, user):
                 return False, f"No tienes permisos de escritura sobre los archivos de {owner}."
-            directory = os.path.join(self.root_path, self.current_user, "access", owner)
+            directory = os.path.join(self.root_path, user, "access", owner)
         else:
             return False, "Tipo de directorio no válido. Use 'temporal' o 'access'."
         
@@ -239,30 +2441,32 @@ class FileManagementSystem:
             # Actualizar la fecha de modificación del archivo
             current_time = datetime.datetime.now().timestamp()
             os.utime(file_path, (current_time, current_time))
+            self._note_changes(directory, [filename])
         except Exception as e:
             return False, f"Error al actualizar la fecha del archivo: {str(e)}"
         
         return True, f"Archivo '{filename}' modificado correctamente."
     
-    def delete_file(self, filename, dir_type="temporal", owner=None):
+    @instrumented
+    def delete_file(self, session, filename, dir_type="temporal", owner=None):
         # Elimina un archivo
-        if not self.current_user:
+        user = self._session_user(session)
+        if not user:
             return False, "Debe iniciar sesión primero."
         
         if dir_type not in ["temporal", "access"]:
             return False, "Tipo de directorio no válido. Use 'temporal' o 'access'."
         
         if dir_type == "temporal":
-            directory = self.users[self.current_user]["temporal_dir"]
+            directory = self.users[user]["temporal_dir"]
         elif dir_type == "access":
             if not owner:
                 return False, "Debe especificar el dueño para eliminar archivos en 'access'."
             if owner not in self.users:
                 return False, f"El usuario '{owner}' no existe."
-            if self.current_user not in self.users[owner]["permissions"] or \
-               self.users[owner]["permissions"][self.current_user] != "escritura":
+            if not self._can_write(owner, user):
                 return False, f"No tienes permisos de escritura sobre los archivos de {owner}."
-            directory = os.path.join(self.root_path, self.current_user, "access", owner)
+            directory = os.path.join(self.root_path, user, "access", owner)
         
         file_path = os.path.join(directory, filename)
         
@@ -271,308 +2475,1456 @@ class FileManagementSystem:
         
         try:
             os.remove(file_path)
+            self._note_changes(directory, [filename])
         except Exception as e:
             return False, f"Error al eliminar archivo: {str(e)}"
         
         return True, f"Archivo '{filename}' eliminado correctamente."
     
-    def commit(self, owner=None):
-        if not self.current_user:
+    @staticmethod
+    def _scan_files(directory, on_dir=None):
+        # Devuelve los archivos de una carpeta y de sus subcarpetas: ruta relativa (con "/") -> stat
+        # on_dir(ruta relativa) se llama con cada subcarpeta antes de leerla
+        # Las carpetas vacías no cuentan y los enlaces a carpetas no se siguen
+        files = {}
+        pending = [""]
+        while pending:
+            relative = pending.pop()
+            if relative and on_dir:
+                on_dir(relative)
+            try:
+                entries = os.scandir(os.path.join(directory, relative) if relative else directory)
+            except FileNotFoundError:
+                if not relative:
+                    raise
+                continue  # Subcarpeta borrada mientras se recorría
+            with entries:
+                for entry in entries:
+                    name = f"{relative}/{entry.name}" if relative else entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(name)
+                    elif entry.is_file():
+                        files[name] = entry.stat()
+        count("files_stat", len(files))
+        return files
+
+    def _scan_work(self, directory):
+        # Como _scan_files para una carpeta de trabajo: con seguimiento de cambios solo se consultan
+        # los archivos cambiados y el resto sale de su índice de stat
+        # Siempre se llama con el lock del dueño de la carpeta, así que no hay dos consultas a la vez
+        if self.tracker is None:
+            return self._scan_files(directory)
+        tracker_id, changed = self.tracker.take(directory)
+        # Si hay que recorrerla entera se vigila cada subcarpeta antes de leerla
+        on_dir = (lambda relative: self.tracker.watch_subdir(directory, relative)) if tracker_id else None
+        try:
+            return self._stat_cache(directory).scan(directory, changed, tracker_id, on_dir)
+        except Exception:
+            self.tracker.invalidate(directory)
+            raise
+
+    def _diff_dirs(self, src_dir, dst_dir, work_dir=None):
+        # Compara la carpeta origen con la destino por tamaño, fecha y opcionalmente hash
+        # work_dir: cuál de las dos es la carpeta de trabajo (se recorre con _scan_work)
+        # Devuelve las listas de archivos añadidos, modificados y eliminados en el origen, y los archivos
+        # iguales con distinta fecha como (nombre, mtime_ns del origen). No cambia nada en disco
+        src_files = self._scan_work(src_dir) if src_dir == work_dir else self._scan_files(src_dir)
+        dst_files = self._scan_work(dst_dir) if dst_dir == work_dir else self._scan_files(dst_dir)
+        # Dos escrituras en el mismo instante pueden dejar la misma fecha (incluso en archivos distintos):
+        # los archivos iguales en tamaño y fecha cambiados hace muy poco se comparan por contenido
+        racy_limit = time.time_ns() - StatCache.RACY_NS
+
+        added = [name for name in src_files if name not in dst_files]
+        removed = [name for name in dst_files if name not in src_files]
+        modified = []
+        retimed = []
+
+        for name in src_files.keys() & dst_files.keys():
+            src_stat = src_files[name]
+            dst_stat = dst_files[name]
+            if src_stat.st_size != dst_stat.st_size:
+                modified.append(name)
+            elif src_stat.st_mtime_ns != dst_stat.st_mtime_ns:
+                src_path = os.path.join(src_dir, name)
+                dst_path = os.path.join(dst_dir, name)
+                if self.config["verify_hash"] and BlobStore.hash_file(src_path) == BlobStore.hash_file(dst_path):
+                    # Mismo contenido: al aplicar el plan se iguala la fecha para no volver a leerlo
+                    retimed.append((name, src_stat.st_mtime_ns))
+                else:
+                    modified.append(name)
+            elif src_stat.st_mtime_ns >= racy_limit and (BlobStore.hash_file(os.path.join(src_dir, name))
+                                                          != BlobStore.hash_file(os.path.join(dst_dir, name))):
+                modified.append(name)
+
+        return added, modified, removed, retimed
+
+    def _stat_cache(self, directory):
+        # Índice de stat de una carpeta de trabajo, guardado en .versiones/.estado con su ruta relativa
+        relative = os.path.relpath(directory, self.root_path)
+        return StatCache(os.path.join(self.versions_dir, ".estado", relative + ".json"))
+
+    def _tracker_journal(self, directory):
+        # Estado guardado del seguimiento de cambios de una carpeta de trabajo, en .versiones/.seguimiento
+        relative = os.path.relpath(directory, self.root_path)
+        return TrackerJournal(os.path.join(self.versions_dir, ".seguimiento", relative + ".json"))
+
+    def _work_dirs(self):
+        # Carpetas de trabajo de todos los usuarios: temporal y cada access/<dueño>
+        directories = []
+        for username, user in self.users.items():
+            directories.append(user["temporal_dir"])
+            access_dir = os.path.join(self.root_path, username, "access")
+            if os.path.isdir(access_dir):
+                directories.extend(os.path.join(access_dir, owner) for owner in sorted(os.listdir(access_dir)))
+        return directories
+
+    def _note_changes(self, directory, names):
+        # Apunta en el seguimiento de cambios los archivos que acaba de escribir o borrar el sistema
+        if self.tracker is not None:
+            self.tracker.note(directory, names)
+
+    def _content_diff(self, src_dir, dst_dir):
+        # Como _diff_dirs pero comparando contenidos: los hashes salen del índice de stat de cada carpeta
+        src_files = self._scan_work(src_dir)
+        dst_files = self._scan_files(dst_dir)
+        src_hashes = self._stat_cache(src_dir).hashes(src_dir, src_files)
+        common = src_files.keys() & dst_files.keys()
+        dst_hashes = self._stat_cache(dst_dir).hashes(
+            dst_dir, {name: dst_files[name] for name in dst_files if name in common})
+
+        added = sorted(name for name in src_files if name not in dst_files)
+        removed = sorted(name for name in dst_files if name not in src_files)
+        modified = sorted(name for name in common if src_hashes[name] != dst_hashes[name])
+        return added, modified, removed
+
+    def _plan_sync(self, src_dir, dst_dir, work_dir=None):
+        # Calcula una sola vez las copias y borrados necesarios para que dst quede igual que src
+        # retimed: archivos con el mismo contenido a los que solo hay que igualar la fecha
+        added, modified, removed, retimed = self._diff_dirs(src_dir, dst_dir, work_dir)
+        return {
+            "src": src_dir,
+            "dst": dst_dir,
+            "added": sorted(added),
+            "modified": sorted(modified),
+            "removed": sorted(removed),
+            "retimed": retimed
+        }
+
+    @staticmethod
+    def _plan_has_changes(plan):
+        return bool(plan["added"] or plan["modified"] or plan["removed"])
+
+    @staticmethod
+    def _plan_summary(plan):
+        return (f"{len(plan['added'])} añadidos, {len(plan['modified'])} modificados, "
+                f"{len(plan['removed'])} eliminados")
+
+    @staticmethod
+    def _plan_report(plan):
+        # Describe el plan de sincronización, un archivo por línea
+        lines = []
+        lines += [f"  + {name}" for name in plan["added"]]
+        lines += [f"  ~ {name}" for name in plan["modified"]]
+        lines += [f"  - {name}" for name in plan["removed"]]
+        return "\n".join(lines)
+
+    @staticmethod
+    def _align_mtimes(plan):
+        # Iguala la fecha de los archivos del destino que tienen el mismo contenido que el origen
+        for name, mtime_ns in plan["retimed"]:
+            os.utime(os.path.join(plan["dst"], name), ns=(mtime_ns, mtime_ns))
+
+    def _apply_sync(self, plan):
+        # Aplica un plan de sincronización: borra los eliminados y copia los añadidos o modificados
+        self._align_mtimes(plan)
+        for name in plan["removed"]:
+            os.remove(os.path.join(plan["dst"], name))
+        self._prune_dirs(plan["dst"], plan["removed"])
+
+        # Crear antes las subcarpetas de los archivos nuevos, una vez cada una
+        for parent in sorted({os.path.dirname(name) for name in plan["added"]} - {""}):
+            os.makedirs(os.path.join(plan["dst"], parent), exist_ok=True)
+
+        self.transfers.copy_many(
+            (os.path.join(plan["src"], name), os.path.join(plan["dst"], name))
+            for name in plan["added"] + plan["modified"])
+        self._note_changes(plan["dst"], plan["added"] + plan["modified"] + plan["removed"])
+
+    @staticmethod
+    def _prune_dirs(directory, removed):
+        # Quita las subcarpetas que se quedaron vacías al borrar los archivos removed (rutas relativas)
+        parents = set()
+        for name in removed:
+            parent = os.path.dirname(name)
+            while parent:
+                parents.add(parent)
+                parent = os.path.dirname(parent)
+        for parent in sorted(parents, key=lambda path: path.count("/"), reverse=True):
+            try:
+                os.rmdir(os.path.join(directory, parent))
+            except OSError:
+                pass  # No está vacía o ya no existe
+
+    def _create_version(self, owner, source, author):
+        # Crea una versión de la carpeta permanente del dueño
+        # La versión apunta a un objeto "tree" por carpeta que a su vez apunta a los blobs; solo se copian
+        # los contenidos nuevos y las subcarpetas sin cambios desde la versión anterior se reutilizan
+        # sin volver a recorrerlas
+        permanente_dir = self.users[owner]["permanente_dir"]
+
+        previous = None
+        index = self._version_index(owner)
+        latest = index.latest(limit=1)
+        if latest:
+            previous = self._load_version(owner, latest[0]["version_id"])
+
+        # Carpeta raíz de la versión anterior (las versiones de manifiesto plano solo tienen archivos)
+        # y subcarpetas con cambios desde entonces, None si no se sabe cuáles
+        previous_root = {}
+        changed_dirs = None
+        # Solo se reutiliza el hash de un archivo que ya no cambiaba al guardar la versión anterior: otro cambio
+        # en el mismo instante dejaría el mismo tamaño y fecha (como en StatCache)
+        racy_limit = 0
+        if previous:
+            saved_ns = int(datetime.datetime.fromisoformat(previous["timestamp"]).timestamp() * 10**9)
+            racy_limit = saved_ns - StatCache.RACY_NS
+        if previous and "tree" in previous:
+            previous_root = self.blobs.read_tree(previous["tree"])
+            changes = self._load_changes(owner)
+            if changes["base"] == previous["version_id"] and changes["paths"] is not None:
+                changed_dirs = set()
+                for path in changes["paths"]:
+                    parent = os.path.dirname(path)
+                    while parent:
+                        changed_dirs.add(parent)
+                        parent = os.path.dirname(parent)
+        elif previous:
+            previous_root = previous.get("files", {})
+
+        pending = []
+        root = self._snapshot_dir(permanente_dir, "", previous_root, changed_dirs, pending, racy_limit)
+
+        # Guardar en paralelo solo los contenidos que no estaban en la versión anterior
+        # Un archivo que ya estaba en la versión anterior se puede guardar como delta respecto a ella
+        digests = self.transfers.run(
+            lambda item: self.blobs.put_file(os.path.join(permanente_dir, item[2]), base=item[3]), pending)
+        for (node, name, path, base), digest in zip(pending, digests):
+            node[name]["hash"] = digest
+
+        tree, file_count, size = self._store_tree(root)
+
+        version_id = VersionId.new()
+        version_dir = self._version_dir(owner, version_id)
+        os.makedirs(version_dir, exist_ok=True)
+
+        # La fecha sale del identificador para que coincida con el orden de las carpetas
+        version_info = {
+            "version_id": version_id,
+            "timestamp": datetime.datetime.fromtimestamp(VersionId.millis(version_id) / 1000).isoformat(),
+            "user": author,
+            "source": source,
+            "tree": tree,
+            "file_count": file_count,
+            "size": size
+        }
+
+        data = json.dumps(version_info, indent=4)
+        with open(os.path.join(version_dir, "metadata.json"), 'w', encoding='utf-8') as f:
+            f.write(data)
+        count("bytes_written", len(data))
+
+        index.append(self._index_entry(owner, version_info))
+        return version_id
+
+    def _snapshot_dir(self, directory, relative, previous_entries, changed_dirs, pending, racy_limit):
+        # Recorre una carpeta para una versión: nombre -> entrada de archivo, entrada de subcarpeta
+        # reutilizada ({"tree", ...}) o {"node": ...} con una subcarpeta que hay que guardar
+        # Los archivos cuyo contenido hay que guardar se añaden a pending: (nodo, nombre, ruta, hash anterior)
+        node = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                path = f"{relative}/{entry.name}" if relative else entry.name
+                previous = previous_entries.get(entry.name) or {}
+                if entry.is_dir(follow_symlinks=False):
+                    if "tree" in previous and changed_dirs is not None and path not in changed_dirs:
+                        node[entry.name] = previous
+                        continue
+                    child = self._snapshot_dir(
+                        entry.path, path, self.blobs.read_tree(previous["tree"]) if "tree" in previous else {},
+                        changed_dirs, pending, racy_limit)
+                    if child:
+                        node[entry.name] = {"node": child}
+                elif entry.is_file():
+                    stat = entry.stat()
+                    count("files_stat")
+                    node[entry.name] = {"hash": None, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+                    # Reutilizar el hash de la versión anterior si el archivo tiene el mismo tamaño y fecha
+                    # (anterior a racy_limit)
+                    if previous.get("size") == stat.st_size and previous.get("mtime_ns") == stat.st_mtime_ns \
+                            and stat.st_mtime_ns < racy_limit and "hash" in previous:
+                        node[entry.name]["hash"] = previous["hash"]
+                    else:
+                        pending.append((node, entry.name, path, previous.get("hash")))
+        return node
+
+    def _store_tree(self, node):
+        # Guarda una carpeta recorrida por _snapshot_dir y sus subcarpetas nuevas
+        # Devuelve (hash, número de archivos, bytes)
+        entries = {}
+        file_count = 0
+        size = 0
+        for name, entry in node.items():
+            if "node" in entry:
+                digest, child_count, child_size = self._store_tree(entry["node"])
+                entry = {"tree": digest, "files": child_count, "size": child_size}
+            if "tree" in entry:
+                file_count += entry["files"]
+            else:
+                file_count += 1
+            size += entry["size"]
+            entries[name] = entry
+        return self.blobs.put_tree(entries), file_count, size
+
+    def _changes_path(self, owner):
+        return os.path.join(self.versions_dir, owner, ".cambios.json")
+
+    def _load_changes(self, owner):
+        # Rutas de la carpeta permanente cambiadas desde la versión base: {"base", "paths"}
+        # paths None si no se sabe qué cambió (la siguiente versión recorre toda la carpeta)
+        try:
+            with open(self._changes_path(owner), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {"base": None, "paths": None}
+
+    def _save_changes(self, owner, base, paths):
+        # Se guarda antes de tocar la carpeta permanente, así una operación interrumpida nunca
+        # deja cambios sin apuntar
+        path = self._changes_path(owner)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"base": base, "paths": paths}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _stat_paths(directory, names):
+        # (tamaño, mtime_ns) de cada ruta relativa, None si no existe
+        result = {}
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(directory, name))
+                result[name] = (stat.st_size, stat.st_mtime_ns)
+            except FileNotFoundError:
+                result[name] = None
+        count("files_stat", len(names))
+        return result
+
+    def _publish(self, owner, plan, before):
+        # Lleva los cambios de un commit a las carpetas access/<dueño> de todos los usuarios con permiso,
+        # en una sola pasada de copias en paralelo (con reflink si se puede)
+        # Solo se toca la copia de un usuario si sigue igual que la versión anterior de permanente
+        # (mismo tamaño y fecha, o no existe si el archivo es nuevo); si no, es un cambio suyo sin
+        # confirmar y se deja como está. Los usuarios sin carpeta access/<dueño> la tendrán entera con update
+        # Los enlaces duros no se usan: los usuarios editan sus copias en el sitio
+        permanente_dir = self.users[owner]["permanente_dir"]
+        with self._users_lock:
+            grantees = sorted(grantee for grantee, owners in self.grants.items() if owner in owners)
+        after = self._stat_paths(permanente_dir, plan["added"] + plan["modified"])
+        changed = plan["added"] + plan["modified"] + plan["removed"]
+
+        copies = []
+        removals = {}  # carpeta access -> rutas a borrar
+        written = {}  # carpeta access -> rutas copiadas o borradas
+        users = 0
+        conflicts = 0
+        for grantee in grantees:
+            access_dir = os.path.join(self.root_path, grantee, "access", owner)
+            if not os.path.isdir(access_dir):
+                continue
+            users += 1
+            current = self._stat_paths(access_dir, changed)
+            for name in changed:
+                if current[name] == after.get(name):
+                    continue  # Ya está al día
+                if current[name] != before.get(name):
+                    conflicts += 1
+                elif after.get(name) is None:
+                    removals.setdefault(access_dir, []).append(name)
+                    written.setdefault(access_dir, []).append(name)
+                else:
+                    copies.append((os.path.join(permanente_dir, name), os.path.join(access_dir, name)))
+                    written.setdefault(access_dir, []).append(name)
+
+        for access_dir, names in removals.items():
+            for name in names:
+                os.remove(os.path.join(access_dir, name))
+            self._prune_dirs(access_dir, names)
+        for parent in sorted({os.path.dirname(dst) for src, dst in copies}):
+            os.makedirs(parent, exist_ok=True)
+        self.transfers.copy_many(copies, clone=True)
+        for access_dir, names in written.items():
+            self._note_changes(access_dir, names)
+
+        files = len(copies) + sum(len(names) for names in removals.values())
+        count("files_published", files)
+        count("publish_conflicts", conflicts)
+        return {"users": users, "files": files, "conflicts": conflicts}
+
+    def _version_dir(self, owner, version_id):
+        # Carpeta de una versión: en la subcarpeta de su día si el identificador tiene fecha,
+        # directamente en la carpeta del usuario si es un identificador antiguo (uuid4)
+        ms = VersionId.millis(version_id)
+        if ms is None:
+            return os.path.join(self.versions_dir, owner, version_id)
+        return os.path.join(self.versions_dir, owner, VersionId.shard(ms), version_id)
+
+    def _version_dirs(self, owner):
+        # Recorre las carpetas de versión del usuario: (id, carpeta), las de cada día en orden de fecha
+        user_versions_dir = os.path.join(self.versions_dir, owner)
+        if not os.path.isdir(user_versions_dir):
+            return
+        for name in sorted(os.listdir(user_versions_dir)):
+            path = os.path.join(user_versions_dir, name)
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            if not VersionId.is_shard(name):
+                yield name, path
+                continue
+            for version_id in sorted(os.listdir(path)):
+                yield version_id, os.path.join(path, version_id)
+
+    def _remove_version_dir(self, owner, version_id):
+        # Borra la carpeta de una versión y la de su día si se queda vacía
+        version_dir = self._version_dir(owner, version_id)
+        shutil.rmtree(version_dir, ignore_errors=True)
+        parent = os.path.dirname(version_dir)
+        if VersionId.is_shard(os.path.basename(parent)):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                pass
+
+    def _version_index(self, owner):
+        # Devuelve el índice de versiones del usuario, creándolo a partir de las carpetas si falta
+        index = VersionIndex(os.path.join(self.versions_dir, owner, ".indice.jsonl"))
+        if not index.exists() and os.path.exists(os.path.join(self.versions_dir, owner)):
+            self._rebuild_version_index(owner)
+        return index
+
+    def _index_entry(self, owner, metadata):
+        # Resumen de una versión tal como se guarda en el índice
+        if "tree" in metadata:
+            file_count, size = metadata["file_count"], metadata["size"]
+        else:
+            files = self._version_files(owner, metadata)
+            file_count = len(files)
+            size = 0
+            for entry in files.values():
+                size += entry["size"] if "size" in entry else os.path.getsize(entry["path"])
+        return {
+            "version_id": metadata["version_id"],
+            "timestamp": metadata["timestamp"],
+            "user": metadata.get("user"),
+            "source": metadata.get("source"),
+            "file_count": file_count,
+            "size": size
+        }
+
+    def _rebuild_version_index(self, owner):
+        # Regenera el índice leyendo el metadata.json de cada carpeta de versión
+        # y los metadatos de sus versiones empaquetadas
+        user_versions_dir = os.path.join(self.versions_dir, owner)
+        entries = []
+        found = set()
+        for version_id, _ in self._version_dirs(owner):
+            metadata = self._load_version(owner, version_id)
+            if metadata:
+                entries.append(self._index_entry(owner, metadata))
+                found.add(version_id)
+        for pack in self.blobs.packs():
+            for version_id, metadata in pack.versions.get(owner, {}).items():
+                if version_id not in found:
+                    entries.append(self._index_entry(owner, metadata))
+                    found.add(version_id)
+
+        entries.sort(key=lambda x: x["timestamp"])
+        VersionIndex(os.path.join(user_versions_dir, ".indice.jsonl")).rewrite(entries)
+        return len(entries)
+
+    def _load_version(self, owner, version_id):
+        # Lee el metadata.json de una versión, None si no existe
+        # Las versiones empaquetadas ya no tienen carpeta y se buscan en los paquetes
+        metadata_path = os.path.join(self._version_dir(owner, version_id), "metadata.json")
+        if not os.path.exists(metadata_path):
+            return self.blobs.packed_version(owner, version_id)
+        with open(metadata_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _version_files(self, owner, version):
+        # Devuelve los archivos de una versión: ruta relativa -> entrada del manifiesto
+        # Las versiones con carpetas ("tree") se recorren entera; las de manifiesto plano solo tienen
+        # archivos de primer nivel y las antiguas (sin manifiesto) los guardan dentro de su carpeta
+        if "tree" in version:
+            files = {}
+            pending = [("", version["tree"])]
+            while pending:
+                relative, digest = pending.pop()
+                for name, entry in self.blobs.read_tree(digest).items():
+                    path = f"{relative}/{name}" if relative else name
+                    if "tree" in entry:
+                        pending.append((path, entry["tree"]))
+                    else:
+                        files[path] = entry
+            return files
+        if "files" in version:
+            return version["files"]
+
+        version_dir = self._version_dir(owner, version["version_id"])
+        files = {}
+        for item in os.listdir(version_dir):
+            item_path = os.path.join(version_dir, item)
+            if os.path.isfile(item_path) and item != "metadata.json":
+                files[item] = {"path": item_path}
+        return files
+
+    def _version_entry(self, owner, version, path):
+        # Entrada de un archivo de una versión por su ruta relativa, leyendo solo las carpetas del camino
+        if "tree" not in version:
+            return self._version_files(owner, version).get(path)
+        entries = self.blobs.read_tree(version["tree"])
+        parts = path.split("/")
+        for part in parts[:-1]:
+            entry = entries.get(part)
+            if not entry or "tree" not in entry:
+                return None
+            entries = self.blobs.read_tree(entry["tree"])
+        entry = entries.get(parts[-1])
+        return entry if entry and "tree" not in entry else None
+
+    @staticmethod
+    def _version_refs(version):
+        # Objetos a los que apunta directamente una versión (su carpeta raíz o los blobs del manifiesto)
+        if "tree" in version:
+            return [version["tree"]]
+        return [entry["hash"] for entry in version.get("files", {}).values()]
+
+    def _restore_file(self, entry, dst_path):
+        # Copia un archivo de una versión a su destino conservando la fecha de modificación
+        if "hash" in entry:
+            self.blobs.copy_to(entry["hash"], dst_path)
+            os.utime(dst_path, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+        else:
+            atomic_copy(entry["path"], dst_path)
+
+    @instrumented
+    def commit(self, session, owner=None):
+        user = self._session_user(session)
+        if not user:
             return False, "Debe iniciar sesión primero."
         
         # Modo: commit <dueño>
         if owner:
             # Carpeta access específica del usuario actual hacia el dueño indicado
-            access_path = os.path.join(self.root_path, self.current_user, "access", owner)
+            access_path = os.path.join(self.root_path, user, "access", owner)
             if not os.path.exists(access_path):
                 return False, f"No hay carpeta de acceso para el usuario '{owner}'."
             
             # Verificar si el usuario actual tiene permisos de escritura sobre el dueño
-            if self.current_user not in self.users.get(owner, {}).get("permissions", {}) or \
-               self.users[owner]["permissions"][self.current_user] != "escritura":
+            if not self._can_write(owner, user):
                 return False, f"No tienes permisos de escritura sobre los archivos de {owner}."
             
-            # Obtener carpeta permanente del dueño
-            owner_info = self.users.get(owner)
-            if not owner_info:
+            # Verificar que el dueño sigue existiendo
+            if owner not in self.users:
                 return False, f"No se encontró información del usuario '{owner}'."
             
-            permanente_dir = owner_info["permanente_dir"]
+            success, result = self._commit_into(owner, access_path, "access", user)
+            if not success:
+                return False, result
+            if result is None:
+                return True, "No hay cambios para confirmar."
+
+            return True, f"Commit realizado para la carpeta permanente de '{owner}'.{self._publish_summary(result)}"
+
+        # Modo: commit (sin argumentos) pasar temporal propio a permanente
+        else:
+            temporal_dir = self.users[user]["temporal_dir"]
+
+            success, result = self._commit_into(user, temporal_dir, "temporal", user)
+            if not success:
+                return False, result
+            if result is None:
+                return True, "No hay cambios para confirmar."
+        
+            return True, (f"Commit completo realizado correctamente ({self._plan_summary(result)})."
+                          f"{self._publish_summary(result)}")
+
+    @staticmethod
+    def _publish_summary(plan):
+        # Texto que se añade al mensaje del commit cuando se publica en las carpetas access
+        published = plan.get("published")
+        if not published:
+            return ""
+        if "error" in published:
+            return f" Error al publicar en las carpetas de acceso: {published['error']}"
+        text = f" Publicado en {published['users']} carpetas de acceso ({published['files']} archivos"
+        if published["conflicts"]:
+            text += f", {published['conflicts']} sin tocar por tener cambios sin confirmar"
+        return text + ")."
+
+    def _commit_into(self, owner, src_dir, source, author):
+        # Pasa los cambios de src_dir a la carpeta permanente del dueño, creando antes una versión
+        # Devuelve (True, plan aplicado), (True, None) si no había cambios o (False, mensaje de error)
+        permanente_dir = self.users[owner]["permanente_dir"]
+
+        with self._owner_lock(owner):
+            # Detectar cambios entre la carpeta de trabajo y permanente
+            try:
+                with timed("scan"):
+                    plan = self._plan_sync(src_dir, permanente_dir, work_dir=src_dir)
+            except Exception as e:
+                return False, f"Error al comparar archivos: {str(e)}"
+
+            if not self._plan_has_changes(plan):
+                try:
+                    self._align_mtimes(plan)
+                except OSError as e:
+                    return False, f"Error al sincronizar archivos: {str(e)}"
+                return True, None
+
+            # Crear una versión de la carpeta permanente antes de cambiarla
+            version_id = None
+            if os.path.exists(permanente_dir) and os.listdir(permanente_dir):
+                try:
+                    with timed("snapshot"):
+                        version_id = self._create_version(owner, source, author)
+                except Exception as e:
+                    return False, f"Error al crear la versión: {str(e)}"
+
+            # Datos de stat de los archivos que van a cambiar, para publicar solo sobre copias sin tocar
+            if self.config["publish_on_commit"]:
+                before = self._stat_paths(permanente_dir, plan["modified"] + plan["removed"])
+
+            # Pasar a permanente solo los archivos añadidos o modificados y quitar los eliminados
+            # apuntando antes qué rutas cambian respecto a la versión recién creada
+            try:
+                self._save_changes(owner, version_id, plan["added"] + plan["modified"] + plan["removed"])
+                with timed("sync"):
+                    self._apply_sync(plan)
+            except Exception as e:
+                return False, f"Error al sincronizar archivos: {str(e)}"
+
+            # El commit ya está hecho: un fallo al publicar solo se informa
+            if self.config["publish_on_commit"]:
+                try:
+                    with timed("publish"):
+                        plan["published"] = self._publish(owner, plan, before)
+                except Exception as e:
+                    plan["published"] = {"error": str(e)}
+
+        return True, plan
+
+    @instrumented
+    def update(self, session, target_user=None, dry_run=False):
+        #update o update <nombre_usuario>
+        # dry_run: solo informa de las copias y borrados que se harían
+        user = self._session_user(session)
+        if not user:
+            return False, "Debe iniciar sesión primero."
+
+        # actualizar access/usuario
+        if target_user:
+            if target_user not in self.users:
+                return False, f"El usuario '{target_user}' no existe."
+
+            if not self._permission(target_user, user):
+                return False, f"No tiene permisos para acceder a los archivos de {target_user}."
+
+            access_temporal_dir = os.path.join(self.root_path, user, "access", target_user)
+            os.makedirs(access_temporal_dir, exist_ok=True)
+
+            src_owner = target_user
+            dst_dir = access_temporal_dir
+            done_message = f"Archivos de {target_user} actualizados correctamente"
+
+        # actualizar la carpeta temporal propia
+        else:
+            src_owner = user
+            dst_dir = self.users[user]["temporal_dir"]
+            done_message = "Update realizado correctamente"
+
+        # Leer la carpeta permanente sin que un commit la cambie a mitad
+        with self._owner_lock(src_owner):
+            try:
+                with timed("scan"):
+                    plan = self._plan_sync(self.users[src_owner]["permanente_dir"], dst_dir, work_dir=dst_dir)
+            except Exception as e:
+                return False, f"Error al comparar archivos: {str(e)}"
+
+            if dry_run:
+                if not self._plan_has_changes(plan):
+                    return True, "Simulación: no hay cambios que aplicar."
+                return True, f"Simulación ({self._plan_summary(plan)}):\n{self._plan_report(plan)}"
+
+            try:
+                with timed("sync"):
+                    self._apply_sync(plan)
+            except Exception as e:
+                return False, f"Error al sincronizar archivos: {str(e)}"
+
+        return True, f"{done_message} ({self._plan_summary(plan)})."
+ 
+    @instrumented
+    def status(self, session, owner=None):
+        # Cambios de la carpeta de trabajo respecto a la permanente, sin hacer commit
+        # status() compara temporal; status(dueño) compara access/<dueño> con la permanente del dueño
+        # Devuelve {"added": [...], "modified": [...], "removed": [...]}
+        user = self._session_user(session)
+        if not user:
+            return False, "Debe iniciar sesión primero."
+
+        if owner:
+            if owner not in self.users:
+                return False, f"El usuario '{owner}' no existe."
+            if not self._permission(owner, user):
+                return False, f"No tiene permisos para acceder a los archivos de {owner}."
+            work_dir = os.path.join(self.root_path, user, "access", owner)
+            if not os.path.exists(work_dir):
+                return False, f"No hay carpeta de acceso para el usuario '{owner}'."
+        else:
+            owner = user
+            work_dir = self.users[user]["temporal_dir"]
+
+        with self._owner_lock(owner):
+            try:
+                with timed("scan"):
+                    added, modified, removed = self._content_diff(work_dir, self.users[owner]["permanente_dir"])
+            except Exception as e:
+                return False, f"Error al comparar archivos: {str(e)}"
+
+        return True, {"added": added, "modified": modified, "removed": removed}
+
+    @instrumented
+    def list_versions(self, session, limit=None, offset=0, since=None, until=None):
+        # Lista las versiones disponibles para el usuario actual, más reciente primero
+        # limit y offset permiten paginar o pedir solo las últimas N versiones
+        # since/until: fechas ISO (AAAA-MM-DD o con hora) para listar solo un intervalo, ambas incluidas
+        user = self._session_user(session)
+        if not user:
+            return False, "Debe iniciar sesión primero."
+
+        try:
+            since = self._parse_moment(since)
+            until = self._parse_moment(until, end_of_day=True)
+        except ValueError:
+            return False, "Fecha no válida (use AAAA-MM-DD o AAAA-MM-DDTHH:MM:SS)."
+
+        try:
+            versions = self._version_index(user).latest(limit, offset, since, until)
+        except Exception as e:
+            return False, f"Error al listar versiones: {str(e)}"
+        
+        return True, versions
+
+    @staticmethod
+    def _parse_moment(text, end_of_day=False):
+        # Convierte una fecha ISO en datetime; una fecha sin hora es el principio del día,
+        # o el final con end_of_day. None se deja igual
+        if text is None:
+            return None
+        moment = datetime.datetime.fromisoformat(text)
+        if end_of_day and len(text) == 10:
+            moment += datetime.timedelta(days=1, microseconds=-1)
+        return moment
+
+    @instrumented
+    def rebuild_version_index(self, session):
+        # Regenera el índice de versiones del usuario actual desde las carpetas de versiones
+        user = self._session_user(session)
+        if not user:
+            return False, "Debe iniciar sesión primero."
+
+        try:
+            with self._owner_lock(user):
+                total = self._rebuild_version_index(user)
+        except Exception as e:
+            return False, f"Error al reconstruir el índice: {str(e)}"
+
+        return True, f"Índice de versiones reconstruido ({total} versiones)."
+
+    @instrumented
+    def gc(self, session, dry_run=False):
+        # Borra las versiones del usuario que no cumplen la política de retención
+        # y los contenidos de .objetos que ya no usa ninguna versión de ningún usuario
+        # dry_run: solo informa de lo que se borraría y de los bytes que se liberarían
+        user = self._session_user(session)
+        if not user:
+            return False, "Debe iniciar sesión primero."
+
+        # Los blobs creados después de empezar pueden ser de un commit que todavía no guardó su versión
+        start_ns = time.time_ns()
+        try:
+            with self._all_owners_lock():
+                index = self._version_index(user)
+                entries = index.latest()
+                expired = self._expired_versions(entries)
+                expired_ids = {entry["version_id"] for entry in expired}
+
+                # Versiones antiguas que guardan sus archivos dentro de su carpeta
+                freed = 0
+                for entry in expired:
+                    version_dir = self._version_dir(user, entry["version_id"])
+                    if os.path.isdir(version_dir):
+                        with os.scandir(version_dir) as items:
+                            freed += sum(item.stat().st_size for item in items if item.is_file())
+
+                # Contenidos que no usa ninguna de las versiones que se conservan
+                # (se cuentan como usados los archivos de sus carpetas, las bases de sus deltas
+                # y los trozos de sus archivos troceados)
+                referenced = self.blobs.with_dependencies(self._referenced_blobs(user, expired_ids))
+                unused = []
+                unused_count = 0
+                for digest, path, file_stat in self.blobs.iter_objects():
+                    if digest in referenced or file_stat.st_ctime_ns >= start_ns:
+                        continue
+                    unused.append(path)
+                    # Un blob que comparte inodo con un archivo de trabajo no libera espacio
+                    if file_stat.st_nlink <= 1:
+                        freed += file_stat.st_size
+
+                # Paquetes con versiones caducadas o contenidos sin uso: se reescriben sin ellos
+                repacks = []
+                for pack in self.blobs.packs():
+                    drop_versions = expired_ids & pack.versions.get(user, {}).keys()
+                    drop_objects = {digest for digest in pack.objects if digest not in referenced}
+                    if drop_versions or drop_objects:
+                        repacks.append((pack, drop_versions, drop_objects))
+                        unused_count += len(drop_objects)
+                        freed += sum(pack.size(digest) for digest in drop_objects)
+
+                summary = f"{len(expired)} versiones y {len(unused) + unused_count} contenidos sin uso, {freed} bytes"
+                if dry_run:
+                    return True, f"Simulación: se borrarían {summary}."
+
+                # Quitar primero las versiones del índice para que nunca se listen a medias
+                if expired:
+                    index.rewrite([entry for entry in reversed(entries) if entry["version_id"] not in expired_ids])
+                    for entry in expired:
+                        self._remove_version_dir(user, entry["version_id"])
+                for path in unused:
+                    os.remove(path)
+                for pack, drop_versions, drop_objects in repacks:
+                    self._rewrite_pack(pack, {user: drop_versions}, drop_objects)
+        except Exception as e:
+            return False, f"Error al limpiar versiones: {str(e)}"
+
+        return True, f"Limpieza completada: se borraron {summary}."
+
+    @instrumented
+    def pack_versions(self, session, dry_run=False):
+        # Empaqueta las versiones frías del usuario: sus metadatos y los contenidos que solo usan ellas
+        # pasan a un único archivo de paquete, y se borran sus carpetas y los blobs sueltos
+        # Son frías las que no están entre las pack_keep_recent más recientes y tienen al menos pack_min_age_days días
+        user = self._session_user(session)
+        if not user:
+            return False, "Debe iniciar sesión primero."
+
+        try:
+            with self._all_owners_lock():
+                cutoff = datetime.datetime.now() - datetime.timedelta(days=self.config["pack_min_age_days"])
+                entries = self._version_index(user).latest()
+                cold = [entry for entry in entries[max(1, self.config["pack_keep_recent"]):]
+                        if datetime.datetime.fromisoformat(entry["timestamp"]) <= cutoff
+                        and os.path.isdir(self._version_dir(user, entry["version_id"]))]
+                if not cold:
+                    return True, "No hay versiones frías para empaquetar."
+                cold_ids = {entry["version_id"] for entry in cold}
+
+                # Los contenidos que usa alguna versión sin empaquetar se quedan sueltos
+                # (con sus carpetas, las bases de sus deltas y los trozos de sus archivos troceados)
+                hot = self.blobs.with_dependencies(self._referenced_blobs(user, cold_ids, include_packed=False))
+
+                versions = {}
+                inline = {}  # hash -> archivo dentro de una versión antigua
+                removed_files = 0
+                for entry in cold:
+                    version = self._load_version(user, entry["version_id"])
+                    removed_files += 2  # carpeta y metadata.json
+                    if "files" not in version and "tree" not in version:
+                        # Versión antigua: sus archivos pasan a ser contenidos del paquete
+                        files = {}
+                        for name, item in self._version_files(user, version).items():
+                            stat = os.stat(item["path"])
+                            digest = BlobStore.hash_file(item["path"])
+                            files[name] = {"hash": digest, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+                            inline.setdefault(digest, item["path"])
+                            removed_files += 1
+                        version = dict(version, files=files)
+                    versions[entry["version_id"]] = version
+
+                objects = {}
+                moved = []
+                cold_digests = self.blobs.with_dependencies(
+                    digest for version in versions.values() for digest in self._version_refs(version))
+                for digest in sorted(cold_digests):
+                    if digest in hot or digest in objects:
+                        continue
+                    loose = self.blobs.loose_path(digest)
+                    if loose:
+                        objects[digest] = loose
+                        moved.append(loose[0])
+                    elif digest in inline and not self.blobs.exists(digest):
+                        objects[digest] = (inline[digest], "full")
+                removed_files += len(moved)
+
+                summary = f"{len(cold)} versiones y {len(objects)} contenidos"
+                if dry_run:
+                    return True, f"Simulación: se empaquetarían {summary} ({removed_files} archivos menos)."
+
+                self.blobs.write_pack(objects, {user: versions})
+
+                # Con el paquete ya guardado se pueden borrar las carpetas y los blobs sueltos
+                for entry in cold:
+                    self._remove_version_dir(user, entry["version_id"])
+                for path in moved:
+                    os.remove(path)
+        except Exception as e:
+            return False, f"Error al empaquetar versiones: {str(e)}"
+
+        return True, f"Empaquetadas {summary} ({removed_files} archivos menos)."
+
+    @instrumented
+    def export_bundle(self, session, path, since=None):
+        # Exporta a un bundle el usuario de la sesión: su historial de versiones, temporal, permanente y las
+        # carpetas access/<dueño> de los dueños que le siguen dando permiso. No incluye a otros usuarios
+        user = self._session_user(session)
+        if not user:
+            return False, "Debe iniciar sesión primero."
+        return self._export_bundle(path, since, user)
+
+    @instrumented
+    def export_root(self, path, since=None):
+        # Exporta toda la raíz (todos los usuarios con sus contraseñas, permisos, carpetas e historiales)
+        # Es una operación de administración (--exportar): no se ofrece a las sesiones
+        return self._export_bundle(path, since)
+
+    def _export_bundle(self, path, since=None, user=None):
+        # Exporta usuarios, permisos, carpetas de trabajo e historial de versiones a un bundle (ver Bundle),
+        # de toda la raíz o solo de user
+        # since: fecha ISO para un bundle incremental, con las versiones desde esa fecha, los contenidos que
+        # no usa ninguna versión anterior y los archivos de trabajo modificados desde entonces
+        # Se escribe en streaming: en memoria solo hay metadatos, nunca contenidos
+        try:
+            since_moment = self._parse_moment(since)
+        except ValueError:
+            return False, "Fecha no válida (use AAAA-MM-DD o AAAA-MM-DDTHH:MM:SS)."
+        since_ns = int(since_moment.timestamp() * 10**9) if since_moment else None
+
+        path = os.path.abspath(path)
+        if os.path.commonpath([path, self.root_path]) == self.root_path:
+            return False, "El bundle no puede guardarse dentro de la raíz."
+
+        totals = {"versiones": 0, "objetos": 0, "archivos": 0, "bytes": 0}
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            # Con todas las carpetas permanentes bloqueadas ningún commit, gc ni empaquetado cambia el historial
+            with self._all_owners_lock():
+                exported_at = datetime.datetime.now()
+                with self._users_lock:
+                    users = self.store.load()
+                    grants = self.store.load_grants()
+                if user:
+                    users = {user: users[user]}
+
+                # Versiones que entran en el bundle y contenidos que necesitan
+                versions = {}
+                exported_refs = set()
+                older_refs = set()
+                for owner in sorted(users):
+                    for entry in reversed(self._version_index(owner).latest()):
+                        metadata = self._load_version(owner, entry["version_id"])
+                        if metadata is None:
+                            continue
+                        if since_moment is None or datetime.datetime.fromisoformat(entry["timestamp"]) >= since_moment:
+                            versions.setdefault(owner, []).append(entry["version_id"])
+                            exported_refs.update(self._version_refs(metadata))
+                        else:
+                            older_refs.update(self._version_refs(metadata))
+                objects = self.blobs.with_dependencies(exported_refs)
+                if older_refs:
+                    objects -= self.blobs.with_dependencies(older_refs)
 
-            # Crear una versión de la carpeta permanente del dueño
-            if os.path.exists(permanente_dir) and os.listdir(permanente_dir):
-                version_id = str(uuid.uuid4())
-                version_dir = os.path.join(self.versions_dir, owner, version_id)
-                os.makedirs(version_dir, exist_ok=True)
-                
-                version_info = {
-                    "version_id": version_id,
-                    "timestamp": datetime.datetime.now().isoformat(),
-                    "user": self.current_user,
-                    "source": "access"
-                }
-                
-                with open(os.path.join(version_dir, "metadata.json"), 'w', encoding='utf-8') as f:
-                    json.dump(version_info, f, indent=4)
-                
-                for item in os.listdir(permanente_dir):
-                    item_path = os.path.join(permanente_dir, item)
-                    if os.path.isfile(item_path):
-                        shutil.copy2(item_path, version_dir)
+                with open(tmp_path, 'wb') as f, Bundle.open_write(path, f) as tar:
+                    Bundle.add_json(tar, "indice.json", {
+                        "formato": Bundle.FORMAT,
+                        "fecha": exported_at.isoformat(),
+                        "desde": since_moment.isoformat() if since_moment else None,
+                        "versiones": versions,
+                        "objetos": len(objects)
+                    })
+                    Bundle.add_json(tar, "usuarios.json", {
+                        name: {"password": data["password"], "permissions": data["permissions"]}
+                        for name, data in users.items()})
 
-            try:
-                # Sincronizar archivos: eliminar los que no están en access y actualizar los existentes
-                access_files = set(os.listdir(access_path))
-                permanente_files = set(os.listdir(permanente_dir))
-
-                # Eliminar archivos que ya no están en access
-                for file in permanente_files - access_files:
-                    file_path = os.path.join(permanente_dir, file)
-                    if os.path.isfile(file_path):
-                        os.remove(file_path)
-
-                # Copiar o actualizar archivos desde access a permanente
-                for file in access_files:
-                    src_path = os.path.join(access_path, file)
-                    dst_path = os.path.join(permanente_dir, file)
-                    shutil.copy2(src_path, dst_path)
+                    # Primero los contenidos, luego las versiones que los usan: al importar nunca hay
+                    # una versión sin sus contenidos
+                    for digest in sorted(objects):
+                        with self.blobs.open_stored(digest) as (kind, size, reader):
+                            Bundle.add_stream(tar, f"objetos/{kind}/{digest}", size, reader)
+                        totals["objetos"] += 1
+                        totals["bytes"] += size
 
-            except Exception as e:
-                return False, f"Error al sincronizar archivos: {str(e)}"
+                    for owner, version_ids in versions.items():
+                        for version_id in version_ids:
+                            metadata = self._load_version(owner, version_id)
+                            prefix = f"versiones/{owner}/{version_id}"
+                            if "files" not in metadata and "tree" not in metadata:
+                                # Versión antigua: sus archivos van dentro de su carpeta, antes del metadata.json
+                                for name, item in self._version_files(owner, metadata).items():
+                                    totals["bytes"] += self._add_file(tar, f"{prefix}/{name}", item["path"])
+                            totals["bytes"] += Bundle.add_json(tar, f"{prefix}/metadata.json", metadata)
+                            totals["versiones"] += 1
 
-            return True, f"Commit realizado para la carpeta permanente de '{owner}'."
+                    for name in sorted(users):
+                        for folder in Bundle.WORK_DIRS:
+                            directory = os.path.join(self.root_path, name, folder)
+                            if not os.path.isdir(directory):
+                                continue
+                            for relative, file_stat in self._walk_files(directory):
+                                if since_ns is not None and file_stat.st_mtime_ns < since_ns:
+                                    continue
+                                if user and folder == "access" and relative.split("/")[0] not in grants.get(user, {}):
+                                    continue  # Copia de un dueño que ya le quitó el permiso
+                                totals["bytes"] += self._add_file(
+                                    tar, f"carpetas/{name}/{folder}/{relative}", os.path.join(directory, relative))
+                                totals["archivos"] += 1
 
-        # Modo: commit (sin argumentos) pasar temporal propio a permanente
-        else:
-            temporal_dir = self.users[self.current_user]["temporal_dir"]
-            permanente_dir = self.users[self.current_user]["permanente_dir"]
-            
-            # Crear una versión de la carpeta permanente propia
-            if os.path.exists(permanente_dir) and os.listdir(permanente_dir):
-                version_id = str(uuid.uuid4())
-                version_dir = os.path.join(self.versions_dir, self.current_user, version_id)
-                os.makedirs(version_dir, exist_ok=True)
-                
-                version_info = {
-                    "version_id": version_id,
-                    "timestamp": datetime.datetime.now().isoformat(),
-                    "user": self.current_user,
-                    "source": "temporal"
-                }
-                
-                with open(os.path.join(version_dir, "metadata.json"), 'w', encoding='utf-8') as f:
-                    json.dump(version_info, f, indent=4)
-                
-                for item in os.listdir(permanente_dir):
-                    item_path = os.path.join(permanente_dir, item)
-                    if os.path.isfile(item_path):
-                        shutil.copy2(item_path, version_dir)
-        
-            # Limpiar permanente y pasar archivos desde temporal
-            for item in os.listdir(permanente_dir):
-                item_path = os.path.join(permanente_dir, item)
-                if os.path.isfile(item_path):
-                    os.remove(item_path)
-        
-            for item in os.listdir(temporal_dir):
-                item_path = os.path.join(temporal_dir, item)
-                if os.path.isfile(item_path):
-                    shutil.copy2(item_path, permanente_dir)
-        
-            return True, "Commit completo realizado correctamente."
+                    Bundle.add_json(tar, "fin.json", totals)
+                os.replace(tmp_path, path)
+        except Exception as e:
+            return False, f"Error al exportar: {str(e)}"
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
-    def update(self, target_user=None):
-        #update o update <nombre_usuario>
-        if not self.current_user:
+        kind = f"incremental desde {since_moment.isoformat()}" if since_moment else "completo"
+        return True, (f"Bundle {kind} guardado en {path}: {len(users)} usuarios, {totals['versiones']} versiones, "
+                      f"{totals['objetos']} contenidos y {totals['archivos']} archivos de trabajo ({totals['bytes']} bytes). "
+                      f"Para el siguiente incremental: --desde {exported_at.isoformat(timespec='seconds')}")
+
+    @staticmethod
+    def _add_file(tar, name, file_path):
+        # Añade un archivo al bundle con su fecha de modificación; devuelve su tamaño
+        with open(file_path, 'rb') as f:
+            file_stat = os.fstat(f.fileno())
+            Bundle.add_stream(tar, name, file_stat.st_size, f, file_stat.st_mtime_ns)
+        return file_stat.st_size
+
+    @instrumented
+    def import_bundle(self, session, path):
+        # Importa un bundle en las carpetas del usuario de la sesión: sus versiones, temporal, permanente y
+        # las carpetas access/<dueño> en las que puede escribir. Los usuarios y permisos del bundle y las
+        # carpetas de otros usuarios se omiten
+        user = self._session_user(session)
+        if not user:
             return False, "Debe iniciar sesión primero."
+        return self._import_bundle(path, user)
 
-        # actualizar access/usuario
-        if target_user:
-            if target_user not in self.users:
-                return False, f"El usuario '{target_user}' no existe."
+    @instrumented
+    def import_root(self, path):
+        # Importa un bundle en toda la raíz, con sus usuarios y permisos
+        # Es una operación de administración (--importar-bundle): no se ofrece a las sesiones
+        return self._import_bundle(path)
 
-            if self.current_user not in self.users[target_user]["permissions"]:
-                return False, f"No tiene permisos para acceder a los archivos de {target_user}."
+    def _import_bundle(self, path, user=None):
+        # Importa en esta raíz un bundle de export_bundle, leyéndolo en streaming (solo lo de user si se indica)
+        # Se añaden los usuarios que no existen (los que ya existen conservan su contraseña), los permisos
+        # que falten, los contenidos y versiones que no estén y los archivos de trabajo, que reemplazan a
+        # los actuales. No se borra nada: un bundle incremental se aplica encima del anterior
+        # Los contenidos se comprueban con su hash antes de usarlos, y antes de reemplazar archivos de una
+        # carpeta permanente se crea una versión de cómo estaba
+        if not os.path.isfile(path):
+            return False, f"El archivo '{path}' no existe."
 
-            access_temporal_dir = os.path.join(self.root_path, self.current_user, "access", target_user)
-            os.makedirs(access_temporal_dir, exist_ok=True)
+        totals = {"usuarios": 0, "versiones": 0, "objetos": 0, "archivos": 0}
+        new_versions = {}  # (dueño, id) -> si se importa (no estaba ya)
+        permanente_owners = set()
+        unverified = []  # objetos guardados que se comprueban cuando estén sus dependencias
+        skipped = 0
+        complete = False
+        try:
+            with Bundle.open_read(path) as tar, ExitStack() as locks:
+                index = None
+                locked = False
+                for member in tar:
+                    if index is None:
+                        if member.name != "indice.json":
+                            raise ValueError("no es un bundle (falta indice.json)")
+                        index = json.load(tar.extractfile(member))
+                        if index.get("formato") != Bundle.FORMAT:
+                            raise ValueError(f"formato de bundle {index.get('formato')} no soportado")
+                        continue
+                    if member.name == "usuarios.json":
+                        if user is None:
+                            totals["usuarios"] = self._import_bundle_users(json.load(tar.extractfile(member)))
+                        continue
+                    if member.name == "fin.json":
+                        complete = True
+                        continue
 
-            target_perm_dir = self.users[target_user]["permanente_dir"]
+                    # Con los usuarios ya añadidos, el resto se importa con todas las carpetas permanentes bloqueadas
+                    if not locked:
+                        locks.enter_context(self._all_owners_lock())
+                        locked = True
 
-            # Limpiar carpeta access
-            for item in os.listdir(access_temporal_dir):
-                item_path = os.path.join(access_temporal_dir, item)
-                if os.path.isfile(item_path):
-                    os.remove(item_path)
+                    parts = member.name.split("/")
+                    if parts[0] != "objetos":
+                        # Los contenidos van antes que las versiones: ya se pueden comprobar todos
+                        self._verify_imported(unverified)
+                    allowed = len(parts) > 1 and parts[1] in self.users and (user is None or parts[1] == user)
+                    if not member.isfile():
+                        skipped += 1
+                    elif parts[0] == "objetos" and len(parts) == 3 and parts[1] in BlobStore.KINDS \
+                            and len(parts[2]) == 64 and all(c in "0123456789abcdef" for c in parts[2]):
+                        if self.blobs.put_stored(parts[2], parts[1], tar.extractfile(member)):
+                            totals["objetos"] += 1
+                            if parts[1] != "full":
+                                unverified.append(parts[2])
+                    elif parts[0] == "versiones" and len(parts) == 4 and allowed \
+                            and self._valid_filename(parts[2]) and self._valid_filename(parts[3]):
+                        key = (parts[1], parts[2])
+                        if key not in new_versions:
+                            new_versions[key] = self._load_version(*key) is None
+                            totals["versiones"] += new_versions[key]
+                        if new_versions[key]:
+                            self._write_stream(tar.extractfile(member),
+                                               os.path.join(self._version_dir(*key), parts[3]), member.mtime)
+                    elif parts[0] == "carpetas" and len(parts) >= 4 and allowed \
+                            and parts[2] in Bundle.WORK_DIRS and self._valid_path("/".join(parts[3:])):
+                        owner, folder = parts[1], parts[2]
+                        if folder == "access":
+                            # access/<dueño>/...: una sesión solo escribe en las de los dueños que se lo permiten
+                            if len(parts) < 5 or (user is not None and not self._can_write(parts[3], owner)):
+                                skipped += 1
+                                continue
+                            directory = os.path.join(self.root_path, owner, folder, parts[3])
+                            name = "/".join(parts[4:])
+                        else:
+                            directory = os.path.join(self.root_path, owner, folder)
+                            name = "/".join(parts[3:])
+                        if folder == "permanente" and owner not in permanente_owners:
+                            self._version_before_import(owner)
+                            permanente_owners.add(owner)
+                        self._write_stream(tar.extractfile(member), os.path.join(directory, name), member.mtime)
+                        self._note_changes(directory, [name])
+                        totals["archivos"] += 1
+                    else:
+                        skipped += 1
+                self._verify_imported(unverified)
 
-            # Copiar archivos de permanente a access
-            for item in os.listdir(target_perm_dir):
-                item_path = os.path.join(target_perm_dir, item)
-                if os.path.isfile(item_path):
-                    shutil.copy2(item_path, access_temporal_dir)
+                # Índices de las versiones añadidas
+                for owner in sorted({owner for (owner, _), new in new_versions.items() if new}):
+                    self._rebuild_version_index(owner)
+        except Exception as e:
+            # No dejar en el almacén contenidos sin comprobar
+            try:
+                self._verify_imported(unverified)
+            except ValueError:
+                pass
+            return False, f"Error al importar el bundle: {str(e)}"
 
-            return True, f"Archivos de {target_user} actualizados correctamente."
+        message = (f"Bundle importado: {totals['usuarios']} usuarios nuevos, {totals['versiones']} versiones, "
+                   f"{totals['objetos']} contenidos y {totals['archivos']} archivos de trabajo.")
+        if skipped:
+            message += f" Se omitieron {skipped} entradas no válidas."
+        if not complete:
+            return False, message + " El bundle está incompleto (falta fin.json)."
+        return True, message
 
-        # actualizar la carpeta temporal propia
-        temporal_dir = self.users[self.current_user]["temporal_dir"]
-        permanente_dir = self.users[self.current_user]["permanente_dir"]
+    def _verify_imported(self, digests):
+        # Comprueba los objetos importados de la lista (y la vacía); los que no coinciden con su hash se
+        # borran y se informa con ValueError
+        invalid = []
+        for digest in digests:
+            try:
+                self.blobs.verify(digest)
+            except ValueError:
+                invalid.append(digest)
+        digests.clear()
+        if invalid:
+            raise ValueError(f"{len(invalid)} contenidos no coinciden con su hash: {', '.join(invalid[:3])}")
 
-        for item in os.listdir(temporal_dir):
-            item_path = os.path.join(temporal_dir, item)
-            if os.path.isfile(item_path):
-                os.remove(item_path)
+    def _version_before_import(self, owner):
+        # Crea una versión de la carpeta permanente del dueño antes de que un bundle reemplace sus archivos;
+        # la siguiente versión se crea recorriéndola entera
+        permanente_dir = self.users[owner]["permanente_dir"]
+        version_id = None
+        if os.path.exists(permanente_dir) and os.listdir(permanente_dir):
+            version_id = self._create_version(owner, "bundle", owner)
+        self._save_changes(owner, version_id, None)
 
-        for item in os.listdir(permanente_dir):
-            item_path = os.path.join(permanente_dir, item)
-            if os.path.isfile(item_path):
-                shutil.copy2(item_path, temporal_dir)
+    def _import_bundle_users(self, data):
+        # Añade los usuarios del bundle que no existen y los permisos que falten; devuelve cuántos usuarios se añadieron
+        with self._users_write_lock():
+            new_users = {name: self._new_user(name, info["password"]) for name, info in data.items()
+                         if name not in self.users and self._valid_filename(name)}
+            for new_user in new_users.values():
+                os.makedirs(new_user["temporal_dir"], exist_ok=True)
+                os.makedirs(new_user["permanente_dir"], exist_ok=True)
+            self.store.add_users(new_users)
+            self.users.update(new_users)
 
-        return True, "Update realizado correctamente."
- 
-    def list_versions(self):
-        # Lista las versiones disponibles para el usuario actual
-        if not self.current_user:
-            return False, "Debe iniciar sesión primero."
-        
-        user_versions_dir = os.path.join(self.versions_dir, self.current_user)
-        if not os.path.exists(user_versions_dir):
-            return True, []
-        
-        versions = []
+            for owner, info in data.items():
+                for grantee, permission in info.get("permissions", {}).items():
+                    if owner in self.users and grantee in self.users and permission in ("lectura", "escritura") \
+                            and grantee not in self.users[owner]["permissions"]:
+                        self.store.set_permission(owner, grantee, permission)
+            self.users = self.store.load()
+            self.grants = self.store.load_grants()
+        return len(new_users)
+
+    @staticmethod
+    def _write_stream(reader, dst_path, mtime):
+        # Escribe lo que queda en el lector en dst_path (temporal y renombrado) con la fecha indicada
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        tmp_path = os.path.join(os.path.dirname(dst_path), f".{os.path.basename(dst_path)}.{uuid.uuid4().hex}.tmp")
         try:
-            for version_id in os.listdir(user_versions_dir):
-                metadata_path = os.path.join(user_versions_dir, version_id, "metadata.json")
+            with open(tmp_path, 'wb') as f:
+                shutil.copyfileobj(reader, f, BLOCK_SIZE)
+                count("bytes_written", f.tell())
+            mtime_ns = int(mtime * 10**9)
+            os.utime(tmp_path, ns=(mtime_ns, mtime_ns))
+            os.replace(tmp_path, dst_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _expired_versions(self, entries, now=None):
+        # Devuelve las versiones (más reciente primero) que no cumple ninguna regla de retención
+        # Sin reglas configuradas se conservan todas; la versión más reciente siempre se conserva
+        policy = self.config["retention"]
+        if all(value is None for value in policy.values()) or not entries:
+            return []
+
+        now = now or datetime.datetime.now()
+        timestamps = {entry["version_id"]: datetime.datetime.fromisoformat(entry["timestamp"]) for entry in entries}
+        keep = {entries[0]["version_id"]}
+
+        if policy["keep_last"]:
+            keep.update(entry["version_id"] for entry in entries[:policy["keep_last"]])
+
+        # La más reciente de cada uno de los últimos N días o semanas que tienen versiones
+        periods = (("keep_daily", lambda moment: moment.date()),
+                   ("keep_weekly", lambda moment: moment.isocalendar()[:2]))
+        for key, period in periods:
+            if not policy[key]:
+                continue
+            seen = set()
+            for entry in entries:
+                current = period(timestamps[entry["version_id"]])
+                if current in seen:
+                    continue
+                if len(seen) >= policy[key]:
+                    break
+                seen.add(current)
+                keep.add(entry["version_id"])
+
+        if policy["max_age_days"] is not None:
+            cutoff = now - datetime.timedelta(days=policy["max_age_days"])
+            keep.update(version_id for version_id, moment in timestamps.items() if moment >= cutoff)
+
+        return [entry for entry in entries if entry["version_id"] not in keep]
+
+    def _referenced_blobs(self, skip_owner=None, skip_ids=(), include_packed=True):
+        # Hashes que usan directamente las versiones de todos los usuarios (blobs o carpetas raíz),
+        # sin contar las versiones skip_ids de skip_owner
+        # include_packed: contar también las versiones guardadas en paquetes
+        referenced = set()
+        for owner in os.listdir(self.versions_dir):
+            owner_dir = os.path.join(self.versions_dir, owner)
+            if owner.startswith(".") or not os.path.isdir(owner_dir):
+                continue
+            for version_id, version_dir in self._version_dirs(owner):
+                if owner == skip_owner and version_id in skip_ids:
+                    continue
+                metadata_path = os.path.join(version_dir, "metadata.json")
                 if os.path.exists(metadata_path):
                     with open(metadata_path, 'r', encoding='utf-8') as f:
-                        metadata = json.load(f)
-                        versions.append(metadata)
-        except Exception as e:
-            return False, f"Error al listar versiones: {str(e)}"
-        
-        # Ordenar por fecha, más reciente primero
-        versions.sort(key=lambda x: x["timestamp"], reverse=True)
-        return True, versions
-    
-    def recover_version(self, recover_type="carpeta"):
+                        version = json.load(f)
+                    referenced.update(self._version_refs(version))
+
+        if include_packed:
+            for pack in self.blobs.packs():
+                for owner, versions in pack.versions.items():
+                    for version_id, version in versions.items():
+                        if owner == skip_owner and version_id in skip_ids:
+                            continue
+                        referenced.update(self._version_refs(version))
+        return referenced
+
+    def _rewrite_pack(self, pack, drop_versions, drop_objects):
+        # Sustituye un paquete por otro sin las versiones (dueño -> ids) ni los contenidos indicados
+        versions = {}
+        for owner, owner_versions in pack.versions.items():
+            kept = {version_id: metadata for version_id, metadata in owner_versions.items()
+                    if version_id not in drop_versions.get(owner, ())}
+            if kept:
+                versions[owner] = kept
+        objects = {digest: pack for digest in pack.objects if digest not in drop_objects}
+        if versions or objects:
+            self.blobs.write_pack(objects, versions)
+        self.blobs.remove_pack(pack)
+
+    @instrumented
+    def recover_version(self, session, recover_type="carpeta", version_id=None, filename=None):
         # Recupera una versión anterior de los archivos
         # recover_type: 'carpeta' para recuperar toda la carpeta, 'archivo' para un archivo específico
-        if not self.current_user:
+        # version_id y filename evitan las preguntas por consola; si faltan se piden al usuario
+        user = self._session_user(session)
+        if not user:
             return False, "Debe iniciar sesión primero."
 
-        # Obtener todas las versiones disponibles
-        success, versions = self.list_versions()
-        if not success:
-            return False, versions
+        if recover_type not in ["carpeta", "archivo"]:
+            return False, "Tipo de recuperación no válido."
 
-        if not versions:
-            return False, "No hay versiones disponibles."
+        if version_id is None:
+            # Obtener todas las versiones disponibles
+            success, versions = self.list_versions(session)
+            if not success:
+                return False, versions
+
+            if not versions:
+                return False, "No hay versiones disponibles."
 
-        # Mostrar las versiones disponibles
-        print("Versiones disponibles:")
-        for i, version in enumerate(versions):
-            timestamp = datetime.datetime.fromisoformat(version["timestamp"]).strftime("%Y-%m-%d %H:%M:%S")
-            print(f"{i + 1}. ID: {version['version_id']} - Fecha: {timestamp}")
+            # Mostrar las versiones disponibles
+            print("Versiones disponibles:")
+            for i, version in enumerate(versions):
+                timestamp = datetime.datetime.fromisoformat(version["timestamp"]).strftime("%Y-%m-%d %H:%M:%S")
+                print(f"{i + 1}. ID: {version['version_id']} - Fecha: {timestamp}")
 
-        # Solicitar al usuario el número de versión
-        try:
-            version_index = int(input("Ingrese el número de la versión que desea recuperar: ")) - 1
-            if version_index < 0 or version_index >= len(versions):
-                return False, "Número de versión inválido."
-        except ValueError:
-            return False, "El índice debe ser un número válido."
+            # Solicitar al usuario el número de versión
+            try:
+                version_index = int(input("Ingrese el número de la versión que desea recuperar: ")) - 1
+                if version_index < 0 or version_index >= len(versions):
+                    return False, "Número de versión inválido."
+            except ValueError:
+                return False, "El índice debe ser un número válido."
+
+            # Obtener el ID de la versión seleccionada
+            version_id = versions[version_index]["version_id"]
 
-        # Obtener el ID de la versión seleccionada
-        version_id = versions[version_index]["version_id"]
-        version_dir = os.path.join(self.versions_dir, self.current_user, version_id)
+        if not self._valid_filename(version_id):
+            return False, f"La versión {version_id} no existe."
+        version = self._load_version(user, version_id)
 
-        if not os.path.exists(version_dir):
+        if not version:
             return False, f"La versión {version_id} no existe."
 
-        permanente_dir = self.users[self.current_user]["permanente_dir"]
+        permanente_dir = self.users[user]["permanente_dir"]
 
         if recover_type == "carpeta":
             # Recuperar toda la carpeta
-            # Eliminar archivos actuales en la carpeta permanente
-            for item in os.listdir(permanente_dir):
-                item_path = os.path.join(permanente_dir, item)
-                if os.path.isfile(item_path) and item != "metadata.json":
-                    os.remove(item_path)
-
-            # Copiar todos los archivos de la versión a la carpeta permanente
-            for item in os.listdir(version_dir):
-                item_path = os.path.join(version_dir, item)
-                if os.path.isfile(item_path) and item != "metadata.json":
-                    shutil.copy2(item_path, permanente_dir)
+            files = self._version_files(user, version)
+            with self._owner_lock(user):
+                # La siguiente versión tendrá que recorrer toda la carpeta
+                self._save_changes(user, None, None)
+
+                # Eliminar archivos y subcarpetas actuales en la carpeta permanente
+                for item in os.listdir(permanente_dir):
+                    item_path = os.path.join(permanente_dir, item)
+                    if os.path.isdir(item_path) and not os.path.islink(item_path):
+                        shutil.rmtree(item_path)
+                    elif os.path.isfile(item_path) and item != "metadata.json":
+                        os.remove(item_path)
+                for parent in sorted({os.path.dirname(name) for name in files} - {""}):
+                    os.makedirs(os.path.join(permanente_dir, parent), exist_ok=True)
+
+                # Copiar todos los archivos de la versión a la carpeta permanente
+                try:
+                    with timed("restore"):
+                        self.transfers.run(
+                            lambda item: self._restore_file(item[1], os.path.join(permanente_dir, item[0])),
+                            files.items(), label=lambda item: item[0])
+                except TransferError as e:
+                    return False, f"Error al recuperar la versión {version_id}: {str(e)}"
 
             return True, f"Carpeta permanente recuperada de la versión {version_id}."
 
         elif recover_type == "archivo":
             # Recuperar un archivo específico
-            # Listar los archivos disponibles en la versión seleccionada
-            print("Archivos disponibles en la versión seleccionada:")
-            files = [file for file in os.listdir(version_dir) if file != "metadata.json"]
-            for file in files:
-                print(f"  - {file}")
-
-            # Solicitar al usuario el nombre del archivo
-            filename = input("Ingrese el nombre del archivo que desea recuperar: ").strip()
-            if filename not in files:
+            if filename is None:
+                # Listar los archivos disponibles en la versión seleccionada
+                print("Archivos disponibles en la versión seleccionada:")
+                for file in sorted(self._version_files(user, version)):
+                    print(f"  - {file}")
+
+                # Solicitar al usuario el nombre del archivo
+                filename = input("Ingrese el nombre del archivo que desea recuperar: ").strip()
+
+            entry = self._version_entry(user, version, filename) if self._valid_path(filename) else None
+            if entry is None:
                 return False, f"El archivo '{filename}' no existe en la versión seleccionada."
 
             # Recuperar el archivo específico
-            src_path = os.path.join(version_dir, filename)
             dst_path = os.path.join(permanente_dir, filename)
-            shutil.copy2(src_path, dst_path)
+            with self._owner_lock(user), timed("restore"):
+                changes = self._load_changes(user)
+                if changes["paths"] is not None:
+                    self._save_changes(user, changes["base"], changes["paths"] + [filename])
+                os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+                self._restore_file(entry, dst_path)
 
             return True, f"Archivo '{filename}' recuperado de la versión {version_id}."
 
-        else:
-            return False, "Tipo de recuperación no válido."
-
-    def listar_archivos_version(self, version_index):
+    @instrumented
+    def listar_archivos_version(self, session, version_index):
         # Lista los archivos de una versión específica por índice
-        if not self.current_user:
+        user = self._session_user(session)
+        if not user:
             return False, "Debe iniciar sesión primero."
         
-        # Obtener todas las versiones disponibles
-        success, versions = self.list_versions()
-        if not success:
-            return False, versions
-        
-        if not versions:
-            return False, "No hay versiones disponibles."
-        
         # Verificar si el índice es válido
         try:
             version_index = int(version_index) - 1  # Convertir a índice (1 basado en 0)
-            if version_index < 0 or version_index >= len(versions):
-                return False, "Número de versión inválido."
         except ValueError:
             return False, "El índice debe ser un número válido."
+
+        if version_index < 0:
+            return False, "Número de versión inválido."
+
+        # Leer del índice solo la versión pedida
+        success, versions = self.list_versions(session, limit=1, offset=version_index)
+        if not success:
+            return False, versions
+
+        if not versions:
+            return False, "Número de versión inválido."
         
         # Obtener el ID de la versión
-        version_id = versions[version_index]["version_id"]
-        version_dir = os.path.join(self.versions_dir, self.current_user, version_id)
+        version_id = versions[0]["version_id"]
+        version = self._load_version(user, version_id)
         
-        if not os.path.exists(version_dir):
+        if not version:
             return False, f"La versión {version_id} no existe."
         
-        # Listar los archivos en la carpeta de la versión
+        # Listar los archivos del manifiesto de la versión
         try:
-            files = [file for file in os.listdir(version_dir) if file != "metadata.json"]
+            files = sorted(self._version_files(user, version))
             return True, files
         except Exception as e:
             return False, f"Error al listar archivos de la versión: {str(e)}"
 
-    def access_user_files(self, target_user, dir_type="permanente"):
+    @instrumented
+    def access_user_files(self, session, target_user, dir_type="permanente"):
         # Accede a los archivos de otro usuario si se tienen permisos
-        if not self.current_user:
+        user = self._session_user(session)
+        if not user:
             return False, "Debe iniciar sesión primero."
         
         if target_user not in self.users:
             return False, f"El usuario {target_user} no existe."
         
-        if self.current_user not in self.users[target_user]["permissions"]:
+        if not self._permission(target_user, user):
             return False, f"No tiene permisos para acceder a los archivos de {target_user}."
         
         # Solo permitir acceso a la carpeta permanente del otro usuario
@@ -580,21 +3932,64 @@ class FileManagementSystem:
             return False, "Solo se puede acceder a la carpeta permanente de otros usuarios."
         
         target_dir = self.users[target_user]["permanente_dir"]
-        files = []
         
         try:
-            for item in os.listdir(target_dir):
-                item_path = os.path.join(target_dir, item)
-                if os.path.isfile(item_path):
-                    files.append(item)
+            files = sorted(self._scan_files(target_dir))
         except Exception as e:
             return False, f"Error al listar archivos: {str(e)}"
         
         return True, files
 
+    def working_file_path(self, session, filename, location="temporal", owner=None, write=False):
+        # Devuelve la ruta de un archivo para leerlo o escribirlo fuera de las operaciones normales
+        # location: "temporal" o "permanente" propios, "permanente" de owner, o "access" con owner
+        # Solo se puede escribir en temporal o en access/<owner> con permiso de escritura
+        user = self._session_user(session)
+        if not user:
+            return False, "Debe iniciar sesión primero."
+
+        if not self._valid_path(filename):
+            return False, f"Nombre de archivo no válido: '{filename}'."
+
+        if owner and owner != user:
+            if owner not in self.users:
+                return False, f"El usuario '{owner}' no existe."
+            if write and not self._can_write(owner, user):
+                return False, f"No tienes permisos de escritura sobre los archivos de {owner}."
+            if not self._permission(owner, user):
+                return False, f"No tiene permisos para acceder a los archivos de {owner}."
+
+            if location == "access":
+                directory = os.path.join(self.root_path, user, "access", owner)
+                os.makedirs(directory, exist_ok=True)
+            elif location == "permanente" and not write:
+                directory = self.users[owner]["permanente_dir"]
+            else:
+                return False, "Solo se puede escribir en 'access' y leer 'access' o 'permanente' de otros usuarios."
+        else:
+            if location not in ["temporal", "permanente"] or (write and location != "temporal"):
+                return False, "Tipo de directorio no válido. Use 'temporal' o 'permanente' (solo lectura)."
+            directory = self.users[user][f"{location}_dir"]
+
+        path = os.path.join(directory, filename)
+        if write:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return True, path
+
+    def note_written(self, path):
+        # Apunta en el seguimiento de cambios un archivo escrito en una ruta de working_file_path
+        # (temporal o access/<dueño>), como hacen las operaciones que escriben archivos
+        parts = os.path.relpath(path, self.root_path).split(os.sep)
+        split = 3 if len(parts) > 3 and parts[1] == "access" else 2
+        self._note_changes(os.path.join(self.root_path, *parts[:split]), ["/".join(parts[split:])])
+
     @staticmethod
     def input_con_asteriscos(prompt=''):
         # Muestra las contraseñas con asteriscos en la consola
+        # Sin msvcrt (fuera de Windows) o sin terminal se lee la contraseña sin mostrarla
+        if msvcrt is None or not sys.stdin.isatty():
+            return getpass.getpass(prompt)
+
         print(prompt, end='', flush=True)
         password = ''
         while True:
@@ -617,46 +4012,70 @@ class CommandLineInterface(Cmd):
     prompt = 'ControlArchivos> '
     intro = 'Sistema de Control de Archivos\n' \
             'Escriba "ayuda" para ver la lista de comandos disponibles.\n'
+    interactive = True  # se pueden pedir datos por consola (contraseñas, versión a recuperar)
     
     def __init__(self, root_path):# inicializar
         super().__init__()
         self.system = FileManagementSystem(root_path)
+        self.session = None  # sesión del usuario que ha iniciado sesión en esta consola
+
+    def report(self, success, result, text=None):
+        # Muestra el resultado de un comando; text es la versión formateada para la consola
+        print(text if text is not None else result)
+
+    def read_password(self, username):
+        # Pide la contraseña del usuario por consola
+        return self.system.input_con_asteriscos("Contraseña: ")
     
     def do_registrar(self, arg):
         # Registra un nuevo usuario
         # uso: registrar <nombre_usuario>
         username = arg.strip()
         if not username:
-            print("Debe proporcionar un nombre de usuario, registrar <nombre_usuario>")
+            self.report(False, "Debe proporcionar un nombre de usuario, registrar <nombre_usuario>")
             return
 
-        password = self.system.input_con_asteriscos("Contraseña: ")
+        password = self.read_password(username)
+        if password is None:
+            self.report(False, f"No hay contraseña disponible para {username}.")
+            return
 
         success, message = self.system.register_user(username, password)
-        print(message)
+        self.report(success, message)
     
     def do_iniciar(self, arg):
        # Inicia sesión
        # uso: iniciar <nombre_usuario>
         username = arg.strip()
         if not username:
-            print("Debe escribir un nombre de usuario, iniciar <nombre_usuario>")
+            self.report(False, "Debe escribir un nombre de usuario, iniciar <nombre_usuario>")
             return
 
-        password = self.system.input_con_asteriscos("Contraseña: ")
-        success, message = self.system.login(username, password)
-        print(message)
+        password = self.read_password(username)
+        if password is None:
+            self.report(False, f"No hay contraseña disponible para {username}.")
+            return
 
-        if success:
-            self.prompt = f'ControlArchivos ({username})> '
+        success, result = self.system.login(username, password)
+        if not success:
+            self.report(False, result)
+            return
+
+        # Cerrar la sesión anterior de esta consola, si había una
+        if self.session:
+            self.system.logout(self.session)
+        self.session = result
+        self.report(True, f"Sesión iniciada como {username}.")
+        self.prompt = f'ControlArchivos ({username})> '
 
     def do_cerrar_sesion(self, arg):
         # Cierra sesion
         # uso: cerrar_sesion
-        success, message = self.system.logout()
-        print(message)
+        success, message = self.system.logout(self.session)
+        self.report(success, message)
         
         if success:
+            self.session = None
             self.prompt = 'ControlArchivos> '
     
     def do_otorgar_permiso(self, arg):
@@ -665,55 +4084,55 @@ class CommandLineInterface(Cmd):
         # tipo_permiso: "lectura" o "escritura"
         args = arg.strip().split()
         if len(args) != 2:
-            print("Uso: otorgar_permiso <nombre_usuario> <tipo_permiso>")
+            self.report(False, "Uso: otorgar_permiso <nombre_usuario> <tipo_permiso>")
             return
         
         target_user, permission_type = args
-        success, message = self.system.grant_permission(target_user, permission_type)
-        print(message)
+        success, message = self.system.grant_permission(self.session, target_user, permission_type)
+        self.report(success, message)
     
     def do_revocar_permiso(self, arg):
         # Revoca los permisos otorgados a un usuario
         # uso: revocar_permiso <nombre_usuario>
         target_user = arg.strip()
         if not target_user:
-            print("Debe proporcionar un nombre de usuario, revocar_permiso <nombre_usuario>")
+            self.report(False, "Debe proporcionar un nombre de usuario, revocar_permiso <nombre_usuario>")
             return
         
-        success, message = self.system.revoke_permission(target_user)
-        print(message)
+        success, message = self.system.revoke_permission(self.session, target_user)
+        self.report(success, message)
     
     def do_mis_archivos(self, arg):
         # Lista los archivos en una carpeta
         # uso: mis_archivos [tipo_directorio]
         # tipo_directorio: "temporal" (temporal, por defecto) o "permanente"
         dir_type = arg.strip() or "temporal"
-        success, result = self.system.list_files(dir_type)
+        success, result = self.system.list_files(self.session, dir_type)
         
         if success:
             if not result:
-                print(f"No hay archivos en la carpeta {dir_type}.")
+                self.report(True, result, f"No hay archivos en la carpeta {dir_type}.")
             else:
-                print(f"Archivos en la carpeta {dir_type}:")
-                for file in result:
-                    print(f"  - {file}")
+                lines = [f"Archivos en la carpeta {dir_type}:"]
+                lines += [f"  - {file}" for file in result]
+                self.report(True, result, "\n".join(lines))
         else:
-            print(result)
+            self.report(False, result)
     
     def do_carpetas_accesibles(self, arg):
         # Lista las carpetas a las que el usuario tiene acceso
         # uso: carpetas_accesibles
-        success, result = self.system.list_accessible_folders()
+        success, result = self.system.list_accessible_folders(self.session)
         
         if success:
             if not result:
-                print("No tiene acceso a carpetas de otros usuarios.")
+                self.report(True, result, "No tiene acceso a carpetas de otros usuarios.")
             else:
-                print("Carpetas accesibles:")
-                for user, permanente in result:
-                    print(f"  - {user} (permiso: {permanente})")
+                lines = ["Carpetas accesibles:"]
+                lines += [f"  - {user} (permiso: {permanente})" for user, permanente in result]
+                self.report(True, result, "\n".join(lines))
         else:
-            print(result)
+            self.report(False, result)
     
     def do_crear_archivo(self, arg):
         # Crea un nuevo archivo
@@ -722,15 +4141,28 @@ class CommandLineInterface(Cmd):
         # - crear_archivo <nombre_archivo.formato> <dueño> (crea en carpeta access/dueño)
         args = arg.strip().split()
         if not args:
-            print("Uso:\n- crear_archivo <nombre_archivo.formato> (crea en carpeta temporal)\n- crear_archivo <nombre_archivo.formato> <dueño> (crea en carpeta access/dueño)")
+            self.report(False, "Uso:\n- crear_archivo <nombre_archivo.formato> (crea en carpeta temporal)\n- crear_archivo <nombre_archivo.formato> <dueño> (crea en carpeta access/dueño)")
             return
 
         filename = args[0]
         owner = args[1] if len(args) > 1 else None
 
         content = " "
-        success, message = self.system.create_file(filename, content, owner)
-        print(message)
+        success, message = self.system.create_file(self.session, filename, content, owner)
+        self.report(success, message)
+
+    def do_importar(self, arg):
+        # Importa un árbol de archivos local
+        # uso: importar <ruta_local> [dueño]
+        # Sin dueño se importa a la carpeta temporal propia; con dueño, a access/dueño (permiso de escritura)
+        args = arg.strip().split()
+        if not args or len(args) > 2:
+            self.report(False, "Uso: importar <ruta_local> [dueño]")
+            return
+
+        owner = args[1] if len(args) > 1 else None
+        success, message = self.system.import_tree(self.session, args[0], owner)
+        self.report(success, message)
 
     def do_modificar_archivo(self, arg):
         # Modifica la fecha de un archivo existente
@@ -738,30 +4170,30 @@ class CommandLineInterface(Cmd):
         # Si no se especifica dueño, se modifica en la carpeta temporal del usuario actual.
         args = arg.strip().split()
         if not args:
-            print("Debe proporcionar un nombre de archivo,modificar_archivo <nombre_archivo> o modificar_archivo <nombre_archivo> [dueño]")
+            self.report(False, "Debe proporcionar un nombre de archivo,modificar_archivo <nombre_archivo> o modificar_archivo <nombre_archivo> [dueño]")
             return
         
         filename = args[0]
         owner = args[1] if len(args) > 1 else None
         dir_type = "access" if owner else "temporal"
         
-        success, message = self.system.modify_file(filename, dir_type, owner)
-        print(message)
+        success, message = self.system.modify_file(self.session, filename, dir_type, owner)
+        self.report(success, message)
     
     def do_eliminar_archivo(self, arg):
         # Elimina un archivo
         # uso: eliminar_archivo <nombre_archivo> [dueño]
         args = arg.strip().split()
         if not args:
-            print("Debe proporcionar un nombre de archivo, eliminar_archivo <nombre_archivo> [dueño]")
+            self.report(False, "Debe proporcionar un nombre de archivo, eliminar_archivo <nombre_archivo> [dueño]")
             return
         
         filename = args[0]
         owner = args[1] if len(args) > 1 else None
         dir_type = "access" if owner else "temporal"
         
-        success, message = self.system.delete_file(filename, dir_type, owner)
-        print(message)
+        success, message = self.system.delete_file(self.session, filename, dir_type, owner)
+        self.report(success, message)
     
     def do_commit(self, arg):
         # Realiza un commit.
@@ -772,90 +4204,247 @@ class CommandLineInterface(Cmd):
         
         if len(args) == 0:
             # Commit completo: temporal -> permanente
-            success, message = self.system.commit()
+            success, message = self.system.commit(self.session)
         elif len(args) == 1:
             # Commit de toda la carpeta de acceso de un dueño
             owner = args[0]
-            success, message = self.system.commit(owner=owner)
+            success, message = self.system.commit(self.session, owner=owner)
         else:
-            print("Uso incorrecto. Use:\n - commit\n - commit <dueño>")
+            self.report(False, "Uso incorrecto. Use:\n - commit\n - commit <dueño>")
             return
         
-        print(message)
+        self.report(success, message)
     
     def do_update(self, arg):
         # Actualiza archivos:
         # - update                    -> actualiza carpeta temporal del usuario actual
         # - update <nombre_usuario>   -> actualiza access/<nombre_usuario>
-        target_user = arg.strip() or None
-        success, message = self.system.update(target_user)
-        print(message)
+        # - update [nombre_usuario] --simular -> muestra los cambios sin aplicarlos
+        args = arg.strip().split()
+        dry_run = "--simular" in args
+        args = [a for a in args if a != "--simular"]
+        if len(args) > 1:
+            self.report(False, "Uso incorrecto. Use:\n - update [--simular]\n - update <nombre_usuario> [--simular]")
+            return
+
+        target_user = args[0] if args else None
+        success, message = self.system.update(self.session, target_user, dry_run=dry_run)
+        self.report(success, message)
     
+    def do_estado(self, arg):
+        # Muestra los cambios sin confirmar:
+        # - estado          -> temporal respecto a permanente
+        # - estado <dueño>  -> access/<dueño> respecto a la permanente del dueño
+        args = arg.strip().split()
+        if len(args) > 1:
+            self.report(False, "Uso incorrecto. Use:\n - estado\n - estado <dueño>")
+            return
+
+        success, result = self.system.status(self.session, args[0] if args else None)
+        if not success:
+            self.report(False, result)
+            return
+        if not FileManagementSystem._plan_has_changes(result):
+            self.report(True, result, "No hay cambios sin confirmar.")
+        else:
+            self.report(True, result, f"Cambios sin confirmar ({FileManagementSystem._plan_summary(result)}):\n"
+                                      f"{FileManagementSystem._plan_report(result)}")
+
     def do_listar_archivos_version(self, arg):
         # Lista los archivos de una versión específica
         # uso: listar_archivos_version <número_de_versión>
         version_index = arg.strip()
         if not version_index:
-            print("Debe proporcionar el número de versión, listar_archivos_version <número_de_versión>")
+            self.report(False, "Debe proporcionar el número de versión, listar_archivos_version <número_de_versión>")
             return
         
-        success, result = self.system.listar_archivos_version(version_index)
+        success, result = self.system.listar_archivos_version(self.session, version_index)
         if success:
             if not result:
-                print(f"No hay archivos en la versión {version_index}.")
+                self.report(True, result, f"No hay archivos en la versión {version_index}.")
             else:
-                print(f"Archivos en la versión {version_index}:")
-                for file in result:
-                    print(f"  - {file}")
+                lines = [f"Archivos en la versión {version_index}:"]
+                lines += [f"  - {file}" for file in result]
+                self.report(True, result, "\n".join(lines))
         else:
-            print(result)
+            self.report(False, result)
 
     def do_listar_versiones(self, arg):
         # Lista las versiones disponibles.
-        # uso: listar_versiones
-        success, versions = self.system.list_versions()
+        # uso: listar_versiones [cantidad] [página] [--desde FECHA] [--hasta FECHA]
+        # cantidad: número de versiones por página (todas por defecto), página: empieza en 1
+        # FECHA: AAAA-MM-DD o AAAA-MM-DDTHH:MM:SS, ambos extremos incluidos
+        args = arg.strip().split()
+        dates = {"--desde": None, "--hasta": None}
+        try:
+            for option in dates:
+                if option in args:
+                    position = args.index(option)
+                    dates[option] = args[position + 1]
+                    del args[position:position + 2]
+            limit = int(args[0]) if args else None
+            page = int(args[1]) if len(args) > 1 else 1
+            if (limit is not None and limit < 1) or page < 1 or len(args) > 2:
+                raise ValueError
+        except (ValueError, IndexError):
+            self.report(False, "Uso: listar_versiones [cantidad] [página] [--desde FECHA] [--hasta FECHA]")
+            return
+
+        offset = (page - 1) * limit if limit else 0
+        success, versions = self.system.list_versions(self.session, limit, offset, dates["--desde"], dates["--hasta"])
         
         if success:
             if not versions:
-                print("No hay versiones disponibles.")
+                self.report(True, versions, "No hay versiones disponibles.")
             else:
-                print("Versiones disponibles:")
-                for i, version in enumerate(versions):
+                lines = ["Versiones disponibles:"]
+                for i, version in enumerate(versions, start=offset + 1):
                     timestamp = datetime.datetime.fromisoformat(version["timestamp"]).strftime("%Y-%m-%d %H:%M:%S")
-                    print(f"{i+1}. ID: {version['version_id']} - Fecha: {timestamp}")
+                    lines.append(f"{i}. ID: {version['version_id']} - Fecha: {timestamp} - "
+                                 f"{version['file_count']} archivos, {version['size']} bytes - Autor: {version['user']}")
+                self.report(True, versions, "\n".join(lines))
         else:
-            print(versions)
+            self.report(False, versions)
+
+    def do_reconstruir_indice(self, arg):
+        # Regenera el índice de versiones a partir de las carpetas de versiones
+        # uso: reconstruir_indice
+        success, message = self.system.rebuild_version_index(self.session)
+        self.report(success, message)
     
+    def do_estadisticas(self, arg):
+        # Muestra las métricas de las operaciones de esta sesión del programa
+        # uso: estadisticas | estadisticas prometheus <archivo> | estadisticas reiniciar
+        args = arg.strip().split()
+        metrics = self.system.metrics
+
+        if len(args) == 2 and args[0] == "prometheus":
+            try:
+                metrics.write_prometheus(args[1])
+            except OSError as e:
+                self.report(False, f"Error al exportar las métricas: {str(e)}")
+                return
+            self.report(True, f"Métricas exportadas en {args[1]}.")
+            return
+
+        if args == ["reiniciar"]:
+            metrics.reset()
+            self.report(True, "Métricas reiniciadas.")
+            return
+
+        if args:
+            self.report(False, "Uso: estadisticas | estadisticas prometheus <archivo> | estadisticas reiniciar")
+            return
+
+        totals = metrics.snapshot()
+        if not totals:
+            self.report(True, totals, "Todavía no hay operaciones medidas.")
+            return
+
+        lines = [f"{'Operación':<26}{'Llamadas':>9}{'Errores':>8}{'Tiempo ms':>11}{'Stat':>8}"
+                 f"{'Copiados':>9}{'Enlazados':>10}{'Bytes escritos':>15}{'Guardados':>10}"]
+        for name in sorted(totals):
+            values = totals[name]
+            lines.append(f"{name:<26}{values.get('calls', 0):>9}{values.get('errors', 0):>8}"
+                         f"{values.get('seconds', 0) * 1000:>11.1f}{values.get('files_stat', 0):>8}"
+                         f"{values.get('files_copied', 0):>9}{values.get('files_linked', 0):>10}"
+                         f"{values.get('bytes_written', 0):>15}{values.get('user_saves', 0):>10}")
+            # Reparto del tiempo entre las fases internas de la operación
+            phases = [f"{counter[:-8]} {value * 1000:.1f} ms" for counter, value in sorted(values.items())
+                      if counter.endswith("_seconds")]
+            if phases:
+                lines.append(f"{'':<4}{', '.join(phases)}")
+        self.report(True, totals, "\n".join(lines))
+
+    def do_gc(self, arg):
+        # Borra las versiones que no cumplen la política de retención y los contenidos sin uso
+        # uso: gc [--simular]
+        args = arg.strip().split()
+        if args not in ([], ["--simular"]):
+            self.report(False, "Uso: gc [--simular]")
+            return
+
+        success, message = self.system.gc(self.session, dry_run=bool(args))
+        self.report(success, message)
+
+    def do_empaquetar(self, arg):
+        # Junta las versiones frías en un archivo de paquete
+        # uso: empaquetar [--simular]
+        args = arg.strip().split()
+        if args not in ([], ["--simular"]):
+            self.report(False, "Uso: empaquetar [--simular]")
+            return
+
+        success, message = self.system.pack_versions(self.session, dry_run=bool(args))
+        self.report(success, message)
+
+    def do_exportar(self, arg):
+        # Guarda en un bundle las carpetas de trabajo y versiones del usuario actual
+        # (la raíz entera solo se exporta al iniciar, con --exportar)
+        # uso: exportar <archivo> [--desde FECHA]
+        # Con --desde solo entran las versiones y archivos de trabajo desde esa fecha (bundle incremental)
+        args = arg.strip().split()
+        if len(args) not in (1, 3) or (len(args) == 3 and args[1] != "--desde"):
+            self.report(False, "Uso: exportar <archivo> [--desde FECHA]")
+            return
+
+        since = args[2] if len(args) == 3 else None
+        success, message = self.system.export_bundle(self.session, args[0], since)
+        self.report(success, message)
+
+    def do_importar_bundle(self, arg):
+        # Importa un bundle de exportar en las carpetas del usuario actual
+        # uso: importar_bundle <archivo>
+        args = arg.strip().split()
+        if len(args) != 1:
+            self.report(False, "Uso: importar_bundle <archivo>")
+            return
+
+        success, message = self.system.import_bundle(self.session, args[0])
+        self.report(success, message)
+
     def do_recuperar_version(self, arg):
         # Recupera una versión anterior
-        # uso: recuperar_version carpeta | archivo
-        recover_type = arg.strip().lower()
-        if recover_type not in ["carpeta", "archivo"]:
-            print("Uso incorrecto. Use:\n - recuperar_version carpeta\n - recuperar_version archivo")
+        # uso: recuperar_version carpeta [id_versión] | archivo [id_versión] [nombre_archivo]
+        # Sin id de versión (o sin archivo) se pregunta por consola
+        args = arg.strip().split()
+        usage = ("Uso incorrecto. Use:\n - recuperar_version carpeta [id_versión]\n"
+                 " - recuperar_version archivo [id_versión] [nombre_archivo]")
+        if not args or args[0].lower() not in ["carpeta", "archivo"]:
+            self.report(False, usage)
+            return
+
+        recover_type = args[0].lower()
+        max_args = 2 if recover_type == "carpeta" else 3
+        needed_args = max_args if not self.interactive else 1
+        if len(args) > max_args or len(args) < needed_args:
+            self.report(False, usage)
             return
 
-        success, message = self.system.recover_version(recover_type)
-        print(message)
+        version_id = args[1] if len(args) > 1 else None
+        filename = args[2] if len(args) > 2 else None
+        success, message = self.system.recover_version(self.session, recover_type, version_id, filename)
+        self.report(success, message)
     
     def do_archivos_accesibles(self, arg):
         # Accede a los archivos de otro usuario
         # uso: archivos_accesibles <nombre_usuario>
         target_user = arg.strip()
         if not target_user:
-            print("Debe proporcionar un nombre de usuario, archivos_accesibles <nombre_usuario>")
+            self.report(False, "Debe proporcionar un nombre de usuario, archivos_accesibles <nombre_usuario>")
             return
         
-        success, result = self.system.access_user_files(target_user)
+        success, result = self.system.access_user_files(self.session, target_user)
         
         if success:
             if not result:
-                print(f"No hay archivos en la carpeta permanente de {target_user}.")
+                self.report(True, result, f"No hay archivos en la carpeta permanente de {target_user}.")
             else:
-                print(f"Archivos de {target_user}:")
-                for file in result:
-                    print(f"  - {file}")
+                lines = [f"Archivos de {target_user}:"]
+                lines += [f"  - {file}" for file in result]
+                self.report(True, result, "\n".join(lines))
         else:
-            print(result)
+            self.report(False, result)
 
     def do_cls(self, arg):
         # Limpia la consola.
@@ -879,15 +4468,22 @@ class CommandLineInterface(Cmd):
             
             print("\nGestión de archivos:")
             print("  crear_archivo       - Crea un nuevo archivo (crear_archivo <nombre_archivo> [dueño] o crear_archivo <nombre_archivo>)")
+            print("  importar            - Importa un árbol de archivos local (importar <ruta_local> [dueño])")
             print("  modificar_archivo   - Modifica un archivo (modificar_archivo <nombre_archivo> [dueño] o modificar_archivo <nombre_archivo>)")
             print("  eliminar_archivo    - Elimina un archivo (eliminar_archivo <nombre_archivo> [dueño] o eliminar_archivo <nombre_archivo>)")
             
             print("\nControl de versiones:")
             print("  commit              - Transfiere de temporal a permanente y crea versión (commit o commit <dueño>)")
-            print("  update              - Actualiza temporal con contenido de permanente (update o update <dueño>)")
-            print("  listar_versiones    - Lista versiones disponibles")
+            print("  update              - Actualiza temporal con contenido de permanente (update o update <dueño>, --simular para ver los cambios)")
+            print("  estado              - Muestra los cambios sin confirmar respecto a permanente (estado o estado <dueño>)")
+            print("  listar_versiones    - Lista versiones disponibles (listar_versiones [cantidad] [página] [--desde FECHA] [--hasta FECHA])")
+            print("  reconstruir_indice  - Regenera el índice de versiones desde las carpetas de versiones")
+            print("  gc                  - Borra las versiones caducadas y los contenidos sin uso (gc [--simular])")
+            print("  empaquetar          - Junta las versiones antiguas en un único archivo de paquete (empaquetar [--simular])")
+            print("  exportar            - Guarda sus carpetas y versiones en un bundle (exportar <archivo> [--desde FECHA])")
+            print("  importar_bundle     - Importa un bundle en sus carpetas (importar_bundle <archivo>)")
             print("  listar_archivos_version    - Lista los archivos de una version especifica (listar_archivos_version <número_de_versión>)")
-            print("  recuperar_version   - Recupera una versión anterior de archivo o carpeta (recuperar_version <carpeta|archivo>)")
+            print("  recuperar_version   - Recupera una versión anterior de archivo o carpeta (recuperar_version <carpeta|archivo> [id_versión] [archivo])")
             
             print("\nListado de archivos y carpetas:")
             print("  mis_archivos     - Lista archivos en carpeta temporal o permanente (mis_archivos [tipo])")
@@ -895,6 +4491,7 @@ class CommandLineInterface(Cmd):
             print("  archivos_accesibles    - Accede a archivos de otro usuario (archivos_accesibles <nombre_usuario>)")
             
             print("\nOtros comandos:")
+            print("  estadisticas        - Muestra o exporta las métricas de las operaciones (estadisticas [prometheus <archivo>|reiniciar])")
             print("  ayuda               - Muestra esta ayuda")
             print("  salir               - Sale del programa")
             print("  cls                 - Limpia la consola")   
@@ -905,14 +4502,439 @@ class CommandLineInterface(Cmd):
         print("¡Hasta luego!")
         return True
 
+class BatchInterface(CommandLineInterface):
+    # Ejecuta comandos desde un archivo o la entrada estándar, sin ninguna pregunta por consola
+    # Cada comando escribe una línea JSON con su resultado en output
+
+    interactive = False
+
+    def __init__(self, root_path, passwords=None, default_password=None, output=None, stop_on_error=False):
+        super().__init__(root_path)
+        self.passwords = passwords or {}  # usuario -> contraseña
+        self.default_password = default_password
+        self.output = output or sys.stdout
+        self.stop_on_error = stop_on_error
+        self._last_result = None
+
+    @staticmethod
+    def load_passwords(path):
+        # Lee un archivo de contraseñas con líneas "usuario:contraseña"
+        passwords = {}
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.rstrip("\r\n")
+                if line and not line.startswith("#") and ":" in line:
+                    username, password = line.split(":", 1)
+                    passwords[username.strip()] = password
+        return passwords
+
+    def read_password(self, username):
+        return self.passwords.get(username, self.default_password)
+
+    def report(self, success, result, text=None):
+        self._last_result = (success, result)
+
+    def default(self, line):
+        self.report(False, f"Comando desconocido: {line.split()[0]}")
+
+    def do_cls(self, arg):
+        self.report(True, None)
+
+    def do_ayuda(self, arg):
+        self.report(True, sorted(name[3:] for name in self.get_names() if name.startswith("do_")))
+
+    def do_salir(self, arg):
+        self.report(True, "Fin del lote.")
+        return True
+
+    def run(self, lines):
+        # Ejecuta los comandos y devuelve el código de salida: 0 si todos funcionaron, 1 si alguno falló
+        failures = 0
+        for number, line in enumerate(lines, start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            self._last_result = None
+            try:
+                stop = self.onecmd(line)
+            except Exception as e:
+                stop = False
+                self.report(False, f"Error inesperado: {str(e)}")
+            success, result = self._last_result or (True, None)
+
+            response = {"line": number, "command": line.split()[0], "ok": success}
+            response["result" if success else "error"] = result
+            self.output.write(json.dumps(response, ensure_ascii=False) + "\n")
+            self.output.flush()
+
+            if not success:
+                failures += 1
+                if self.stop_on_error:
+                    break
+            if stop:
+                break
+        return 1 if failures else 0
+
+class FileService:
+    # Servicio local asyncio delante de FileManagementSystem, con un protocolo de líneas JSON
+    # Cada petición es una línea {"op": ..., "token": ..., ...} y cada respuesta otra línea JSON
+    # upload: la petición lleva "size" y le siguen exactamente esos bytes del archivo
+    # download: la respuesta lleva "size" y le siguen exactamente esos bytes
+    # El trabajo de disco se hace en un pool de hilos para no bloquear el bucle de eventos
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, system, max_requests=16, workers=8):
+        self.system = system
+        self.max_requests = max_requests
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.limit = None
+
+    async def _run(self, func, *args, **kwargs):
+        # Ejecuta una función bloqueante en el pool de hilos
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    @staticmethod
+    async def _send(writer, response):
+        writer.write((json.dumps(response, ensure_ascii=False) + "\n").encode('utf-8'))
+        await writer.drain()
+
+    @staticmethod
+    def _response(success, result):
+        if success:
+            return {"ok": True, "result": result}
+        return {"ok": False, "error": result}
+
+    async def handle_client(self, reader, writer):
+        # Atiende las peticiones de una conexión, una detrás de otra
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError
+                except ValueError:
+                    await self._send(writer, {"ok": False, "error": "Petición JSON no válida."})
+                    continue
+
+                async with self.limit:
+                    response = await self._dispatch(request, reader, writer)
+                if response is not None:
+                    await self._send(writer, response)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, request, reader, writer):
+        op = request.get("op")
+        handler = getattr(self, f"_op_{op}", None) if isinstance(op, str) else None
+        if handler is None:
+            return {"ok": False, "error": f"Operación desconocida: {op}"}
+
+        session = self.system.get_session(str(request.get("token", "")))
+        try:
+            return await handler(request, session, reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            raise
+        except Exception as e:
+            return {"ok": False, "error": f"Error inesperado: {str(e)}"}
+
+    async def _op_register(self, request, session, reader, writer):
+        return self._response(*await self._run(
+            self.system.register_user, request.get("username", ""), request.get("password", "")))
+
+    async def _op_login(self, request, session, reader, writer):
+        success, result = await self._run(
+            self.system.login, request.get("username", ""), request.get("password", ""))
+        if not success:
+            return self._response(False, result)
+        return self._response(True, {"token": result.token, "username": result.username})
+
+    async def _op_logout(self, request, session, reader, writer):
+        return self._response(*await self._run(self.system.logout, session))
+
+    async def _op_list_files(self, request, session, reader, writer):
+        return self._response(*await self._run(
+            self.system.list_files, session, request.get("dir_type", "temporal")))
+
+    async def _op_commit(self, request, session, reader, writer):
+        return self._response(*await self._run(self.system.commit, session, owner=request.get("owner")))
+
+    async def _op_update(self, request, session, reader, writer):
+        return self._response(*await self._run(
+            self.system.update, session, request.get("owner"), dry_run=bool(request.get("dry_run"))))
+
+    async def _op_status(self, request, session, reader, writer):
+        return self._response(*await self._run(self.system.status, session, request.get("owner")))
+
+    async def _op_list_versions(self, request, session, reader, writer):
+        return self._response(*await self._run(
+            self.system.list_versions, session, request.get("limit"), request.get("offset", 0),
+            request.get("since"), request.get("until")))
+
+    async def _op_recover(self, request, session, reader, writer):
+        # En el servicio nunca se pregunta por consola: la versión (y el archivo) son obligatorios
+        recover_type = request.get("recover_type", "carpeta")
+        if not request.get("version_id"):
+            return self._response(False, "Debe indicar version_id.")
+        if recover_type == "archivo" and not request.get("filename"):
+            return self._response(False, "Debe indicar filename para recuperar un archivo.")
+        return self._response(*await self._run(
+            self.system.recover_version, session, recover_type,
+            version_id=request["version_id"], filename=request.get("filename")))
+
+    async def _op_gc(self, request, session, reader, writer):
+        return self._response(*await self._run(self.system.gc, session, dry_run=bool(request.get("dry_run"))))
+
+    async def _op_pack(self, request, session, reader, writer):
+        return self._response(*await self._run(
+            self.system.pack_versions, session, dry_run=bool(request.get("dry_run"))))
+
+    async def _op_metrics(self, request, session, reader, writer):
+        # Métricas del proceso del servicio, en JSON o en formato Prometheus
+        if session is None:
+            return self._response(False, "Debe iniciar sesión primero.")
+        if request.get("format") == "prometheus":
+            return self._response(True, self.system.metrics.to_prometheus())
+        return self._response(True, self.system.metrics.snapshot())
+
+    async def _op_upload(self, request, session, reader, writer):
+        # Recibe un archivo por trozos y lo escribe en temporal o en access/<owner>
+        try:
+            remaining = int(request.get("size", -1))
+        except (TypeError, ValueError):
+            remaining = -1
+        if remaining < 0:
+            # Sin tamaño no se puede saber dónde acaba el archivo
+            await self._send(writer, {"ok": False, "error": "Debe indicar size."})
+            raise ConnectionError("upload sin tamaño")
+
+        owner = request.get("owner")
+        success, path = await self._run(
+            self.system.working_file_path, session, request.get("filename", ""),
+            "access" if owner else "temporal", owner, write=True)
+
+        f = None
+        tmp_path = None
+        if success:
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            try:
+                f = await self._run(open, tmp_path, 'wb')
+            except OSError as e:
+                success, path = False, f"Error al crear archivo: {str(e)}"
+
+        try:
+            # Leer siempre el cuerpo completo, aunque se rechace, para no desincronizar la conexión
+            while remaining > 0:
+                chunk = await reader.readexactly(min(self.CHUNK_SIZE, remaining))
+                remaining -= len(chunk)
+                if success:
+                    try:
+                        await self._run(f.write, chunk)
+                    except OSError as e:
+                        success, path = False, f"Error al escribir archivo: {str(e)}"
+            if f:
+                await self._run(f.close)
+            if success:
+                await self._run(os.replace, tmp_path, path)
+                self.system.note_written(path)
+        finally:
+            if f and not f.closed:
+                await self._run(f.close)
+            if tmp_path and os.path.exists(tmp_path):
+                await self._run(os.remove, tmp_path)
+
+        if not success:
+            return self._response(False, path)
+        return self._response(True, f"Archivo '{os.path.basename(path)}' subido correctamente.")
+
+    async def _op_download(self, request, session, reader, writer):
+        # Envía un archivo por trozos después de una línea de cabecera con su tamaño
+        success, path = await self._run(
+            self.system.working_file_path, session, request.get("filename", ""),
+            request.get("location", "permanente"), request.get("owner"))
+        if success and not os.path.isfile(path):
+            success, path = False, f"El archivo '{request.get('filename')}' no existe."
+        if not success:
+            return self._response(False, path)
+
+        f = await self._run(open, path, 'rb')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            await self._send(writer, {"ok": True, "size": size})
+            remaining = size
+            while remaining > 0:
+                chunk = await self._run(f.read, min(self.CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise ConnectionError("el archivo cambió de tamaño durante la descarga")
+                remaining -= len(chunk)
+                writer.write(chunk)
+                await writer.drain()
+        finally:
+            await self._run(f.close)
+        return None
+
+    async def serve(self, socket_path=None, host="127.0.0.1", port=8765):
+        # Escucha en un socket Unix si se indica (y existe en el sistema) o en TCP local
+        self.limit = asyncio.Semaphore(self.max_requests)
+        if socket_path and hasattr(asyncio, "start_unix_server"):
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = await asyncio.start_unix_server(self.handle_client, path=socket_path)
+            print(f"Servicio escuchando en {socket_path}")
+        else:
+            server = await asyncio.start_server(self.handle_client, host, port)
+            print(f"Servicio escuchando en {host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+class FileServiceClient:
+    # Cliente mínimo y síncrono del servicio
+
+    def __init__(self, socket_path=None, host="127.0.0.1", port=8765):
+        if socket_path:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(socket_path)
+        else:
+            self.sock = socket.create_connection((host, port))
+        self.stream = self.sock.makefile('rwb')
+        self.token = None
+
+    def _send(self, request):
+        self.stream.write((json.dumps(request, ensure_ascii=False) + "\n").encode('utf-8'))
+
+    def _receive(self):
+        line = self.stream.readline()
+        if not line:
+            raise ConnectionError("El servicio cerró la conexión.")
+        return json.loads(line)
+
+    def request(self, op, **params):
+        # Envía una operación con la sesión actual y devuelve la respuesta
+        self._send(dict(params, op=op, token=self.token))
+        self.stream.flush()
+        return self._receive()
+
+    def login(self, username, password):
+        response = self.request("login", username=username, password=password)
+        if response["ok"]:
+            self.token = response["result"]["token"]
+        return response
+
+    def upload(self, local_path, filename=None, owner=None):
+        # Sube un archivo local leyéndolo por trozos
+        size = os.path.getsize(local_path)
+        self._send({"op": "upload", "token": self.token, "filename": filename or os.path.basename(local_path),
+                    "owner": owner, "size": size})
+        with open(local_path, 'rb') as f:
+            shutil.copyfileobj(f, self.stream, FileService.CHUNK_SIZE)
+        self.stream.flush()
+        return self._receive()
+
+    def download(self, filename, local_path, location="permanente", owner=None):
+        # Descarga un archivo escribiéndolo por trozos en local_path
+        response = self.request("download", filename=filename, location=location, owner=owner)
+        if not response["ok"]:
+            return response
+        remaining = response["size"]
+        with open(local_path, 'wb') as f:
+            while remaining > 0:
+                chunk = self.stream.read(min(FileService.CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise ConnectionError("El servicio cerró la conexión durante la descarga.")
+                f.write(chunk)
+                remaining -= len(chunk)
+        return {"ok": True, "result": f"Archivo '{filename}' descargado en {local_path}."}
+
+    def close(self):
+        self.stream.close()
+        self.sock.close()
+
+def run_batch(args):
+    # Ejecuta un script de comandos y devuelve el código de salida
+    # 0: todos los comandos funcionaron, 1: algún comando falló, 2: no se pudo iniciar el lote
+    # Los mensajes informativos del sistema se envían a la salida de errores
+    output = sys.stdout
+    try:
+        passwords = BatchInterface.load_passwords(args.contrasenas) if args.contrasenas else {}
+        default_password = os.environ.get("CONTROL_ARCHIVOS_PASSWORD")
+        with redirect_stdout(sys.stderr):
+            root_path = os.path.abspath(args.raiz)
+            os.makedirs(root_path, exist_ok=True)
+            batch = BatchInterface(root_path, passwords, default_password, output, args.detener_en_error)
+            try:
+                if args.lote == "-":
+                    return batch.run(sys.stdin)
+                with open(args.lote, 'r', encoding='utf-8') as f:
+                    return batch.run(f)
+            finally:
+                batch.system.close()
+    except (OSError, UnicodeDecodeError) as e:
+        print(f"Error al iniciar el modo lote: {str(e)}", file=sys.stderr)
+        return 2
+
+def run_bundle(args):
+    # Exporta o importa la raíz entera (--exportar / --importar-bundle) y devuelve el código de salida
+    root_path = os.path.abspath(args.raiz)
+    if args.importar_bundle:
+        os.makedirs(root_path, exist_ok=True)
+    elif not os.path.isdir(root_path):
+        print(f"La carpeta raíz '{root_path}' no existe.", file=sys.stderr)
+        return 2
+    system = FileManagementSystem(root_path)
+    try:
+        if args.exportar:
+            success, message = system.export_root(args.exportar, args.desde)
+        else:
+            success, message = system.import_root(args.importar_bundle)
+    finally:
+        system.close()
+    print(message)
+    return 0 if success else 1
+
 def main():
     # Función principal
+    parser = argparse.ArgumentParser(description="Sistema de Control de Archivos")
+    parser.add_argument("--raiz", default=os.path.join(os.getcwd(), "raiz"),
+                        help="carpeta raíz del repositorio (por defecto ./raiz)")
+    parser.add_argument("--servidor", action="store_true",
+                        help="inicia el servicio local en lugar de la consola interactiva")
+    parser.add_argument("--socket", help="ruta del socket Unix del servicio")
+    parser.add_argument("--host", default="127.0.0.1", help="dirección TCP del servicio si no se usa --socket")
+    parser.add_argument("--puerto", type=int, default=8765, help="puerto TCP del servicio")
+    parser.add_argument("--lote", metavar="ARCHIVO",
+                        help="ejecuta los comandos de ARCHIVO ('-' para la entrada estándar) sin interacción")
+    parser.add_argument("--contrasenas", metavar="ARCHIVO",
+                        help="archivo con líneas usuario:contraseña para el modo lote")
+    parser.add_argument("--detener-en-error", action="store_true",
+                        help="en modo lote, se detiene en el primer comando que falle")
+    parser.add_argument("--exportar", metavar="ARCHIVO",
+                        help="guarda toda la raíz (usuarios, permisos, carpetas y versiones) en un bundle y termina")
+    parser.add_argument("--desde", metavar="FECHA", help="con --exportar, bundle incremental desde FECHA")
+    parser.add_argument("--importar-bundle", metavar="ARCHIVO",
+                        help="importa un bundle de --exportar en toda la raíz y termina")
+    args = parser.parse_args()
+
+    # Modo lote: la salida estándar solo contiene las líneas JSON de los resultados
+    if args.lote:
+        return run_batch(args)
+
+    # Copias de la raíz entera: solo quien tiene acceso a la carpeta raíz, nunca desde una sesión
+    if args.exportar or args.importar_bundle:
+        return run_bundle(args)
+
     print("Sistema de Control de Archivos")
     print("=" * 50)
     
     # Ubicación del raiz raíz
     while True:
-        root_path = os.path.join(os.getcwd(), "raiz")      
+        root_path = os.path.abspath(args.raiz)
         if not os.path.exists(root_path):
             try:
                 os.makedirs(root_path)
@@ -924,6 +4946,18 @@ def main():
             break
     
     print(f"Usando repositorio en: {root_path}")
+
+    # Iniciar el servicio local
+    if args.servidor:
+        system = FileManagementSystem(root_path)
+        service = FileService(system, system.config["server_max_requests"], system.config["server_workers"])
+        try:
+            asyncio.run(service.serve(args.socket, args.host, args.puerto))
+        except KeyboardInterrupt:
+            print("\nServicio detenido.")
+        finally:
+            system.close()
+        return
     
     # Iniciar la interfaz de línea de comandos
     cli = CommandLineInterface(root_path)
@@ -933,6 +4967,8 @@ def main():
         print("\n¡Hasta luego!")
     except Exception as e:
         print(f"Error inesperado: {str(e)}")
+    finally:
+        cli.system.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
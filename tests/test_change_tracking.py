@@ -0,0 +1,114 @@
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tarea
+
+
+class ChangeTrackingTest(unittest.TestCase):
+    # Con change_tracking, commit y estado ven todos los cambios de temporal: con inotify, con sondeo
+    # (sin inotify) y tras reiniciar el sistema
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        with open(os.path.join(self.root, ".configuracion.json"), 'w', encoding='utf-8') as f:
+            json.dump({"change_tracking": True}, f)
+
+    def _system(self, inotify=True):
+        with contextlib.redirect_stdout(io.StringIO()):
+            if inotify:
+                system = tarea.FileManagementSystem(self.root)
+            else:
+                # Como en un sistema sin inotify (Windows, macOS)
+                with mock.patch.object(tarea.ctypes, "CDLL", side_effect=OSError):
+                    system = tarea.FileManagementSystem(self.root)
+        if not system.users:
+            self.assertTrue(system.register_user("ana", "clave")[0])
+        ok, session = system.login("ana", "clave")
+        self.assertTrue(ok)
+        return system, session
+
+    def _write(self, system, name, data):
+        with open(os.path.join(system.users["ana"]["temporal_dir"], name), 'w', encoding='utf-8') as f:
+            f.write(data)
+
+    def _check_edit_then_commit(self, inotify):
+        system, session = self._system(inotify)
+        self.addCleanup(system.close)
+        for i in range(20):
+            self._write(system, f"f{i}.txt", f"contenido {i}")
+        self.assertTrue(system.commit(session)[0])
+        self.assertEqual(system.status(session), (True, {"added": [], "modified": [], "removed": []}))
+
+        # Sin esperar a nada entre el cambio y el commit
+        self._write(system, "f3.txt", "cambiado")
+        self._write(system, "nuevo.txt", "nuevo")
+        os.remove(os.path.join(system.users["ana"]["temporal_dir"], "f4.txt"))
+        ok, message = system.commit(session)
+        self.assertTrue(ok, message)
+        self.assertIn("1 añadidos, 1 modificados, 1 eliminados", message)
+        self.assertEqual(system.status(session), (True, {"added": [], "modified": [], "removed": []}))
+        with open(os.path.join(system.users["ana"]["permanente_dir"], "f3.txt"), encoding='utf-8') as f:
+            self.assertEqual(f.read(), "cambiado")
+
+    def test_commit_right_after_edit_with_inotify(self):
+        system, session = self._system()
+        method = system.tracker.method
+        system.close()
+        if method != "inotify":
+            self.skipTest("inotify no disponible")
+        self._check_edit_then_commit(True)
+
+    def test_commit_right_after_edit_without_inotify(self):
+        self._check_edit_then_commit(False)
+
+    def _check_restart(self, inotify, clean):
+        system, session = self._system(inotify)
+        self._write(system, "a.txt", "uno")
+        self._write(system, "b.txt", "dos")
+        self.assertTrue(system.commit(session)[0])
+        self._write(system, "a.txt", "pendiente")  # Cambio sin consultar al cerrar
+        if clean:
+            system.close()
+        else:
+            system.transfers.close()  # Termina sin guardar el estado del seguimiento
+        self._write(system, "b.txt", "mientras estaba cerrado")
+
+        system, session = self._system(inotify)
+        self.addCleanup(system.close)
+        self.assertEqual(system.status(session), (True, {"added": [], "modified": ["a.txt", "b.txt"], "removed": []}))
+        ok, message = system.commit(session)
+        self.assertTrue(ok, message)
+        self.assertIn("0 añadidos, 2 modificados, 0 eliminados", message)
+
+    def test_restart_after_clean_close(self):
+        self._check_restart(True, True)
+
+    def test_restart_after_unclean_exit(self):
+        self._check_restart(True, False)
+
+    def test_restart_without_inotify(self):
+        self._check_restart(False, True)
+
+    def test_files_written_by_the_system(self):
+        system, session = self._system(False)
+        self.addCleanup(system.close)
+        self.assertTrue(system.create_file(session, "a.txt", "uno")[0])
+        self.assertTrue(system.commit(session)[0])
+        self.assertTrue(system.create_file(session, "a.txt", "otro contenido")[0])
+        self.assertTrue(system.delete_file(session, "a.txt")[0])
+        self.assertTrue(system.create_file(session, "b.txt", "dos")[0])
+        self.assertEqual(system.status(session), (True, {"added": ["b.txt"], "modified": [], "removed": ["a.txt"]}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,240 @@
+import contextlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import tarea
+
+FILES = 8
+
+# Proceso que hace commits en la carpeta del dueño desde su propio FileManagementSystem
+WORKER = """
+import contextlib, io, sys
+sys.path.insert(0, sys.argv[1])
+import tarea
+root, user, owner, rounds, files = sys.argv[2], sys.argv[3], sys.argv[4], int(sys.argv[5]), int(sys.argv[6])
+with contextlib.redirect_stdout(io.StringIO()):
+    system = tarea.FileManagementSystem(root)
+try:
+    ok, session = system.login(user, "clave")
+    assert ok, session
+    for r in range(rounds):
+        for k in range(files):
+            ok, message = system.create_file(session, f"f{k}.txt", f"{user} {r}\\n", owner)
+            assert ok, message
+        ok, message = system.commit(session, owner)
+        assert ok, message
+finally:
+    system.close()
+"""
+
+
+class ConcurrentSessionsTest(unittest.TestCase):
+    # Varias sesiones trabajan a la vez sobre la misma raíz, en hilos de un sistema y en varios procesos:
+    # cada commit sobre una carpeta permanente es atómico (ni la carpeta ni ninguna versión mezclan archivos
+    # de dos commits), no se pierde ninguna versión y gc nunca borra contenidos que se están guardando
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        with open(os.path.join(self.root, ".configuracion.json"), 'w', encoding='utf-8') as f:
+            json.dump({"transfer_workers": 4}, f)
+
+    def _system(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            system = tarea.FileManagementSystem(self.root)
+        self.addCleanup(system.close)
+        return system
+
+    def _login(self, system, username):
+        ok, session = system.login(username, "clave")
+        self.assertTrue(ok, session)
+        return session
+
+    def _setup_owner(self, system, grantees):
+        # Registra a "ana" y a los usuarios con permiso de escritura sobre su carpeta
+        self.assertTrue(system.register_users([("ana", "clave")] + [(name, "clave") for name in grantees])[0])
+        owner = self._login(system, "ana")
+        for name in grantees:
+            self.assertTrue(system.grant_permission(owner, name, "escritura")[0])
+        return owner
+
+    @staticmethod
+    def _write_round(system, session, label, owner=None):
+        # Escribe los mismos FILES archivos con un contenido que identifica al autor y la ronda
+        for k in range(FILES):
+            ok, message = system.create_file(session, f"f{k}.txt", f"{label}\n", owner)
+            if not ok:
+                raise AssertionError(message)
+
+    def _check_uniform(self, directory):
+        # Todos los archivos vienen del mismo commit; devuelve su contenido
+        contents = {}
+        for name in tarea.FileManagementSystem._scan_files(directory):
+            with open(os.path.join(directory, name), encoding='utf-8') as f:
+                contents[name] = f.read()
+        self.assertEqual(sorted(contents), [f"f{k}.txt" for k in range(FILES)])
+        self.assertEqual(len(set(contents.values())), 1, contents)
+        return next(iter(contents.values()))
+
+    def _check_history(self, system, session, commits):
+        # Una versión por commit (salvo el primero, con permanente vacía) y todas recuperables enteras
+        permanente_dir = system.users["ana"]["permanente_dir"]
+        final = self._check_uniform(permanente_dir)
+        ok, versions = system.list_versions(session)
+        self.assertTrue(ok, versions)
+        ids = [entry["version_id"] for entry in versions]
+        self.assertEqual(len(ids), commits - 1)
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual(ids, sorted(ids, reverse=True))
+
+        seen = {final}
+        for version_id in ids:
+            ok, message = system.recover_version(session, "carpeta", version_id)
+            self.assertTrue(ok, message)
+            seen.add(self._check_uniform(permanente_dir))
+        self.assertEqual(len(seen), commits)
+
+    def _run_threads(self, targets):
+        errors = []
+
+        def run(target):
+            try:
+                target()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(target,)) for target in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_sessions(self):
+        system = self._system()
+        self._setup_owner(system, ["beto"])
+        ana = self._login(system, "ana")
+        other_ana = self._login(system, "ana")
+        beto = self._login(system, "beto")
+        self.assertNotEqual(ana.token, other_ana.token)
+        self.assertIs(system.get_session(beto.token), beto)
+
+        self.assertTrue(system.create_file(ana, "a.txt", "de ana")[0])
+        self.assertTrue(system.create_file(beto, "b.txt", "de beto")[0])
+        self.assertEqual(system.list_files(other_ana)[1], ["a.txt"])
+        self.assertEqual(system.list_files(beto)[1], ["b.txt"])
+
+        self.assertTrue(system.logout(ana)[0])
+        self.assertFalse(system.commit(ana)[0])
+        self.assertIsNone(system.get_session(ana.token))
+        self.assertTrue(system.commit(other_ana)[0])
+        self.assertTrue(system.commit(beto)[0])
+        self.assertFalse(system.commit(tarea.Session("beto"))[0])
+
+    def test_concurrent_registration(self):
+        system = self._system()
+        results = []
+        names = [f"u{i}" for i in range(10)]
+        self._run_threads([lambda name=name: results.append(system.register_user(name, "clave")[0])
+                           for name in names for _ in range(3)])
+        # Cada nombre se registra una sola vez
+        self.assertEqual(sorted(results), [False] * 20 + [True] * 10)
+        self.assertEqual(sorted(self._system().users), names)
+
+    def test_concurrent_commits_in_threads(self):
+        system = self._system()
+        grantees = [f"u{i}" for i in range(6)]
+        owner = self._setup_owner(system, grantees)
+        rounds = 4
+
+        def grantee_work(name):
+            session = self._login(system, name)
+            for r in range(rounds):
+                self._write_round(system, session, f"{name} {r}", "ana")
+                ok, message = system.commit(session, "ana")
+                if not ok:
+                    raise AssertionError(message)
+                # Leer la carpeta del dueño mientras otros hacen commit
+                ok, message = system.update(session, "ana")
+                if not ok:
+                    raise AssertionError(message)
+                self._check_uniform(os.path.join(self.root, name, "access", "ana"))
+
+        def owner_work():
+            session = self._login(system, "ana")
+            for r in range(rounds):
+                self._write_round(system, session, f"ana {r}")
+                ok, message = system.commit(session)
+                if not ok:
+                    raise AssertionError(message)
+
+        self._run_threads([lambda name=name: grantee_work(name) for name in grantees] + [owner_work])
+        self._check_history(system, owner, (len(grantees) + 1) * rounds)
+
+    def test_gc_during_commits(self):
+        # gc (sin política de retención) solo borra contenidos sin uso, nunca los de un commit a medias
+        system = self._system()
+        grantees = [f"u{i}" for i in range(4)]
+        owner = self._setup_owner(system, grantees)
+        rounds = 5
+        done = threading.Event()
+
+        def grantee_work(name):
+            session = self._login(system, name)
+            for r in range(rounds):
+                self._write_round(system, session, f"{name} {r}", "ana")
+                ok, message = system.commit(session, "ana")
+                if not ok:
+                    raise AssertionError(message)
+
+        gc_errors = []
+
+        def gc_work():
+            session = self._login(system, "ana")
+            while not done.is_set():
+                ok, message = system.gc(session)
+                if not ok:
+                    gc_errors.append(message)
+                    return
+
+        gc_thread = threading.Thread(target=gc_work)
+        gc_thread.start()
+        try:
+            self._run_threads([lambda name=name: grantee_work(name) for name in grantees])
+        finally:
+            done.set()
+            gc_thread.join()
+        self.assertEqual(gc_errors, [])
+        self._check_history(system, owner, len(grantees) * rounds)
+
+    def test_concurrent_commits_in_processes(self):
+        system = self._system()
+        grantees = [f"p{i}" for i in range(3)]
+        owner = self._setup_owner(system, grantees)
+        rounds = 4
+        processes = [subprocess.Popen([sys.executable, "-c", WORKER, REPO_DIR, self.root, name, "ana",
+                                       str(rounds), str(FILES)], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                     for name in grantees]
+        # Este proceso también hace commits mientras tanto
+        for r in range(rounds):
+            self._write_round(system, owner, f"ana {r}")
+            ok, message = system.commit(owner)
+            self.assertTrue(ok, message)
+        for process in processes:
+            output = process.communicate(timeout=120)[0]
+            self.assertEqual(process.returncode, 0, output.decode(errors='replace'))
+        self._check_history(system, owner, (len(grantees) + 1) * rounds)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,343 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import tarea
+
+
+def new_root(test):
+    root = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, root, ignore_errors=True)
+    with open(os.path.join(root, ".configuracion.json"), 'w', encoding='utf-8') as f:
+        json.dump({}, f)
+    return root
+
+
+def scratch_dir(test):
+    # Carpeta para archivos de la prueba que no van dentro de la raíz
+    directory = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+    return directory
+
+
+def open_system(test, root):
+    with contextlib.redirect_stdout(io.StringIO()):
+        system = tarea.FileManagementSystem(root)
+    test.addCleanup(system.close)
+    return system
+
+
+def folder_state(directory):
+    # ruta relativa -> contenido de los archivos de una carpeta
+    state = {}
+    if os.path.isdir(directory):
+        for name in tarea.FileManagementSystem._scan_files(directory):
+            with open(os.path.join(directory, name), 'rb') as f:
+                state[name] = f.read()
+    return state
+
+
+class BatchModeTest(unittest.TestCase):
+    # El modo lote ejecuta los comandos de la consola sin preguntar nada y escribe una línea JSON por comando
+
+    def setUp(self):
+        self.root = new_root(self)
+
+    def _run(self, script, stop_on_error=False):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(io.StringIO()):
+            batch = tarea.BatchInterface(self.root, {"ana": "clave"}, "otra", output, stop_on_error)
+        try:
+            code = batch.run(io.StringIO(script))
+        finally:
+            batch.system.close()
+        return code, [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_script(self):
+        code, results = self._run(
+            "# comentario\n"
+            "registrar ana\n"
+            "iniciar ana\n"
+            "\n"
+            "crear_archivo a.txt\n"
+            "commit\n"
+            "crear_archivo b.txt\n"
+            "commit\n"
+            "listar_versiones\n"
+            "mis_archivos permanente\n"
+            "registrar beto\n"
+            "iniciar beto\n")
+        self.assertEqual(code, 0, results)
+        self.assertEqual([result["command"] for result in results],
+                         ["registrar", "iniciar", "crear_archivo", "commit", "crear_archivo", "commit",
+                          "listar_versiones", "mis_archivos", "registrar", "iniciar"])
+        self.assertEqual([result["line"] for result in results[:3]], [2, 3, 5])
+        self.assertTrue(all(result["ok"] for result in results))
+        versions = results[6]["result"]
+        self.assertEqual(len(versions), 1)
+
+        # recuperar_version necesita sus argumentos; los errores no detienen el lote salvo que se pida
+        script = ("iniciar ana\nrecuperar_version carpeta\nno_existe\n"
+                  f"recuperar_version carpeta {versions[0]['version_id']}\n")
+        code, results = self._run(script)
+        self.assertEqual(code, 1)
+        self.assertEqual([result["ok"] for result in results], [True, False, False, True])
+        self.assertIn("error", results[1])
+        self.assertEqual(folder_state(os.path.join(self.root, "ana", "permanente")), {"a.txt": b" "})
+
+        code, results = self._run(script, stop_on_error=True)
+        self.assertEqual(code, 1)
+        self.assertEqual(len(results), 2)
+
+    def test_command_line(self):
+        passwords = os.path.join(scratch_dir(self), "claves.txt")
+        with open(passwords, 'w', encoding='utf-8') as f:
+            f.write("# usuario:contraseña\nana:clave:con:dos puntos\n")
+        process = subprocess.run(
+            [sys.executable, os.path.join(REPO_DIR, "tarea.py"), "--raiz", self.root, "--lote", "-",
+             "--contrasenas", passwords],
+            input="registrar ana\niniciar ana\ncrear_archivo a.txt\ncommit\n", capture_output=True,
+            text=True, timeout=60)
+        self.assertEqual(process.returncode, 0, process.stdout + process.stderr)
+        # La salida estándar solo tiene los resultados
+        results = [json.loads(line) for line in process.stdout.splitlines()]
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(result["ok"] for result in results))
+
+        system = open_system(self, self.root)
+        self.assertTrue(system.login("ana", "clave:con:dos puntos")[0])
+
+
+class FileServiceTest(unittest.TestCase):
+    # El servicio atiende a varios clientes a la vez sobre la misma raíz, con subidas y descargas por trozos
+
+    def setUp(self):
+        self.root = new_root(self)
+        self.system = open_system(self, self.root)
+        self.scratch = scratch_dir(self)
+        self.socket_path = os.path.join(self.scratch, "servicio.sock")
+        service = tarea.FileService(self.system, 4, 4)
+        started = threading.Event()
+        state = {}
+
+        async def main():
+            state["loop"] = asyncio.get_running_loop()
+            state["task"] = asyncio.current_task()
+            started.set()
+            await service.serve(self.socket_path)
+
+        def run():
+            try:
+                asyncio.run(main())
+            except asyncio.CancelledError:
+                pass
+
+        def stop():
+            state["loop"].call_soon_threadsafe(state["task"].cancel)
+            thread.join()
+            service.executor.shutdown()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            thread = threading.Thread(target=run)
+            thread.start()
+            started.wait()
+            self.addCleanup(stop)
+            deadline = time.monotonic() + 10
+            while not os.path.exists(self.socket_path) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            # Con la primera respuesta el servicio ya escribió su mensaje de inicio
+            self._client().request("no_existe")
+
+    def _client(self):
+        client = tarea.FileServiceClient(self.socket_path)
+        self.addCleanup(client.close)
+        return client
+
+    def _file(self, name, size):
+        path = os.path.join(self.scratch, name)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        return path
+
+    def test_requests(self):
+        client = self._client()
+        self.assertEqual(client.request("no_existe"), {"ok": False, "error": "Operación desconocida: no_existe"})
+        client.stream.write(b"no es json\n")
+        client.stream.flush()
+        self.assertEqual(client._receive(), {"ok": False, "error": "Petición JSON no válida."})
+        self.assertFalse(client.request("commit")["ok"])
+
+        self.assertTrue(client.request("register", username="ana", password="clave")["ok"])
+        self.assertFalse(client.login("ana", "mala")["ok"])
+        self.assertTrue(client.login("ana", "clave")["ok"])
+
+        big = self._file("grande.bin", 3 * tarea.FileService.CHUNK_SIZE + 17)
+        self.assertTrue(client.upload(big, filename="sub/grande.bin")["ok"])
+        self.assertFalse(client.upload(big, filename="../fuera.bin")["ok"])
+        self.assertTrue(client.request("commit")["ok"])
+        self.assertEqual(client.request("status")["result"], {"added": [], "modified": [], "removed": []})
+        small = self._file("nuevo.bin", 10)
+        self.assertTrue(client.upload(small, filename="sub/grande.bin")["ok"])
+        self.assertEqual(client.request("status")["result"]["modified"], ["sub/grande.bin"])
+        self.assertTrue(client.request("commit")["ok"])
+
+        versions = client.request("list_versions", limit=1)
+        self.assertTrue(versions["ok"], versions)
+        version_id = versions["result"][0]["version_id"]
+        self.assertTrue(client.request("recover", recover_type="archivo", version_id=version_id,
+                                       filename="sub/grande.bin")["ok"])
+        out = os.path.join(self.scratch, "descarga.bin")
+        self.assertTrue(client.download("sub/grande.bin", out)["ok"])
+        with open(big, 'rb') as expected, open(out, 'rb') as downloaded:
+            self.assertEqual(downloaded.read(), expected.read())
+        self.assertFalse(client.download("no_existe.bin", out)["ok"])
+        # La conexión sigue sincronizada después de todo
+        self.assertTrue(client.request("list_files", dir_type="permanente")["ok"])
+
+    def test_concurrent_clients(self):
+        data = self._file("datos.bin", 200 * 1024)
+        errors = []
+
+        def work(i):
+            try:
+                client = self._client()
+                name = f"u{i}"
+                assert client.request("register", username=name, password="clave")["ok"]
+                assert client.login(name, "clave")["ok"]
+                for k in range(3):
+                    response = client.upload(data, filename=f"f{k}.bin")
+                    assert response["ok"], response
+                response = client.request("commit")
+                assert response["ok"], response
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        with open(data, 'rb') as f:
+            content = f.read()
+        for i in range(6):
+            self.assertEqual(folder_state(self.system.users[f"u{i}"]["permanente_dir"]),
+                             {f"f{k}.bin": content for k in range(3)})
+
+
+class BundleTest(unittest.TestCase):
+    # Un bundle lleva el historial y las carpetas de trabajo a otra raíz, entero (administración) o solo
+    # los del usuario de la sesión, y sus contenidos se comprueban al importarlo
+
+    def setUp(self):
+        self.source = new_root(self)
+        self.system = open_system(self, self.source)
+        self.assertTrue(self.system.register_users([("ana", "clave"), ("beto", "otra")])[0])
+        self.ana = self.system.login("ana", "clave")[1]
+        self.beto = self.system.login("beto", "otra")[1]
+        self.assertTrue(self.system.grant_permission(self.ana, "beto", "escritura")[0])
+        self.assertTrue(self.system.grant_permission(self.beto, "ana", "lectura")[0])
+        for i in range(4):
+            self.assertTrue(self.system.create_file(self.ana, "a.txt", f"versión {i}\n" * 1000)[0])
+            self.assertTrue(self.system.create_file(self.ana, f"sub/{i}.txt", f"archivo {i}")[0])
+            self.assertTrue(self.system.commit(self.ana)[0])
+        self.assertTrue(self.system.create_file(self.ana, "sin_confirmar.txt", "temporal")[0])
+        self.assertTrue(self.system.update(self.beto, "ana")[0])
+        self.assertTrue(self.system.create_file(self.beto, "de_beto.txt", "beto", "ana")[0])
+        self.assertTrue(self.system.create_file(self.beto, "b.txt", "de beto")[0])
+        self.assertTrue(self.system.commit(self.beto)[0])
+        self.assertTrue(self.system.create_file(self.beto, "b.txt", "de beto otra vez")[0])
+        self.assertTrue(self.system.commit(self.beto)[0])
+        self.bundle = os.path.join(scratch_dir(self), "copia.tar.gz")
+
+    def _history(self, system, session):
+        # id de versión -> contenido de permanente en esa versión, recuperándolas una a una
+        # (cambia permanente: se llama después de exportar y de comparar las carpetas)
+        permanente_dir = system.users[session.username]["permanente_dir"]
+        history = {}
+        for entry in system.list_versions(session)[1]:
+            ok, message = system.recover_version(session, "carpeta", entry["version_id"])
+            self.assertTrue(ok, message)
+            history[entry["version_id"]] = folder_state(permanente_dir)
+        return history
+
+    def _folders(self, root, username):
+        return {folder: folder_state(os.path.join(root, username, folder)) for folder in tarea.Bundle.WORK_DIRS}
+
+    def test_root_round_trip(self):
+        expected = {name: self._folders(self.source, name) for name in ("ana", "beto")}
+        ok, message = self.system.export_root(self.bundle)
+        self.assertTrue(ok, message)
+        histories = {"ana": self._history(self.system, self.ana), "beto": self._history(self.system, self.beto)}
+        self.assertEqual(len(histories["ana"]), 3)
+
+        target = new_root(self)
+        system = open_system(self, target)
+        ok, message = system.import_root(self.bundle)
+        self.assertTrue(ok, message)
+        ana = system.login("ana", "clave")[1]
+        beto = system.login("beto", "otra")[1]
+        self.assertEqual(system.grants, self.system.grants)
+        for name, session in (("ana", ana), ("beto", beto)):
+            self.assertEqual(self._folders(target, name), expected[name])
+            self.assertEqual(self._history(system, session), histories[name])
+
+    def test_session_round_trip(self):
+        expected = self._folders(self.source, "ana")
+        ok, message = self.system.export_bundle(self.ana, self.bundle)
+        self.assertTrue(ok, message)
+        history = self._history(self.system, self.ana)
+        with tarfile.open(self.bundle) as tar:
+            names = tar.getnames()
+        self.assertFalse([name for name in names if "beto" in name])
+
+        target = new_root(self)
+        system = open_system(self, target)
+        self.assertTrue(system.register_user("ana", "nueva")[0])
+        ana = system.login("ana", "nueva")[1]
+        ok, message = system.import_bundle(ana, self.bundle)
+        self.assertTrue(ok, message)
+        self.assertEqual(sorted(system.users), ["ana"])
+        self.assertEqual(self._folders(target, "ana"), expected)
+        self.assertEqual(self._history(system, ana), history)
+
+    def test_import_checks_contents(self):
+        ok, message = self.system.export_root(self.bundle)
+        self.assertTrue(ok, message)
+
+        # Cambiar un byte del primer contenido completo
+        tampered = self.bundle.replace("copia", "alterada")
+        with tarfile.open(self.bundle) as src, tarfile.open(tampered, "w:gz") as dst:
+            done = False
+            for member in src.getmembers():
+                data = src.extractfile(member).read() if member.isfile() else None
+                if not done and member.name.startswith("objetos/full/"):
+                    data = bytes([data[0] ^ 1]) + data[1:]
+                    digest = member.name.rsplit("/", 1)[1]
+                    done = True
+                dst.addfile(member, io.BytesIO(data) if data is not None else None)
+        self.assertTrue(done)
+
+        target = new_root(self)
+        system = open_system(self, target)
+        ok, message = system.import_root(tampered)
+        self.assertFalse(ok)
+        self.assertIn("no coincide con su hash", message)
+        self.assertFalse(system.blobs.exists(digest))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,148 @@
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tarea
+
+
+class SnapshotBackendTest(unittest.TestCase):
+    # Las versiones guardadas no cambian aunque después se editen, reescriban o toquen los archivos de
+    # temporal y permanente, con cada forma de guardar los contenidos (snapshot_backend)
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+
+    def _system(self, backend):
+        with open(os.path.join(self.root, ".configuracion.json"), 'w', encoding='utf-8') as f:
+            json.dump({"snapshot_backend": backend}, f)
+        with contextlib.redirect_stdout(io.StringIO()):
+            system = tarea.FileManagementSystem(self.root)
+        self.addCleanup(system.close)
+        self.assertTrue(system.register_user("ana", "clave")[0])
+        ok, session = system.login("ana", "clave")
+        self.assertTrue(ok)
+        return system, session
+
+    @staticmethod
+    def _state(directory):
+        # nombre -> (contenido, mtime_ns) de cada archivo de la carpeta
+        state = {}
+        for name, file_stat in tarea.FileManagementSystem._scan_files(directory).items():
+            with open(os.path.join(directory, name), 'rb') as f:
+                state[name] = (f.read(), file_stat.st_mtime_ns)
+        return state
+
+    @staticmethod
+    def _write(path, data, mtime_ns=None):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        if mtime_ns is not None:
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    @staticmethod
+    def _edit_in_place(path, offset, data):
+        # Reescribe bytes sin cambiar de inodo, como un editor que guarda sobre el mismo archivo
+        with open(path, 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+
+    @staticmethod
+    def _replace(path, data):
+        # Reescribe el archivo con uno nuevo y un rename, como hace el programa
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _touch(path, mtime_ns):
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    def _commit(self, system, session, expected):
+        # Hace commit y apunta el contenido que debe tener la versión que crea (permanente antes del commit)
+        permanente_dir = system.users["ana"]["permanente_dir"]
+        before = self._state(permanente_dir)
+        ok, message = system.commit(session)
+        self.assertTrue(ok, message)
+        ok, versions = system.list_versions(session, limit=1)
+        self.assertTrue(ok, versions)
+        if before:
+            expected.append((versions[0]["version_id"], before))
+
+    def _check_versions(self, system, session, expected):
+        permanente_dir = system.users["ana"]["permanente_dir"]
+        for version_id, state in expected:
+            ok, message = system.recover_version(session, "carpeta", version_id)
+            self.assertTrue(ok, message)
+            self.assertEqual(self._state(permanente_dir), state, version_id)
+
+    def _run_backend(self, backend):
+        system, session = self._system(backend)
+        temporal_dir = system.users["ana"]["temporal_dir"]
+        permanente_dir = system.users["ana"]["permanente_dir"]
+        hardlink = backend == "hardlink"
+        expected = []
+
+        self._write(os.path.join(temporal_dir, "a.txt"), b"uno\n", 1_600_000_000_000_000_000)
+        self._write(os.path.join(temporal_dir, "b.txt"), b"dos\n" * 100, 1_600_000_001_000_000_000)
+        self._write(os.path.join(temporal_dir, "sub", "c.bin"), os.urandom(300 * 1024), 1_600_000_002_000_000_000)
+        self._write(os.path.join(temporal_dir, "sub", "e.txt"), b"igual\n" * 50, 1_600_000_003_000_000_000)
+        self._commit(system, session, expected)
+
+        # Reescribir, editar en el sitio y tocar en temporal
+        self._replace(os.path.join(temporal_dir, "a.txt"), b"uno cambiado\n")
+        self._edit_in_place(os.path.join(temporal_dir, "sub", "c.bin"), 1000, b"editado")
+        self._touch(os.path.join(temporal_dir, "b.txt"), 1_700_000_000_000_000_000)
+        self._commit(system, session, expected)
+        self.assertEqual(len(expected), 1)
+
+        # Ahora en permanente: sub/e.txt no cambió, así que sigue siendo el archivo que se guardó en la
+        # primera versión y en modo hardlink comparte el inodo con su blob
+        shared = os.path.join(permanente_dir, "sub", "e.txt")
+        if hardlink and "hardlink" in system.blobs.methods:
+            self.assertGreater(os.stat(shared).st_nlink, 1)
+        self._touch(shared, 1_700_000_001_000_000_000)
+        self._touch(os.path.join(permanente_dir, "b.txt"), 1_700_000_001_000_000_000)
+        self._replace(os.path.join(permanente_dir, "a.txt"), b"cambio a mano\n")
+        if not hardlink:
+            # Con enlaces duros no se deben editar a mano en el sitio (ver README, snapshot_backend)
+            self._edit_in_place(shared, 0, b"a mano")
+            self._edit_in_place(os.path.join(permanente_dir, "b.txt"), 0, b"a mano")
+        self._edit_in_place(os.path.join(temporal_dir, "b.txt"), 0, b"DOS")
+        with open(os.path.join(temporal_dir, "sub", "c.bin"), 'ab') as f:
+            f.write(b"final")
+        self._write(os.path.join(temporal_dir, "d.txt"), b"nuevo\n")
+        self._commit(system, session, expected)
+
+        # Los archivos de permanente que el commit no reemplazó siguen enlazados a los blobs
+        self._touch(os.path.join(permanente_dir, "sub", "c.bin"), 1_700_000_002_000_000_000)
+        os.remove(os.path.join(temporal_dir, "a.txt"))
+        self._edit_in_place(os.path.join(temporal_dir, "d.txt"), 0, b"N")
+        self._commit(system, session, expected)
+
+        self.assertEqual(len(expected), 3)
+        self._check_versions(system, session, expected)
+        # Recuperar no cambia tampoco las versiones
+        self._check_versions(system, session, expected)
+
+    def test_reflink(self):
+        self._run_backend("reflink")
+
+    def test_hardlink(self):
+        self._run_backend("hardlink")
+
+    def test_copy(self):
+        self._run_backend("copy")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,255 @@
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tarea
+
+
+def random_bytes(generator, size):
+    # Bytes pseudoaleatorios reproducibles (random.randbytes solo existe desde Python 3.9)
+    return generator.getrandbits(size * 8).to_bytes(size, 'little')
+
+
+class BlobStoreTest(unittest.TestCase):
+    # Cada forma de guardar un contenido en .objetos (completo, delta, troceado, comprimido y carpeta)
+    # devuelve exactamente los mismos bytes que se guardaron, suelto, al copiarlo y al llevarlo a otro almacén
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.random = random.Random(1234)
+
+    def _store(self, name="objetos", **options):
+        return tarea.BlobStore(os.path.join(self.root, name), "copy", **options)
+
+    def _file(self, name, data):
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def _data(self, size):
+        return random_bytes(self.random, size)
+
+    def _check(self, store, digest, data, kind):
+        # El objeto es del tipo esperado y se reconstruye igual con write_content y con copy_to
+        self.assertEqual(store.loose_path(digest)[1], kind)
+        out = io.BytesIO()
+        store.write_content(digest, out)
+        self.assertEqual(out.getvalue(), data)
+        copy_path = os.path.join(self.root, "copia")
+        store.copy_to(digest, copy_path)
+        with open(copy_path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        store.verify(digest)
+
+    def test_full(self):
+        store = self._store()
+        data = self._data(10_000)
+        digest = store.put_file(self._file("a.bin", data))
+        self.assertEqual(digest, tarea.BlobStore.hash_file(os.path.join(self.root, "a.bin")))
+        self._check(store, digest, data, "full")
+        # El mismo contenido se guarda una sola vez
+        self.assertEqual(store.put_file(self._file("b.bin", data)), digest)
+        self.assertEqual(len([d for d, _, _ in store.iter_objects() if d]), 1)
+
+    def test_delta_chain(self):
+        store = self._store(delta_min_size=1, delta_max_chain=2, delta_block_size=1024)
+        data = bytearray(self._data(64 * 1024))
+        contents, digests = [], []
+        base = None
+        for i in range(4):
+            data[i * 5000:i * 5000 + 10] = b"cambio %03d" % i
+            contents.append(bytes(data))
+            digests.append(store.put_file(self._file(f"v{i}.bin", contents[-1]), base=base))
+            base = digests[-1]
+
+        # La primera es completa, las dos siguientes deltas encadenados y la cadena se corta en la cuarta
+        self.assertIsNone(store.delta_base(digests[0]))
+        self.assertEqual(store.delta_base(digests[1]), (digests[0], 1))
+        self.assertEqual(store.delta_base(digests[2]), (digests[1], 2))
+        self.assertIsNone(store.delta_base(digests[3]))
+        for digest, content, kind in zip(digests, contents, ("full", "delta", "delta", "full")):
+            self._check(store, digest, content, kind)
+        self.assertLess(os.path.getsize(store.loose_path(digests[2])[0]), len(contents[2]) // 4)
+        self.assertEqual(store.with_dependencies([digests[2]]), set(digests[:3]))
+
+    def test_delta_not_worth_it(self):
+        # Un contenido sin parecido con la base se guarda completo
+        store = self._store(delta_min_size=1, delta_max_chain=8, delta_block_size=1024)
+        base = store.put_file(self._file("a.bin", self._data(32 * 1024)))
+        data = self._data(32 * 1024)
+        self._check(store, store.put_file(self._file("b.bin", data), base=base), data, "full")
+
+    def test_chunks(self):
+        store = self._store(chunk_min_size=1, chunk_avg_size=4096)
+        data = self._data(256 * 1024)
+        digest = store.put_file(self._file("a.bin", data))
+        self._check(store, digest, data, "chunks")
+        chunks = store.dependencies(digest)
+        self.assertGreater(len(chunks), 10)
+        with open(store.loose_path(digest)[0], 'rb') as f:
+            sizes = [size for _, size in tarea.Chunker.read_manifest(f)]
+        self.assertTrue(all(1024 <= size <= 16 * 1024 for size in sizes[:-1]))
+
+        # Insertar bytes en medio solo cambia los trozos de alrededor
+        edited = data[:100_000] + b"insertado" + data[100_000:]
+        edited_digest = store.put_file(self._file("b.bin", edited))
+        self._check(store, edited_digest, edited, "chunks")
+        shared = set(chunks) & set(store.dependencies(edited_digest))
+        self.assertGreaterEqual(len(shared), len(chunks) - 3)
+
+    def test_small_file_is_not_chunked(self):
+        store = self._store(chunk_min_size=1, chunk_avg_size=4096)
+        data = self._data(500)
+        self._check(store, store.put_file(self._file("a.bin", data)), data, "full")
+
+    def test_compression(self):
+        text = "".join(f"línea {i} de un archivo de texto\n" for i in range(20_000)).encode('utf-8')
+        for codec in tarea.Compression.available():
+            with self.subTest(codec=codec):
+                store = self._store(codec, compression=codec)
+                digest = store.put_file(self._file("a.txt", text))
+                self._check(store, digest, text, "compressed")
+                self.assertLess(os.path.getsize(store.loose_path(digest)[0]), len(text) // 4)
+
+                # Lo que no se reduce y los formatos ya comprimidos se guardan tal cual
+                data = self._data(100_000)
+                self._check(store, store.put_file(self._file("a.bin", data)), data, "full")
+                self._check(store, store.put_file(self._file("a.png", text + b"png")), text + b"png", "full")
+
+    def test_compressed_chunks(self):
+        text = "".join(f"registro {i:08d}\n" for i in range(40_000)).encode('utf-8')
+        store = self._store(chunk_min_size=1, chunk_avg_size=4096, compression="zlib")
+        digest = store.put_file(self._file("a.txt", text))
+        self._check(store, digest, text, "chunks")
+        self.assertTrue(all(store.loose_path(chunk)[1] == "compressed" for chunk in store.dependencies(digest)))
+
+    def test_truncated_compressed_object(self):
+        store = self._store(compression="zlib")
+        text = b"abcdefgh" * 100_000
+        digest = store.put_file(self._file("a.txt", text))
+        path = store.loose_path(digest)[0]
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) // 2)
+        with self.assertRaises(ValueError):
+            store.write_content(digest, io.BytesIO())
+
+    def test_tree(self):
+        store = self._store()
+        file_digest = store.put_file(self._file("a.bin", b"contenido"))
+        sub = store.put_tree({"a.bin": {"hash": file_digest, "size": 9, "mtime_ns": 1}})
+        entries = {"sub": {"tree": sub, "files": 1, "size": 9}, "ñ.txt": {"hash": file_digest, "size": 9, "mtime_ns": 2}}
+        digest = store.put_tree(entries)
+        self.assertEqual(store.put_tree(dict(reversed(list(entries.items())))), digest)
+        self.assertEqual(store.read_tree(digest), entries)
+        self.assertEqual(store.loose_path(digest)[1], "tree")
+        self.assertEqual(set(store.dependencies(digest)), {sub, file_digest})
+        store.verify(digest)
+
+    def test_put_stored(self):
+        # Los objetos pasan a otro almacén tal como están guardados (un delta sigue siendo delta)
+        store = self._store(delta_min_size=1, delta_max_chain=8, delta_block_size=1024)
+        data = self._data(64 * 1024)
+        base = store.put_file(self._file("a.bin", data))
+        edited = data[:1000] + b"cambio" + data[1006:]
+        digest = store.put_file(self._file("b.bin", edited), base=base)
+
+        other = self._store("otro")
+        for item in (base, digest):
+            with store.open_stored(item) as (kind, size, reader):
+                self.assertTrue(other.put_stored(item, kind, reader))
+        with store.open_stored(base) as (kind, size, reader):
+            self.assertFalse(other.put_stored(base, kind, reader))
+        self._check(other, digest, edited, "delta")
+
+    def test_put_stored_rejects_wrong_content(self):
+        store = self._store()
+        digest = store.put_file(self._file("a.bin", b"original"))
+        with self.assertRaises(ValueError):
+            store.put_stored("0" * 64, "full", io.BytesIO(b"original"))
+        self.assertFalse(store.exists("0" * 64))
+
+        # Un delta con otro contenido se detecta al comprobarlo y se borra
+        self.assertTrue(store.put_stored("1" * 64, "delta", io.BytesIO(b"no es un delta")))
+        with self.assertRaises(ValueError):
+            store.verify("1" * 64)
+        self.assertFalse(store.exists("1" * 64))
+        self.assertTrue(store.exists(digest))
+
+
+class StoredVersionsTest(unittest.TestCase):
+    # Las versiones guardadas con deltas, trozos y compresión se recuperan con su contenido exacto
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+
+    def _system(self, config):
+        with open(os.path.join(self.root, ".configuracion.json"), 'w', encoding='utf-8') as f:
+            json.dump(config, f)
+        with contextlib.redirect_stdout(io.StringIO()):
+            system = tarea.FileManagementSystem(self.root)
+        self.addCleanup(system.close)
+        self.assertTrue(system.register_user("ana", "clave")[0])
+        ok, session = system.login("ana", "clave")
+        self.assertTrue(ok)
+        return system, session
+
+    @staticmethod
+    def _state(directory):
+        state = {}
+        for name in tarea.FileManagementSystem._scan_files(directory):
+            with open(os.path.join(directory, name), 'rb') as f:
+                state[name] = f.read()
+        return state
+
+    def test_recover_every_format(self):
+        system, session = self._system({"delta_min_size": 1, "delta_max_chain": 3, "delta_block_size": 1024,
+                                        "chunk_min_size": 512 * 1024, "chunk_avg_size": 16 * 1024,
+                                        "compression": "zlib"})
+        temporal_dir = system.users["ana"]["temporal_dir"]
+        permanente_dir = system.users["ana"]["permanente_dir"]
+        generator = random.Random(99)
+        big = bytearray(random_bytes(generator, 1024 * 1024))
+        medium = bytearray(random_bytes(generator, 200 * 1024))
+        expected = []
+        for i in range(5):
+            big[i * 1000:i * 1000 + 4] = b"%04d" % i
+            medium[i * 3000:i * 3000 + 4] = b"%04d" % i
+            files = {"grande.bin": bytes(big), "sub/medio.bin": bytes(medium),
+                     "sub/dentro/texto.txt": ("texto repetido %d\n" % i).encode() * 5000}
+            for name, data in files.items():
+                path = os.path.join(temporal_dir, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(data)
+            before = self._state(permanente_dir)
+            ok, message = system.commit(session)
+            self.assertTrue(ok, message)
+            if before:
+                expected.append((system.list_versions(session, limit=1)[1][0]["version_id"], before))
+
+        kinds = {kind for digest, _, _ in system.blobs.iter_objects() if digest
+                 for kind in [system.blobs.loose_path(digest)[1]]}
+        self.assertLessEqual({"full", "delta", "chunks", "compressed", "tree"}, kinds)
+        for version_id, state in expected:
+            ok, message = system.recover_version(session, "carpeta", version_id)
+            self.assertTrue(ok, message)
+            self.assertEqual(self._state(permanente_dir), state)
+            ok, message = system.recover_version(session, "archivo", version_id, "sub/medio.bin")
+            self.assertTrue(ok, message)
+            with open(os.path.join(permanente_dir, "sub", "medio.bin"), 'rb') as f:
+                self.assertEqual(f.read(), state["sub/medio.bin"])
+
+
+if __name__ == "__main__":
+    unittest.main()
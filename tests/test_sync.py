@@ -0,0 +1,126 @@
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tarea
+
+
+class IncrementalSyncTest(unittest.TestCase):
+    # commit y update solo copian lo que cambió entre la carpeta de trabajo y la permanente,
+    # también los archivos reescritos con el mismo tamaño en el mismo instante que su copia
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        with open(os.path.join(self.root, ".configuracion.json"), 'w', encoding='utf-8') as f:
+            json.dump({}, f)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.system = tarea.FileManagementSystem(self.root)
+        self.addCleanup(self.system.close)
+        self.assertTrue(self.system.register_user("ana", "clave")[0])
+        ok, self.session = self.system.login("ana", "clave")
+        self.assertTrue(ok)
+        self.temporal_dir = self.system.users["ana"]["temporal_dir"]
+        self.permanente_dir = self.system.users["ana"]["permanente_dir"]
+
+    @staticmethod
+    def _write(path, data, mtime_ns=None):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        if mtime_ns is not None:
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    @staticmethod
+    def _read(path):
+        with open(path, encoding='utf-8') as f:
+            return f.read()
+
+    def _commit(self, expected):
+        ok, message = self.system.commit(self.session)
+        self.assertTrue(ok, message)
+        self.assertIn(expected, message)
+
+    def test_commit_and_update(self):
+        self._write(os.path.join(self.temporal_dir, "a.txt"), "uno")
+        self._write(os.path.join(self.temporal_dir, "b.txt"), "dos")
+        self._write(os.path.join(self.temporal_dir, "sub", "c.txt"), "tres")
+        self._commit("3 añadidos, 0 modificados, 0 eliminados")
+        self.assertEqual(self.system.commit(self.session), (True, "No hay cambios para confirmar."))
+
+        self._write(os.path.join(self.temporal_dir, "a.txt"), "uno cambiado")
+        os.remove(os.path.join(self.temporal_dir, "sub", "c.txt"))
+        self._write(os.path.join(self.temporal_dir, "d.txt"), "cuatro")
+        self._commit("1 añadidos, 1 modificados, 1 eliminados")
+        self.assertFalse(os.path.exists(os.path.join(self.permanente_dir, "sub")))
+        self.assertEqual(self._read(os.path.join(self.permanente_dir, "a.txt")), "uno cambiado")
+
+        # update deja temporal igual que permanente; en simulación no cambia nada
+        os.remove(os.path.join(self.temporal_dir, "d.txt"))
+        self._write(os.path.join(self.temporal_dir, "b.txt"), "dos a medias")
+        self._write(os.path.join(self.temporal_dir, "e.txt"), "sin confirmar")
+        ok, message = self.system.update(self.session, dry_run=True)
+        self.assertTrue(ok, message)
+        self.assertIn("1 añadidos, 1 modificados, 1 eliminados", message)
+        self.assertEqual(self._read(os.path.join(self.temporal_dir, "b.txt")), "dos a medias")
+        ok, message = self.system.update(self.session)
+        self.assertTrue(ok, message)
+        self.assertEqual(sorted(tarea.FileManagementSystem._scan_files(self.temporal_dir)), ["a.txt", "b.txt", "d.txt"])
+        self.assertEqual(self._read(os.path.join(self.temporal_dir, "b.txt")), "dos")
+        self.assertEqual(self.system.update(self.session, dry_run=True),
+                         (True, "Simulación: no hay cambios que aplicar."))
+
+    def test_same_size_and_time(self):
+        # Un archivo reescrito con el mismo tamaño en el mismo instante que el de permanente sí cambió
+        path = os.path.join(self.temporal_dir, "a.txt")
+        self._write(path, "uno")
+        self._commit("1 añadidos")
+        mtime_ns = os.stat(os.path.join(self.permanente_dir, "a.txt")).st_mtime_ns
+        self._write(path, "dos", mtime_ns)
+        self._commit("0 añadidos, 1 modificados, 0 eliminados")
+        self.assertEqual(self._read(os.path.join(self.permanente_dir, "a.txt")), "dos")
+
+        # Lo mismo en update
+        self._write(path, "tre", mtime_ns)
+        ok, message = self.system.update(self.session)
+        self.assertTrue(ok, message)
+        self.assertEqual(self._read(path), "dos")
+
+    def test_version_after_same_size_and_time(self):
+        # La versión siguiente guarda el contenido nuevo aunque tenga el tamaño y la fecha de la anterior
+        path = os.path.join(self.temporal_dir, "a.txt")
+        self._write(path, "uno")
+        self._commit("1 añadidos")
+        mtime_ns = os.stat(os.path.join(self.permanente_dir, "a.txt")).st_mtime_ns
+        self._write(os.path.join(self.temporal_dir, "b.txt"), "b")
+        self._commit("1 añadidos")
+        self._write(path, "dos", mtime_ns)
+        self._commit("1 modificados")
+        self._write(os.path.join(self.temporal_dir, "c.txt"), "c")
+        self._commit("1 añadidos")
+
+        ok, versions = self.system.list_versions(self.session)
+        self.assertTrue(ok, versions)
+        for version, expected in zip(versions, ("dos", "uno", "uno")):
+            ok, message = self.system.recover_version(self.session, "archivo", version["version_id"], "a.txt")
+            self.assertTrue(ok, message)
+            self.assertEqual(self._read(os.path.join(self.permanente_dir, "a.txt")), expected)
+
+    def test_old_files_are_compared_by_stat(self):
+        # Con la misma fecha antigua y el mismo tamaño no se leen los contenidos
+        path = os.path.join(self.temporal_dir, "a.txt")
+        self._write(path, "uno", 1_600_000_000_000_000_000)
+        self._commit("1 añadidos")
+        self._write(path, "dos", 1_600_000_000_000_000_000)
+        self.assertEqual(self.system.commit(self.session), (True, "No hay cambios para confirmar."))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,214 @@
+import contextlib
+import datetime
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tarea
+
+
+class VersionHistoryTest(unittest.TestCase):
+    # Empaquetar, limpiar con gc y reconstruir el índice no cambia el contenido de las versiones que quedan,
+    # y las versiones se guardan en carpetas por día con identificadores ordenados por fecha
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+
+    def _system(self, config=None):
+        with open(os.path.join(self.root, ".configuracion.json"), 'w', encoding='utf-8') as f:
+            json.dump(config or {}, f)
+        with contextlib.redirect_stdout(io.StringIO()):
+            system = tarea.FileManagementSystem(self.root)
+        self.addCleanup(system.close)
+        if not system.users:
+            self.assertTrue(system.register_user("ana", "clave")[0])
+        ok, session = system.login("ana", "clave")
+        self.assertTrue(ok)
+        return system, session
+
+    @staticmethod
+    def _state(directory):
+        state = {}
+        for name in tarea.FileManagementSystem._scan_files(directory):
+            with open(os.path.join(directory, name), 'rb') as f:
+                state[name] = f.read()
+        return state
+
+    def _history(self, system, session, count):
+        # Hace count + 1 commits, cada uno con un archivo propio y uno que cambia siempre
+        # Devuelve [(id de versión, contenido de permanente que guarda)] de la más antigua a la más reciente
+        temporal_dir = system.users["ana"]["temporal_dir"]
+        permanente_dir = system.users["ana"]["permanente_dir"]
+        expected = []
+        for i in range(count + 1):
+            with open(os.path.join(temporal_dir, f"solo_{i}.txt"), 'w', encoding='utf-8') as f:
+                f.write(f"solo en la versión {i}\n" * 10)
+            with open(os.path.join(temporal_dir, "comun.txt"), 'w', encoding='utf-8') as f:
+                f.write(f"cambio {i}\n")
+            os.makedirs(os.path.join(temporal_dir, "sub"), exist_ok=True)
+            with open(os.path.join(temporal_dir, "sub", "fijo.txt"), 'w', encoding='utf-8') as f:
+                f.write("siempre igual\n")
+            if i:
+                os.remove(os.path.join(temporal_dir, f"solo_{i - 1}.txt"))
+            before = self._state(permanente_dir)
+            ok, message = system.commit(session)
+            self.assertTrue(ok, message)
+            if before:
+                expected.append((system.list_versions(session, limit=1)[1][0]["version_id"], before))
+        self.assertEqual(len(expected), count)
+        return expected
+
+    def _check_versions(self, system, session, expected):
+        permanente_dir = system.users["ana"]["permanente_dir"]
+        for version_id, state in expected:
+            ok, message = system.recover_version(session, "carpeta", version_id)
+            self.assertTrue(ok, message)
+            self.assertEqual(self._state(permanente_dir), state, version_id)
+            ok, message = system.recover_version(session, "archivo", version_id, "comun.txt")
+            self.assertTrue(ok, message)
+
+    def _listed(self, system, session):
+        ok, versions = system.list_versions(session)
+        self.assertTrue(ok, versions)
+        return [entry["version_id"] for entry in versions]
+
+    def test_version_ids_and_shards(self):
+        ids = [tarea.VersionId.new() for _ in range(200)]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), len(ids))
+        now_ms = time.time_ns() // 10**6
+        self.assertLess(abs(tarea.VersionId.millis(ids[-1]) - now_ms), 60_000)
+        self.assertIsNone(tarea.VersionId.millis("2d6f9c4a-1c3e-4b0a-9f1e-3a5b7c9d1e2f"))
+        self.assertIsNone(tarea.VersionId.millis("no es un id"))
+        self.assertEqual(tarea.VersionId.shard(0), "1970-01-01")
+        self.assertTrue(tarea.VersionId.is_shard("2024-02-29"))
+        self.assertFalse(tarea.VersionId.is_shard(ids[0]))
+
+        system, session = self._system()
+        expected = self._history(system, session, 3)
+        listed = self._listed(system, session)
+        self.assertEqual(listed, [version_id for version_id, _ in reversed(expected)])
+        for version_id, _ in expected:
+            shard = tarea.VersionId.shard(tarea.VersionId.millis(version_id))
+            self.assertTrue(os.path.isfile(os.path.join(system.versions_dir, "ana", shard, version_id, "metadata.json")))
+
+    def test_rebuild_version_index(self):
+        system, session = self._system()
+        self._history(system, session, 4)
+        listed = system.list_versions(session)[1]
+        index_path = os.path.join(system.versions_dir, "ana", ".indice.jsonl")
+
+        os.remove(index_path)
+        self.assertEqual(system.list_versions(session)[1], listed)
+        with open(index_path, 'w', encoding='utf-8') as f:
+            f.write('{"version_id": "roto"\n')
+        ok, message = system.rebuild_version_index(session)
+        self.assertTrue(ok, message)
+        self.assertIn("4 versiones", message)
+        self.assertEqual(system.list_versions(session)[1], listed)
+        self.assertEqual(system.list_versions(session, limit=2, offset=1)[1], listed[1:3])
+
+    def test_pack_versions(self):
+        system, session = self._system({"pack_min_age_days": 0, "pack_keep_recent": 2})
+        expected = self._history(system, session, 5)
+        listed = self._listed(system, session)
+        objects_before = sum(1 for digest, _, _ in system.blobs.iter_objects() if digest)
+
+        ok, message = system.pack_versions(session, dry_run=True)
+        self.assertTrue(ok, message)
+        self.assertIn("Simulación", message)
+        self.assertEqual(system.blobs.packs(), [])
+
+        ok, message = system.pack_versions(session)
+        self.assertTrue(ok, message)
+        self.assertIn("Empaquetadas 3 versiones", message)
+        self.assertEqual(len(system.blobs.packs()), 1)
+        for version_id, _ in expected[:3]:
+            self.assertFalse(os.path.exists(system._version_dir("ana", version_id)))
+            self.assertIsNotNone(system.blobs.packed_version("ana", version_id))
+        for version_id, _ in expected[3:]:
+            self.assertTrue(os.path.isdir(system._version_dir("ana", version_id)))
+        self.assertLess(sum(1 for digest, _, _ in system.blobs.iter_objects() if digest), objects_before)
+        self.assertEqual(system.pack_versions(session), (True, "No hay versiones frías para empaquetar."))
+
+        # Las versiones empaquetadas se listan, se recuperan y entran en el índice reconstruido
+        self.assertEqual(self._listed(system, session), listed)
+        self._check_versions(system, session, expected)
+        self.assertTrue(system.rebuild_version_index(session)[0])
+        self.assertEqual(self._listed(system, session), listed)
+
+        # Y también desde otro sistema que abre la misma raíz
+        other, other_session = self._system({"pack_min_age_days": 0, "pack_keep_recent": 2})
+        self._check_versions(other, other_session, expected)
+
+    def test_gc_keep_last(self):
+        system, session = self._system({"retention": {"keep_last": 2}})
+        expected = self._history(system, session, 5)
+        listed = self._listed(system, session)
+        # solo_0.txt solo está en la primera versión; sub/fijo.txt está en todas
+        only_first = hashlib.sha256(expected[0][1]["solo_0.txt"]).hexdigest()
+        shared = hashlib.sha256(expected[0][1]["sub/fijo.txt"]).hexdigest()
+        # gc no borra contenidos creados después de empezar
+        time.sleep(0.01)
+
+        ok, message = system.gc(session, dry_run=True)
+        self.assertTrue(ok, message)
+        self.assertIn("3 versiones", message)
+        self.assertEqual(self._listed(system, session), listed)
+
+        ok, message = system.gc(session)
+        self.assertTrue(ok, message)
+        self.assertEqual(self._listed(system, session), listed[:2])
+        for version_id, _ in expected[:3]:
+            self.assertFalse(os.path.exists(system._version_dir("ana", version_id)))
+        self.assertFalse(system.blobs.exists(only_first))
+        self.assertTrue(system.blobs.exists(shared))
+        self._check_versions(system, session, expected[3:])
+        ok, message = system.recover_version(session, "carpeta", expected[0][0])
+        self.assertFalse(ok)
+
+    def test_gc_packed_versions(self):
+        # gc también quita versiones y contenidos de los paquetes
+        system, session = self._system({"pack_min_age_days": 0, "pack_keep_recent": 1,
+                                        "retention": {"keep_last": 3}})
+        expected = self._history(system, session, 5)
+        self.assertTrue(system.pack_versions(session)[0])
+        time.sleep(0.01)
+        ok, message = system.gc(session)
+        self.assertTrue(ok, message)
+        packed = {version_id for pack in system.blobs.packs() for version_id in pack.versions.get("ana", {})}
+        self.assertEqual(packed, {version_id for version_id, _ in expected[2:4]})
+        self.assertEqual(len(self._listed(system, session)), 3)
+        self._check_versions(system, session, expected[2:])
+
+    def test_retention_rules(self):
+        system, session = self._system()
+        now = datetime.datetime(2024, 3, 15, 12, 0)
+        moments = [now - datetime.timedelta(hours=hours) for hours in (0, 1, 25, 26, 24 * 8, 24 * 9, 24 * 40)]
+        entries = [{"version_id": f"v{i}", "timestamp": moment.isoformat()} for i, moment in enumerate(moments)]
+
+        def kept(**policy):
+            system.config["retention"] = {**tarea.DEFAULT_CONFIG["retention"], **policy}
+            expired = {entry["version_id"] for entry in system._expired_versions(entries, now)}
+            return [entry["version_id"] for entry in entries if entry["version_id"] not in expired]
+
+        self.assertEqual(kept(), [entry["version_id"] for entry in entries])
+        self.assertEqual(kept(keep_last=0), ["v0"])
+        self.assertEqual(kept(keep_last=3), ["v0", "v1", "v2"])
+        self.assertEqual(kept(keep_daily=2), ["v0", "v2"])
+        self.assertEqual(kept(keep_weekly=2), ["v0", "v4"])
+        self.assertEqual(kept(max_age_days=2), ["v0", "v1", "v2", "v3"])
+        self.assertEqual(kept(keep_last=1, max_age_days=10), ["v0", "v1", "v2", "v3", "v4", "v5"])
+
+
+if __name__ == "__main__":
+    unittest.main()